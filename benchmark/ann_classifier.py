@@ -0,0 +1,63 @@
+"""
+Benchmark of the ANN classifier: latency per face and agreement with the exact nearest neighbour, for increasing
+`nprobe`, on synthetic 128-d embeddings of `identities` classes.
+
+    python -m benchmark.ann_classifier --identities 10000 --per_class 20 --nprobe 1 4 8 16 32
+"""
+import argparse
+import time
+
+import numpy as np
+
+from src.ann import AnnClassifier, normalise
+
+
+def make_dataset(identities, per_class, dim=128, noise=0.8, seed=0):
+    rng = np.random.RandomState(seed)
+    centers = rng.normal(size=(identities, dim))
+    X = np.repeat(centers, per_class, axis=0) + noise * rng.normal(size=(identities * per_class, dim))
+    y = np.repeat(np.arange(identities), per_class)
+    queries = rng.randint(identities, size=1000)
+    faces = centers[queries] + noise * rng.normal(size=(len(queries), dim))
+    return X.astype('float32'), y, faces.astype('float32'), queries
+
+
+def main(identities, per_class, nprobes, batch_size=1):
+    X, y, faces, truth = make_dataset(identities, per_class)
+    start = time.time()
+    model = AnnClassifier().train(X, y)
+    print('Built in %.1fs' % (time.time() - start))
+
+    # exact nearest neighbour, by brute force
+    exact = y[np.argmax(normalise(faces) @ normalise(X).T, axis=1)]
+
+    classes = np.asarray(model.classes_)
+    print('%7s %10s %12s %10s %10s' % ('nprobe', 'batch', 'ms per face', 'recall@1', 'accuracy'))
+    for nprobe in nprobes:
+        start = time.time()
+        best = []
+        for i in range(0, len(faces), batch_size):
+            proba = model.predict_proba(faces[i:i + batch_size], nprobe)
+            best.extend(classes[np.argmax(proba, axis=1)])
+        elapsed = (time.time() - start) / len(faces)
+        best = np.array(best)
+        print('%7d %10d %12.3f %10.3f %10.3f' % (nprobe, batch_size, elapsed * 1000, (best == exact).mean(),
+                                                (best == truth).mean()))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--identities', type=int, default=10000,
+                        help='Number of classes')
+    parser.add_argument('--per_class', type=int, default=20,
+                        help='Training images per class')
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[1, 4, 8, 16, 32],
+                        help='Numbers of lists scanned per face')
+    parser.add_argument('--batch_size', type=int, default=1,
+                        help='Number of faces classified together')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args.identities, args.per_class, args.nprobe, args.batch_size)
@@ -0,0 +1,154 @@
+"""
+Benchmark of the appearance-aware association of the tracker: fragmentation of the tracks, and time of the
+downstream stages (recognition, `clusterize`), with the association on IoU only and mixed with the FaceNet
+similarity.
+
+On synthetic scenes, where the faces move between two samples and their embeddings are noisy copies of the one of
+their person (same person at about `--similarity`, different persons at about 0):
+
+    python -m benchmark.appearance_tracking --people 5 20 50 --weights 0 0.5
+
+On a video, with the models of a project:
+
+    python -m benchmark.appearance_tracking --video video/sample.mp4 --project general --weights 0 0.5
+"""
+import argparse
+import tempfile
+import time
+
+import numpy as np
+
+from src import clusterize
+from src.SORT.kalman_tracker import KalmanBoxTracker
+from src.SORT.sort import Sort
+
+WIDTH, HEIGHT = 1280, 720
+
+
+def make_scene(people, samples, dim=128, similarity=0.7, step=0.6, visible=0.97, seed=0):
+    """
+    The detections [x1,y1,x2,y2,score], person and embedding of each sample. Between two samples, a face moves by
+    `step` times its size, and is missed by the detector with probability 1 - `visible`.
+    """
+    rng = np.random.RandomState(seed)
+    identities = rng.normal(size=(people, dim))
+    identities /= np.linalg.norm(identities, axis=1, keepdims=True)
+    side = rng.uniform(40, 120, people)
+    position = np.stack([rng.uniform(0, WIDTH - side), rng.uniform(0, HEIGHT - side)], axis=1)
+
+    scene = []
+    for _ in range(samples):
+        position += rng.normal(scale=step, size=position.shape) * side[:, None]
+        position = np.clip(position, 0, np.array([WIDTH, HEIGHT]) - side[:, None] - 1)
+        seen = np.flatnonzero(rng.rand(people) < visible)
+        seen = seen[rng.permutation(len(seen))]
+        boxes = np.stack([position[seen, 0], position[seen, 1], position[seen, 0] + side[seen],
+                          position[seen, 1] + side[seen], np.full(len(seen), 0.9)], axis=1)
+        noise = rng.normal(size=(len(seen), dim))
+        noise /= np.linalg.norm(noise, axis=1, keepdims=True)
+        embeddings = np.sqrt(similarity) * identities[seen] + np.sqrt(1 - similarity) * noise
+        scene.append((boxes, seen, embeddings))
+    return scene
+
+
+def track_scene(scene, appearance_weight, min_similarity, root_dic):
+    """The rows (track, sample, person, box) of the tracked faces, and the tracking time per sample"""
+    KalmanBoxTracker.count = 0
+    sort = Sort(min_hits=0, appearance_weight=appearance_weight, min_similarity=min_similarity)
+    rows = []
+    start = time.time()
+    for sample, (boxes, persons, embeddings) in enumerate(scene):
+        # the person as last attribute, in place of the landmarks, to know who each track follows
+        attributes = [[None, 0.5, person] for person in persons]
+        tracked = sort.update(boxes, (HEIGHT, WIDTH), root_dic, attributes,
+                              embeddings=embeddings if appearance_weight > 0 else None)
+        rows += [(int(d[4]), sample, int(d[5]), d[0:4].astype(float).tolist()) for d in tracked]
+    return rows, (time.time() - start) / len(scene)
+
+
+def fragmentation(rows):
+    """Tracks, tracks per person and share of the observations of a track that are not of its main person"""
+    tracks = {}
+    for track, _, person, _ in rows:
+        tracks.setdefault(track, []).append(person)
+    main_person = {t: np.bincount(p).argmax() for t, p in tracks.items()}
+    per_person = {}
+    for track, persons in tracks.items():
+        for person in set(persons):
+            per_person.setdefault(person, set()).add(track)
+    wrong = sum(sum(p != main_person[t] for p in persons) for t, persons in tracks.items())
+    return len(tracks), np.mean([len(t) for t in per_person.values()]), wrong / max(len(rows), 1)
+
+
+def clusterize_time(matches):
+    """Time and number of segments of the clustering of the predictions"""
+    start = time.time()
+    clusters = clusterize.main(clusterize.from_dict(matches), dominant_ratio=0.6, weighted_dominant_ratio=0.4,
+                               confidence_threshold=0.6, merge_cluster=True, min_length=1)
+    return time.time() - start, len(clusters)
+
+
+def synthetic(people_counts, weights, samples=200, similarity=0.7, step=0.6, min_similarity=0.6):
+    print('%6s %7s %7s %12s %10s %11s %10s %13s %9s' % ('people', 'weight', 'tracks', 'per person', 'wrong %',
+                                                          'sort ms', 'segments', 'clusterize s', 'samples'))
+    with tempfile.TemporaryDirectory() as root_dic:
+        for people in people_counts:
+            scene = make_scene(people, samples, similarity=similarity, step=step)
+            for weight in weights:
+                rows, sort_time = track_scene(scene, weight, min_similarity, root_dic)
+                tracks, per_person, wrong = fragmentation(rows)
+                matches = [{'track_id': t, 'tracker_sample': s, 'name': 'person_%d' % p, 'confidence': 0.9,
+                            'frame': s * 25, 'npt': s, 'rect': r} for t, s, p, r in rows]
+                cluster_time, segments = clusterize_time(matches)
+                print('%6d %7.2f %7d %12.2f %10.2f %11.3f %10d %13.2f %9d' % (
+                    people, weight, tracks, per_person, 100 * wrong, 1000 * sort_time, segments, cluster_time,
+                    len(rows) / tracks))
+
+
+def video(video_path, project, weights, video_speedup=25, min_similarity=0.6):
+    from src.tracker import Tracker
+
+    tracker = Tracker(project)
+    print('%7s %7s %12s %13s %10s %13s %10s' % ('weight', 'tracks', 'samples/track', 'recognitions', 'tracker s',
+                                                 'clusterize s', 'segments'))
+    for weight in weights:
+        start = time.time()
+        matches = tracker.run(video_path, video_speedup, cluster_features=False, verbose=False,
+                              appearance_weight=weight, min_similarity=min_similarity)
+        elapsed = time.time() - start
+        tracks = len(tracker.track_ends)
+        cluster_time, segments = clusterize_time(matches)
+        samples = np.mean([e['last_sample'] - e['first_sample'] + 1 for e in tracker.track_ends.values()])
+        print('%7.2f %7d %12.1f %13d %10.1f %13.2f %10d' % (
+            weight, tracks, samples, tracker.recognition_stats['recognitions'], elapsed, cluster_time, segments))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--weights', type=float, nargs='+', default=[0, 0.5],
+                        help='Appearance weights to compare, 0 for IoU only')
+    parser.add_argument('--min_similarity', type=float, default=0.6,
+                        help='Min cosine similarity for continuing a track whose IoU is too low')
+    parser.add_argument('--people', type=int, nargs='+', default=[5, 20, 50],
+                        help='Faces per synthetic scene')
+    parser.add_argument('--samples', type=int, default=200,
+                        help='Samples per synthetic scene')
+    parser.add_argument('--similarity', type=float, default=0.7,
+                        help='Expected cosine similarity between two embeddings of the same person')
+    parser.add_argument('--step', type=float, default=0.6,
+                        help='Motion of the faces between two samples, relative to their size')
+    parser.add_argument('--video', type=str, default=None,
+                        help='Video to analyse instead of the synthetic scenes')
+    parser.add_argument('--project', type=str, default='general',
+                        help='Project of the classifier, with --video')
+    parser.add_argument('--video_speedup', type=int, default=25,
+                        help='Speed up for the video')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.video:
+        video(args.video, args.project, args.weights, args.video_speedup, args.min_similarity)
+    else:
+        synthetic(args.people, args.weights, args.samples, args.similarity, args.step, args.min_similarity)
@@ -0,0 +1,98 @@
+"""
+Benchmark of the data association of SORT: the vectorised `associate_detections_to_trackers` against the previous
+implementation, with a Python loop over the pairs, on synthetic crowd frames from 1 to 500 faces. Both must return
+the same matches and unmatched detections and trackers, in the same order.
+
+    python -m benchmark.association --sizes 1 10 50 100 500
+"""
+import argparse
+import time
+
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+from src.SORT.data_association import associate_detections_to_trackers, iou
+
+
+def reference_association(detections, trackers, iou_threshold=0.25):
+    """The previous implementation"""
+    if len(trackers) == 0:
+        return np.empty((0, 2), dtype=int), np.arange(len(detections)), np.empty((0, 5), dtype=int)
+    iou_matrix = np.zeros((len(detections), len(trackers)), dtype=np.float32)
+    for d, det in enumerate(detections):
+        for t, trk in enumerate(trackers):
+            iou_matrix[d, t] = iou(det, trk)
+    matched_indices = np.transpose(np.asarray(linear_sum_assignment(-iou_matrix)))
+
+    unmatched_detections = [d for d, det in enumerate(detections) if d not in matched_indices[:, 0]]
+    unmatched_trackers = [t for t, trk in enumerate(trackers) if t not in matched_indices[:, 1]]
+    matches = []
+    for m in matched_indices:
+        if iou_matrix[m[0], m[1]] < iou_threshold:
+            unmatched_detections.append(m[0])
+            unmatched_trackers.append(m[1])
+        else:
+            matches.append(m.reshape(1, 2))
+    matches = np.concatenate(matches, axis=0) if matches else np.empty((0, 2), dtype=int)
+    return matches, np.array(unmatched_detections), np.array(unmatched_trackers)
+
+
+def make_frame(size, width=1920, height=1080, seed=0):
+    """
+    The predicted boxes of `size` tracks and the detections of the frame: most tracks are detected again with some
+    motion, some are lost or moved too far, and new faces appear.
+    """
+    rng = np.random.RandomState(seed)
+    side = rng.uniform(20, 80, size)
+    x1 = rng.uniform(0, width - side)
+    y1 = rng.uniform(0, height - side)
+    trackers = np.stack([x1, y1, x1 + side, y1 + side, np.zeros(size)], axis=1)
+
+    kept = trackers[rng.rand(size) < 0.9, :4]
+    kept += rng.normal(scale=0.15, size=kept.shape) * (kept[:, 2:3] - kept[:, 0:1])
+    new = size - len(kept) + rng.randint(0, 3)
+    side = rng.uniform(20, 80, new)
+    x1 = rng.uniform(0, width - side)
+    y1 = rng.uniform(0, height - side)
+    boxes = np.concatenate([kept, np.stack([x1, y1, x1 + side, y1 + side], axis=1)])
+    detections = np.concatenate([boxes, rng.uniform(0.9, 1, (len(boxes), 1))], axis=1)
+    return detections[rng.permutation(len(detections))], trackers
+
+
+def same(a, b):
+    return all(x.shape == y.shape and np.array_equal(x, y) for x, y in zip(a, b))
+
+
+def timed(function, frames, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        results = [function(d, t) for d, t in frames]
+    return (time.time() - start) / repeat / len(frames), results
+
+
+def main(sizes, frames=20, repeat=3):
+    print('%6s %14s %14s %9s %10s %8s' % ('boxes', 'reference ms', 'vectorised ms', 'speed-up', 'unmatched', 'same'))
+    for size in sizes:
+        data = [make_frame(size, seed=seed) for seed in range(frames)]
+        reference_time, expected = timed(reference_association, data, repeat)
+        vectorised_time, found = timed(associate_detections_to_trackers, data, repeat)
+        unmatched = np.mean([len(r[1]) + len(r[2]) for r in expected])
+        print('%6d %14.3f %14.3f %9.1f %10.1f %8s' % (
+            size, reference_time * 1000, vectorised_time * 1000, reference_time / vectorised_time, unmatched,
+            all(same(e, f) for e, f in zip(expected, found))))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 5, 10, 20, 50, 100, 200, 500],
+                        help='Number of tracks, and about the number of detections, per frame')
+    parser.add_argument('--frames', type=int, default=20,
+                        help='Frames per size')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Repetitions of the timing')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args.sizes, args.frames, args.repeat)
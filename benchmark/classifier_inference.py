@@ -0,0 +1,73 @@
+"""
+Benchmark of the inference of FacerecClassifier: one `predict_proba` per binary SVC against the compiled
+`LinearOvR`, with 10, 100 and 1000 classes of synthetic 128-d embeddings.
+
+The inference cost does not depend on the training set, so each estimator is fitted on the samples of its class
+and a random subset of the others, to keep the benchmark short.
+
+    python -m benchmark.classifier_inference --classes 10 100 1000
+"""
+import argparse
+import time
+
+import numpy as np
+from sklearn.svm import SVC
+
+from src.classifier import FacerecClassifier
+
+
+def make_classifier(n_classes, dim=128, per_class=10, negatives=200, seed=0):
+    rng = np.random.RandomState(seed)
+    centers = rng.normal(size=(n_classes, dim))
+    X = np.concatenate([c + 0.8 * rng.normal(size=(per_class, dim)) for c in centers])
+    y = np.repeat(np.arange(n_classes), per_class)
+
+    estimators = []
+    for c in range(n_classes):
+        positives = np.where(y == c)[0]
+        others = rng.choice(np.where(y != c)[0], min(negatives, len(y) - per_class), replace=False)
+        index = np.concatenate([positives, others])
+        estimators.append(SVC(kernel='linear', probability=True).fit(X[index], (y[index] == c).astype(int)))
+
+    model = FacerecClassifier()
+    model.estimators_ = estimators
+    return model, X, centers
+
+
+def timed(function, X, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        result = function(X)
+    return (time.time() - start) / repeat, result
+
+
+def main(classes, batch_sizes, repeat=5):
+    print('%-8s %6s %12s %12s %8s %10s' % ('classes', 'batch', 'slow ms', 'compiled ms', 'speedup', 'max diff'))
+    for n_classes in classes:
+        model, X, centers = make_classifier(n_classes)
+        if not model.compile(X):
+            print('%d classes: not compiled' % n_classes)
+            continue
+        rng = np.random.RandomState(1)
+        for batch_size in batch_sizes:
+            faces = centers[rng.randint(n_classes, size=batch_size)] + 0.8 * rng.normal(size=(batch_size, X.shape[1]))
+            slow, expected = timed(model.estimators_proba, faces, repeat)
+            fast, found = timed(model.predict_proba, faces, repeat)
+            print('%-8d %6d %12.2f %12.3f %7.0fx %10.2g' % (n_classes, batch_size, slow * 1000, fast * 1000,
+                                                           slow / fast, np.abs(found - expected).max()))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--classes', type=int, nargs='+', default=[10, 100, 1000],
+                        help='Numbers of classes to benchmark')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 32],
+                        help='Numbers of faces classified together')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Repetitions of each measure')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args.classes, args.batch_sizes, args.repeat)
@@ -0,0 +1,74 @@
+"""
+Round trip of the classifiers through `classifier_store`: same probabilities after `save` and `load`, memory maps
+and time of the load, for a random forest project, a project of SVCs without the compiled inference (as when
+`FacerecClassifier.compile` rejects the estimators) and a compiled one.
+
+    python -m benchmark.classifier_store --classes 5 50
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from src.classifier import FacerecClassifier
+from src.utils import classifier_store
+
+
+def make_data(n_classes, dim=128, per_class=10, seed=0):
+    rng = np.random.RandomState(seed)
+    centers = rng.normal(size=(n_classes, dim))
+    X = np.concatenate([c + 0.8 * rng.normal(size=(per_class, dim)) for c in centers])
+    y = np.repeat(['person_%d' % c for c in range(n_classes)], per_class)
+    return X, y
+
+
+def mapped_files(root):
+    """Memory maps of the process on the files under `root`, or -1 where /proc is missing"""
+    try:
+        with open('/proc/self/maps') as f:
+            return sum(1 for line in f if os.path.realpath(root) in line)
+    except OSError:
+        return -1
+
+
+def round_trip(model, X, root, project):
+    expected = model.predict_proba(X)
+    classifier_store.save(project, model, list(model.classes_), root=root)
+    start = time.time()
+    _, (loaded, _) = classifier_store.load(project, root=root)
+    elapsed = time.time() - start
+    mapped = mapped_files(root)
+    found = loaded.predict_proba(X)
+    return elapsed, mapped, np.abs(found - expected).max(), getattr(loaded, 'compiled_', None) is not None
+
+
+def main(classes, n_jobs=1):
+    print('%-14s %8s %10s %8s %10s %9s' % ('classifier', 'classes', 'load ms', 'maps', 'max diff', 'compiled'))
+    with tempfile.TemporaryDirectory() as root:
+        for n_classes in classes:
+            X, y = make_data(n_classes)
+            for name, type, compiled in (('random forest', 'RF', False), ('svc', 'SVM', False),
+                                         ('compiled svc', 'SVM', True)):
+                model = FacerecClassifier(type, n_jobs=n_jobs).train(X, y)
+                if not compiled:
+                    model.compiled_ = None
+                elapsed, mapped, diff, loaded_compiled = round_trip(model, X, root, '%s-%d' % (type, n_classes))
+                print('%-14s %8d %10.1f %8d %10.2g %9s' % (name, n_classes, 1000 * elapsed, mapped, diff,
+                                                           loaded_compiled))
+                assert diff == 0, 'different probabilities after the round trip'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--classes', type=int, nargs='+', default=[5, 50],
+                        help='Numbers of classes of the projects')
+    parser.add_argument('--n_jobs', type=int, default=1,
+                        help='Processes fitting the estimators')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args.classes, args.n_jobs)
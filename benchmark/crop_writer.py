@@ -0,0 +1,106 @@
+"""
+Benchmark of the saving of the face crops of the finished tracks: time the tracking loop spends in it, with the
+previous synchronous writing (two resizes, PIL then OpenCV) and with the background `CropWriter`, keeping all the
+crops or the `top_k` best of each track.
+
+    python -m benchmark.crop_writer --tracks 200 --samples 50 --top_k 0 5
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from src.SORT.face_attributes import FaceAttributeStore
+from src.SORT.sort_utils import CropWriter, mkdir
+
+
+class FakeTrack:
+    def __init__(self, id, attributes):
+        self.id = id
+        self.attributes = attributes  # as kept before `FaceAttributeStore`
+        self.face_additional_attribute = FaceAttributeStore(max_crops=len(attributes))
+        for sample, attribute in enumerate(attributes):
+            self.face_additional_attribute.append(attribute, sample)
+
+
+def make_tracks(count, samples, seed=0):
+    """
+    Tracks with `samples` crops of 60 to 200 pixels each. The scores are skewed towards 1 as the confidences of
+    MTCNN for the faces it detects, about half of them above the 0.99 threshold of the saved crops.
+    """
+    rng = np.random.RandomState(seed)
+    tracks = []
+    for id in range(count):
+        side = rng.randint(60, 200)
+        face = rng.randint(0, 256, (side, side, 3), dtype=np.uint8)
+        attributes = [[face, 1 - rng.beta(1, 60), rng.rand(), 0., 0., None] for _ in range(samples)]
+        tracks.append(FakeTrack(id, attributes))
+    return tracks
+
+
+def reference_save(root_dic, tracker, frame):
+    """The previous implementation"""
+    image_size = 160
+    out_path = os.path.join(root_dic, str(tracker.id))
+    mkdir(out_path)
+    for i, item in enumerate(tracker.attributes):
+        if item[1] > 0.99:
+            scaled = np.array(Image.fromarray(item[0]).resize((image_size, image_size), resample=Image.BILINEAR))
+            scaled = cv2.resize(scaled, (image_size, image_size), interpolation=cv2.INTER_CUBIC)
+            cv2.imwrite("%s/%s.jpg" % (out_path, frame - i), scaled)
+
+
+def file_count(path):
+    return sum(len(files) for _, _, files in os.walk(path))
+
+
+def folder_size(path):
+    return sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(path) for f in files)
+
+
+def main(tracks, samples, top_ks, workers=2):
+    data = make_tracks(tracks, samples)
+    print('%-22s %12s %10s %10s %10s' % ('writer', 'tracking s', 'total s', 'crops', 'MB'))
+    with tempfile.TemporaryDirectory() as root:
+        path = os.path.join(root, 'reference')
+        start = time.time()
+        for track in data:
+            reference_save(path, track, samples)
+        elapsed = time.time() - start
+        print('%-22s %12.2f %10.2f %10d %10.1f' % ('synchronous', elapsed, elapsed, file_count(path),
+                                                   folder_size(path) / 2 ** 20))
+
+        for top_k in top_ks:
+            path = os.path.join(root, 'top%d' % top_k)
+            writer = CropWriter(workers=workers, top_k=top_k or None)
+            start = time.time()
+            for track in data:
+                writer.save(path, track)
+            tracking = time.time() - start
+            writer.close()
+            total = time.time() - start
+            stats = writer.stats()
+            print('%-22s %12.2f %10.2f %10d %10.1f' % ('background, top %s' % (top_k or 'all'), tracking, total,
+                                                       stats['crops'], stats['bytes'] / 2 ** 20))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tracks', type=int, default=200,
+                        help='Number of finished tracks')
+    parser.add_argument('--samples', type=int, default=50,
+                        help='Crops per track')
+    parser.add_argument('--top_k', type=int, nargs='+', default=[0, 5],
+                        help='Best crops kept per track, 0 for all')
+    parser.add_argument('--workers', type=int, default=2,
+                        help='Writer threads')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args.tracks, args.samples, args.top_k, args.workers)
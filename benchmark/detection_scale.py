@@ -0,0 +1,105 @@
+"""
+Benchmark of the detection resolution.
+
+MTCNN runs on frames sampled from a video, at the analysis resolution of the tracker (0.9 for videos wider than
+700px) and with the candidates searched on frames further downscaled by each `detection_scale`.
+The full pass at the analysis resolution is the reference for the accuracy of the boxes and of the landmarks.
+
+MTCNN already starts its pyramid at 12 / min_face_size: a detection scale saves time only when it is lower than
+that ratio, i.e. when the faces smaller than 12 / detection_scale pixels can be ignored.
+
+    python -m benchmark.detection_scale -v video.mp4 --scales 1 0.5 0.35 0.25
+"""
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from src.FaceDetector import FaceDetector
+from src.SORT.data_association import iou
+from src.utils import frame_source, utils
+
+
+def load_frames(video_path, samples, analysis_scale=None):
+    """Sample the frames as the tracker does: resized to the analysis resolution, gray in RGB"""
+    video_capture = cv2.VideoCapture(video_path)
+    length = int(video_capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    width = int(video_capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+    if analysis_scale is None:
+        analysis_scale = 0.9 if width > 700 else 1
+
+    frames = frame_source.sample_frames(0, length, max(length // samples, 1))[:samples]
+    images = []
+    for sample in frame_source.open_frame_source(video_capture, frames):
+        if sample.image is None:
+            break
+        frame = cv2.resize(sample.image, (0, 0), fx=analysis_scale, fy=analysis_scale)
+        images.append(cv2.cvtColor(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), cv2.COLOR_GRAY2RGB))
+    return images
+
+
+def compare(reference, found):
+    """Recall of the reference faces (IoU >= 0.5), mean IoU and mean landmark error (px) of the matched faces"""
+    total, matched, ious, errors = 0, 0, [], []
+    for (ref_boxes, ref_landmarks), (boxes, landmarks) in zip(reference, found):
+        rects = [utils.xywh2rect(*utils.fix_box(b)) for b in boxes]
+        for ref_box, ref_ld in zip(ref_boxes, ref_landmarks):
+            total += 1
+            if len(rects) == 0:
+                continue
+            overlaps = [iou(utils.xywh2rect(*utils.fix_box(ref_box)), r) for r in rects]
+            best = int(np.argmax(overlaps))
+            if overlaps[best] < 0.5:
+                continue
+            matched += 1
+            ious.append(overlaps[best])
+            errors.extend(np.linalg.norm(np.subtract(ref_ld[k], landmarks[best][k])) for k in ref_ld)
+    recall = matched / total if total else 1.
+    return recall, np.mean(ious) if ious else 0., np.mean(errors) if errors else 0.
+
+
+def main(video_path, scales, samples=50, batch_size=8, min_face_size=25, analysis_scale=None):
+    images = load_frames(video_path, samples, analysis_scale)
+    height, width, _ = images[0].shape
+    print('%d frames of %dx%d' % (len(images), width, height))
+
+    detector = FaceDetector(detect_multiple_faces=True, min_face_size=min_face_size, batch_size=batch_size)
+    detector.detect_batch(images[:batch_size])  # warm up
+
+    reference = None
+    reference_time = None
+    print('%-8s %10s %8s %7s %7s %9s %12s' % ('scale', 'ms/frame', 'speedup', 'faces', 'recall', 'mean IoU',
+                                              'landmark px'))
+    for scale in [1.] + [s for s in scales if s != 1]:
+        start = time.time()
+        found = detector.detect_batch(images, scale)
+        elapsed = (time.time() - start) / len(images)
+        if reference is None:
+            reference, reference_time = found, elapsed
+
+        recall, mean_iou, error = compare(reference, found)
+        print('%-8g %10.1f %7.2fx %7d %7.3f %9.3f %12.2f' % (scale, elapsed * 1000, reference_time / elapsed,
+                                                            sum(len(b) for b, _ in found), recall, mean_iou, error))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-v', '--video', type=str, required=True,
+                        help='Path of the video')
+    parser.add_argument('--scales', type=float, nargs='+', default=[0.5, 0.35, 0.25],
+                        help='Detection scales to compare with the full resolution')
+    parser.add_argument('--samples', type=int, default=50,
+                        help='Number of frames sampled from the video')
+    parser.add_argument('--batch_size', type=int, default=8,
+                        help='Frames given together to MTCNN')
+    parser.add_argument('--min_face_size', type=int, default=25,
+                        help='Min face size of the detector, as in the tracker')
+    parser.add_argument('--analysis_scale', type=float, default=None,
+                        help='Resolution of the analysis. By default, the one of the tracker')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args.video, args.scales, args.samples, args.batch_size, args.min_face_size, args.analysis_scale)
@@ -0,0 +1,165 @@
+"""
+Benchmark of the inference backends of FaceNet and MTCNN: Keras (float32) against the TFLite conversions with
+float16 and int8 (dynamic-range) weights.
+
+Throughput and agreement with Keras, on the frames of a video (MTCNN) and on the faces detected in them (FaceNet):
+
+    python -m benchmark.inference_backends --video video/sample.mp4
+
+Accuracy of the whole analysis on the evaluation datasets, each with the classifier of its project, for each
+`inference` setting of the projects (with int8, MTCNN runs with float16): a segment is correct when the person of
+the ground truth is among the recognised people.
+
+    python -m benchmark.inference_backends --dataset evaluation/dataset_memad.csv evaluation/dataset_antract.csv \
+        --project memad antract
+
+The projects keep `inference: keras` until this comparison shows no loss of accuracy with float16 or int8 on both
+datasets.
+"""
+import argparse
+import time
+
+import cv2
+import numpy as np
+import pandas as pd
+
+from src import clusterize, models
+from src.FaceDetector import FaceDetector
+from src.SORT.data_association import iou
+from src.tracker import Tracker
+from src.utils import utils
+
+PRECISIONS = ['keras', 'float16', 'int8']
+
+
+def read_frames(video_path, count, step=25):
+    video_capture = cv2.VideoCapture(video_path)
+    frames = []
+    while len(frames) < count:
+        for _ in range(step):
+            ret, frame = video_capture.read()
+        if not ret:
+            break
+        frames.append(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+    video_capture.release()
+    return frames
+
+
+def timed(function, *args):
+    start = time.time()
+    result = function(*args)
+    return time.time() - start, result
+
+
+def box_agreement(expected, found):
+    """Mean IoU of each expected box with its best match, and the difference in the number of boxes"""
+    expected = [utils.xywh2rect(*b) for b in expected]
+    found = [utils.xywh2rect(*b) for b in found]
+    ious = [max([iou(e, f) for f in found] or [0]) for e in expected]
+    return (np.mean(ious) if ious else 1.), len(found) - len(expected)
+
+
+def throughput(video_path, frames=64, batch_size=4):
+    frames = read_frames(video_path, frames)
+    print('%d frames of %dx%d' % (len(frames), frames[0].shape[1], frames[0].shape[0]))
+
+    reference = None
+    faces = None
+    print('%-8s %10s %8s %6s %12s %10s %10s' % ('backend', 'frames/s', 'box IoU', 'boxes', 'faces/s', 'min cos',
+                                                 'mean cos'))
+    for precision in PRECISIONS:
+        detector = FaceDetector(detect_multiple_faces=True, min_face_size=25, batch_size=batch_size,
+                                precision=precision)
+        detector.detect_batch(frames[:batch_size])  # warm-up
+        elapsed, detections = timed(detector.detect_batch, frames)
+        boxes = [b for b, _ in detections]
+
+        if reference is None:
+            faces = [cv2.resize(detector.aligner.align(frame, det), (160, 160))
+                     for frame, (bb, ld) in zip(frames, detections) for det in zip(bb, ld)]
+        facenet = models.facenet(precision=precision).model
+        utils.get_embeddings(facenet, faces[:1])  # warm-up
+        embed_time, embeddings = timed(utils.get_embeddings, facenet, faces)
+        embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+        if reference is None:
+            reference = boxes, embeddings
+        agreement = [box_agreement(e, f) for e, f in zip(reference[0], boxes)]
+        cosine = np.sum(embeddings * reference[1], axis=1)
+        print('%-8s %10.1f %8.3f %+6d %12.1f %10.4f %10.4f' % (
+            precision, len(frames) / elapsed, np.mean([a for a, _ in agreement]), sum(d for _, d in agreement),
+            len(faces) / embed_time, cosine.min(), cosine.mean()))
+
+
+def normalise_name(name):
+    # "Le Saint, Sophie" in the datasets, "Sophie_Le_Saint" in the classes
+    return ' '.join(sorted(name.replace(',', ' ').replace('_', ' ').lower().split()))
+
+
+def recognised(matches):
+    if len(matches) == 0:
+        return set()
+    clusters = clusterize.main(clusterize.from_dict(matches), dominant_ratio=0.6, weighted_dominant_ratio=0.4,
+                               confidence_threshold=0.6, merge_cluster=True, min_length=1)
+    return {normalise_name(c['name']) for c in clusters}
+
+
+def accuracy(dataset, project):
+    """The recognition accuracy of each backend on the segments of `dataset`"""
+    # needs the connectors of the video sources
+    import bulk_run
+
+    df = pd.read_csv(dataset)
+    truth = [normalise_name(p) for p in df['person']]
+    print('%s: %d segments, project %s' % (dataset, len(df), project))
+
+    reference = None
+    accuracies = {}
+    print('%-8s %10s %10s %12s' % ('backend', 'accuracy', 'time s', 'same as keras'))
+    for precision in PRECISIONS:
+        tracker = Tracker(project, inference=precision)
+        elapsed, results = timed(bulk_run.track_dataset, df, tracker, False)
+        names = [recognised(r) for r in results]
+        if reference is None:
+            reference = names
+        accuracies[precision] = np.mean([t in n for t, n in zip(truth, names)])
+        same = np.mean([n == r for n, r in zip(names, reference)])
+        print('%-8s %10.3f %10.1f %12.3f' % (precision, accuracies[precision], elapsed, same))
+    return accuracies
+
+
+def compare(datasets, projects):
+    """Accuracy of each backend on each dataset, and its difference with keras"""
+    if len(projects) == 1:
+        projects = projects * len(datasets)
+    assert len(projects) == len(datasets), 'one project for all the datasets, or one for each'
+
+    results = {dataset: accuracy(dataset, project) for dataset, project in zip(datasets, projects)}
+    print('%-40s %-8s %10s %10s' % ('dataset', 'backend', 'accuracy', 'vs keras'))
+    for dataset, accuracies in results.items():
+        for precision in PRECISIONS:
+            print('%-40s %-8s %10.3f %+10.3f' % (dataset, precision, accuracies[precision],
+                                                 accuracies[precision] - accuracies['keras']))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--video', type=str, default=None,
+                        help='Video for the throughput and the agreement of the backends')
+    parser.add_argument('--frames', type=int, default=64,
+                        help='Number of frames of the video, one every second')
+    parser.add_argument('--batch_size', type=int, default=4,
+                        help='Frames per MTCNN batch')
+    parser.add_argument('--dataset', type=str, nargs='+', default=None,
+                        help='Evaluation csv files, as evaluation/dataset_memad.csv, for the accuracy of the backends')
+    parser.add_argument('--project', type=str, nargs='+', default=['general'],
+                        help='Project of the classifier of each dataset, or one for all, with --dataset')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.video:
+        throughput(args.video, args.frames, args.batch_size)
+    if args.dataset:
+        compare(args.dataset, args.project)
@@ -0,0 +1,95 @@
+"""
+Benchmark of the motion model of SORT: the batched Kalman filters of `batched_kalman` against one filterpy
+`KalmanFilter` per track, on synthetic crowd videos where faces move, appear and disappear.
+
+Both run the same `Sort`, and must give the same tracks: same ids and frames, boxes within `--tolerance` pixels.
+The frames alternate between detections (`update`) and motion only (`coast`), as with `detect_every` 2.
+
+    python -m benchmark.kalman --sizes 1 10 50 100 500
+"""
+import argparse
+import tempfile
+import time
+
+import numpy as np
+
+from src.SORT.kalman_tracker import KalmanBoxTracker
+from src.SORT.sort import Sort
+
+
+def make_video(size, frames, width=1920, height=1080, seed=0):
+    """The detections [x1,y1,x2,y2,score] of each frame, for about `size` faces at a time"""
+    rng = np.random.RandomState(seed)
+    video = []
+    faces = np.zeros((0, 5))  # x, y, side, vx, vy
+    for _ in range(frames):
+        faces = faces[rng.rand(len(faces)) > 0.02]  # leaving
+        new = max(0, size - len(faces)) if not video else rng.binomial(size, 0.02)
+        faces = np.concatenate([faces, np.stack([rng.uniform(0, width - 80, new), rng.uniform(0, height - 80, new),
+                                                 rng.uniform(20, 80, new), rng.normal(scale=3, size=new),
+                                                 rng.normal(scale=3, size=new)], axis=1)])
+        faces[:, :2] += faces[:, 3:5]
+        faces[:, 2] *= rng.uniform(0.98, 1.02, len(faces))
+        seen = faces[rng.rand(len(faces)) > 0.05]  # missed by the detector
+        noise = rng.normal(scale=1, size=(len(seen), 2))
+        boxes = np.stack([seen[:, 0] + noise[:, 0], seen[:, 1] + noise[:, 1], seen[:, 0] + seen[:, 2],
+                          seen[:, 1] + seen[:, 2], rng.uniform(0.5, 0.99, len(seen))], axis=1)
+        video.append(boxes[rng.permutation(len(boxes))])
+    return video
+
+
+def track(video, batched, root_dic, detect_every=2, height=1080, width=1920):
+    """The output rows [x1,y1,x2,y2,id] of each frame, and the time per frame"""
+    KalmanBoxTracker.count = 0
+    sort = Sort(min_hits=0, batched=batched)
+    outputs = []
+    start = time.time()
+    for i, dets in enumerate(video):
+        if i % detect_every == 0 or sort.leaves_image((height, width)):
+            attributes = [(None, det[4]) for det in dets]
+            result = sort.update(dets, (height, width), root_dic, attributes)
+        else:
+            result = sort.coast()
+        outputs.append(result[:, :5])
+    return outputs, (time.time() - start) / len(video)
+
+
+def compare(expected, found):
+    """Whether the frames have the same tracks, and the maximum difference of their boxes"""
+    same = all(e.shape == f.shape and np.array_equal(e[:, 4], f[:, 4]) for e, f in zip(expected, found))
+    if not same:
+        return False, np.inf
+    diff = max([np.nanmax(np.abs(e[:, :4] - f[:, :4]), initial=0) for e, f in zip(expected, found)])
+    return True, diff
+
+
+def main(sizes, frames=100, detect_every=2, tolerance=1e-6):
+    print('%6s %14s %14s %9s %8s %12s' % ('faces', 'filterpy ms', 'batched ms', 'speed-up', 'same', 'max diff px'))
+    with tempfile.TemporaryDirectory() as root_dic:
+        for size in sizes:
+            video = make_video(size, frames)
+            expected, filterpy_time = track(video, False, root_dic, detect_every)
+            found, batched_time = track(video, True, root_dic, detect_every)
+            same, diff = compare(expected, found)
+            print('%6d %14.3f %14.3f %9.1f %8s %12.2e' % (size, filterpy_time * 1000, batched_time * 1000,
+                                                          filterpy_time / batched_time, same and diff <= tolerance,
+                                                          diff))
+            assert same and diff <= tolerance, 'the batched filters give different tracks with %d faces' % size
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 10, 50, 100, 200, 500],
+                        help='Number of faces per frame')
+    parser.add_argument('--frames', type=int, default=100,
+                        help='Frames per video')
+    parser.add_argument('--detect_every', type=int, default=2,
+                        help='Run the detection every N frames, and coast in between')
+    parser.add_argument('--tolerance', type=float, default=1e-6,
+                        help='Maximum difference of the boxes, in pixels')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args.sizes, args.frames, args.detect_every, args.tolerance)
@@ -0,0 +1,84 @@
+"""
+Benchmark of the outlier detection of the training images: the incremental `detect_outliers` against the previous
+implementation, which recomputed all the similarities after each removal, on synthetic clusters of 128-d embeddings
+with a share of unrelated images. Both must return the same outliers.
+
+    python -m benchmark.outlier_detection --sizes 50 200 500 --classes 40
+"""
+import argparse
+import time
+
+import numpy as np
+from sklearn.metrics.pairwise import cosine_similarity
+
+from src.classifier import detect_outliers, filter_outliers
+
+
+def reference_outliers(embs, files, threshold=0.1):
+    """The previous implementation"""
+    d = cosine_similarity(embs)
+    outliers = []
+    if len(embs) < 2:
+        return files
+    while d.std() > threshold:
+        m = embs.mean(axis=0)
+        diff = np.array([cosine_similarity([x], [m]) for x in embs]).flatten()
+        to_delete = np.argmin(diff)
+        outliers.append(files[to_delete])
+        embs = np.delete(embs, to_delete, 0)
+        files = np.delete(files, to_delete, 0)
+        d = cosine_similarity(embs)
+        if len(embs) < 2:
+            return files
+    return outliers
+
+
+def make_class(size, dim=128, noise=1.2, unrelated=0.2, seed=0):
+    rng = np.random.RandomState(seed)
+    center = rng.normal(size=dim) + 1
+    embs = center + noise * rng.normal(size=(size, dim))
+    others = rng.rand(size) < unrelated
+    embs[others] = rng.normal(size=(others.sum(), dim)) + 1
+    files = np.array(['%d/%d.jpg' % (seed, i) for i in range(size)])
+    return embs.astype('float32'), files
+
+
+def main(sizes, classes, n_jobs):
+    print('%6s %12s %12s %8s %9s %6s' % ('size', 'previous s', 'new s', 'speedup', 'outliers', 'same'))
+    for size in sizes:
+        embs, files = make_class(size, seed=size)
+        start = time.time()
+        expected = reference_outliers(embs, files)
+        slow = time.time() - start
+        start = time.time()
+        found = detect_outliers(embs, files)
+        fast = time.time() - start
+        print('%6d %12.3f %12.4f %7.0fx %9d %6s' % (size, slow, fast, slow / fast, len(found),
+                                                  list(found) == list(expected)))
+
+    # a project of many classes, in parallel
+    data = [make_class(sizes[-1], seed=i) for i in range(classes)]
+    x = np.concatenate([e for e, _ in data])
+    paths = np.concatenate([f for _, f in data])
+    y = np.repeat(np.arange(classes), sizes[-1])
+    for jobs in (1, n_jobs):
+        start = time.time()
+        outliers = filter_outliers(x, y, paths, n_jobs=jobs)[3]
+        print('%d classes of %d images, n_jobs=%d: %.2fs, %d outliers' % (classes, sizes[-1], jobs,
+                                                                         time.time() - start, len(outliers)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[50, 200, 500],
+                        help='Numbers of images of a class')
+    parser.add_argument('--classes', type=int, default=40,
+                        help='Number of classes of the project filtered in parallel')
+    parser.add_argument('--n_jobs', type=int, default=-1,
+                        help='Processes filtering the classes of the project')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args.sizes, args.classes, args.n_jobs)
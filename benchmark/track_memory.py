@@ -0,0 +1,87 @@
+"""
+Benchmark of the memory held by the tracks: peak of the Python and NumPy allocations while tracking faces that stay
+on screen for the whole video, with the attributes of the faces in a `FaceAttributeStore` (bounded) and in a list
+of all of them, as before the store.
+
+    python -m benchmark.track_memory --samples 100 500 2000 --faces 3
+"""
+import argparse
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from src.SORT.kalman_tracker import KalmanBoxTracker
+from src.SORT.sort import Sort
+
+WIDTH, HEIGHT = 1280, 720
+
+
+class AttributeList(list):
+    """The previous storage: every attribute of the track"""
+    max_crops = None
+
+    def append(self, attribute, sample=None):
+        super().append(attribute)
+
+    @property
+    def last(self):
+        return self[-1]
+
+    def crops(self):
+        return [(i, a[1], 0., a[0]) for i, a in enumerate(self)]
+
+
+class ListSort(Sort):
+    def new_tracker(self, det, img=None):
+        trk = super().new_tracker(det, img)
+        trk.face_additional_attribute = AttributeList()
+        return trk
+
+
+def track(samples, faces, bounded, root_dic, seed=0):
+    """Peak of the allocations in MB, and the time per sample"""
+    rng = np.random.RandomState(seed)
+    frame = rng.randint(0, 256, (HEIGHT, WIDTH, 3), dtype=np.uint8)
+    side = rng.randint(80, 160, faces)
+    x = rng.randint(0, WIDTH - 200, faces)
+    y = rng.randint(0, HEIGHT - 200, faces)
+
+    KalmanBoxTracker.count = 0
+    sort = Sort(min_hits=0, save_crops=False) if bounded else ListSort(min_hits=0, save_crops=False)
+    tracemalloc.start()
+    start = time.time()
+    for _ in range(samples):
+        dets = np.stack([x, y, x + side, y + side, np.full(faces, 0.99)], axis=1).astype(float)
+        attributes = [[frame[b:b + s, a:a + s, :].copy(), 0.99, rng.rand(), 0., 0., {}]
+                      for a, b, s in zip(x, y, side)]
+        sort.update(dets, (HEIGHT, WIDTH), root_dic, attributes)
+    elapsed = time.time() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak / 2 ** 20, elapsed / samples
+
+
+def main(sample_counts, faces):
+    print('%8s %14s %12s %14s %12s' % ('samples', 'list peak MB', 'list ms', 'store peak MB', 'store ms'))
+    with tempfile.TemporaryDirectory() as root_dic:
+        for samples in sample_counts:
+            list_peak, list_time = track(samples, faces, False, root_dic)
+            store_peak, store_time = track(samples, faces, True, root_dic)
+            print('%8d %14.1f %12.3f %14.1f %12.3f' % (samples, list_peak, 1000 * list_time, store_peak,
+                                                       1000 * store_time))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--samples', type=int, nargs='+', default=[100, 500, 2000],
+                        help='Duration of the tracks, in samples')
+    parser.add_argument('--faces', type=int, default=3,
+                        help='Faces on screen')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args.samples, args.faces)
@@ -10,32 +10,39 @@ from src.tracker import Tracker
 from src.utils import uri_utils
 
 
+def track_dataset(df, tr, export_frames=True):
+    """Run the tracker on each segment of the dataset. Return the matches of each segment."""
+    all_results = []
+    v = None
+    old = None
+    for i, x in tqdm(df.iterrows(), total=len(df)):
+        start = int(x['start']) if 'start' in x else None
+        end = int(x['end']) if 'end' in x else None
+        fragment = f'{start},{end+1}' if start is not None else None
+        media = x['media']
+        if media != old:
+            v, metadata = uri_utils.uri2video(media)
+
+        res = tr.run(v, export_frames=export_frames, fragment=fragment, video_id=x['media'], verbose=False)
+        all_results.append(res)
+    return all_results
+
+
 # 'evaluation/dataset_memad.csv'
 # 'memad-gt'
-def main(input, project, skip_tracking=False):
+def main(input, project, skip_tracking=False, inference=None):
+    results = f'results_{project}_{inference}' if inference else f'results_{project}'
     if not skip_tracking:
         # TODO check if input is a csv or a folder
         df = pd.read_csv(input)
-        tr = Tracker(project=project)
-
-        all_results = []
-        v = None
-        old = None
-        for i, x in tqdm(df.iterrows(), total=len(df)):
-            start = int(x['start']) if 'start' in x else None
-            end = int(x['end']) if 'end' in x else None
-            fragment = f'{start},{end+1}' if start is not None else None
-            media = x['media']
-            if media != old:
-                v, metadata = uri_utils.uri2video(media)
-
-            res = tr.run(v, export_frames=True, fragment=fragment, video_id=x['media'], verbose=False)
-            all_results.append(res)
-        with open(f'results_{project}.json', 'w') as f:
+        tr = Tracker(project=project, inference=inference)
+
+        all_results = track_dataset(df, tr)
+        with open(f'{results}.json', 'w') as f:
             json.dump(all_results, f)
 
     else:
-        with open(f'results_{project}.json', 'r') as f:
+        with open(f'{results}.json', 'r') as f:
             all_results = json.load(f)
 
     clusters = []
@@ -44,7 +51,7 @@ def main(input, project, skip_tracking=False):
                             confidence_threshold=0.6, merge_cluster=True, min_length=1)
         clusters.append(c)
 
-    with open(f'results_{project}_clusters.json', 'w') as f:
+    with open(f'{results}_clusters.json', 'w') as f:
         json.dump(clusters, f)
 
 
@@ -56,12 +63,14 @@ def parse_arguments(argv):
                         help='Name of the collection to be part of')
     parser.add_argument('--skip_tracking', action='store_true', default=False,
                         help='Only recompute clustering')
+    parser.add_argument('--inference', type=str, default=None, choices=['keras', 'float16', 'int8'],
+                        help='Precision of FaceNet and MTCNN. By default, the one of the project settings')
 
     return parser.parse_args(argv)
 
 
 if __name__ == '__main__':
     args = parse_arguments(sys.argv[1:])
-    main(args.input, args.project, args.skip_tracking)
+    main(args.input, args.project, args.skip_tracking, args.inference)
 
 # python bulk_run.py -i evaluation/dataset_antract.csv --project antract
@@ -9,13 +9,15 @@ from flask_restx import Api, Resource
 from werkzeug.middleware.proxy_fix import ProxyFix
 
 from src import *
+from src import outlier_report, models
 from src.connectors import antract_connector as antract
-from src.utils import utils, uri_utils
+from src.utils import utils, uri_utils, checkpoint, config
 
 TRAINING_IMG = 'data/training_img_aligned/'
 
 IMG_DIR = os.path.join(os.getcwd(), TRAINING_IMG)
 VIDEO_DIR = os.path.join(os.getcwd(), 'video')
+CHECKPOINT_EVERY = 100  # samples
 
 os.makedirs('database', exist_ok=True)
 
@@ -33,6 +35,10 @@ CORS(flask_app)
 PROJECTS = [p for p in os.listdir(TRAINING_IMG) if os.path.isdir(os.path.join(TRAINING_IMG, p))]
 project_param = {'description': 'The project context of the call', 'enum': PROJECTS, 'required': True}
 
+if (config.load().get('models') or {}).get('warm_up'):
+    # the requests arriving meanwhile wait for the models they need
+    Thread(target=models.warm_up, args=(PROJECTS,), daemon=True).start()
+
 
 def now():
     return datetime.datetime.now().isoformat()
@@ -91,6 +97,9 @@ class Crawler(Resource):
 
         for keyword in q.split(';'):
             crawler.main(keyword, max_num=100, project=project)
+        if not os.path.isfile(os.path.join(TRAINING_IMG, project, 'disabled.txt')):
+            # prepare the outlier report of the new images
+            outlier_report.refresh(project)
 
         return jsonify({
             'task': 'crawl',
@@ -101,14 +110,20 @@ class Crawler(Resource):
 
 
 @api.route('/train/<string:project>')
-@api.doc(description="Trigger the training of the model")
+@api.doc(description="Trigger the training of the model",
+         params={'full': {'type': bool, 'default': False,
+                          'description': 'Set it for retraining all the classes, not only the changed ones'}})
 class Training(Resource):
     def get(self, project):
         start_time = time.time()
 
-        classifier.main(classifier='SVM', project=project, discard_disabled="true")
+        full = 'full' in request.args.to_dict() and request.args.get('full') != 'false'
+        settings = config.project_settings(project)
+        version = classifier.main(classifier=settings.get('classifier') or 'SVM', project=project,
+                                  discard_disabled="true", incremental=not full, nprobe=settings.get('nprobe') or 8)
         return jsonify({
             'task': 'train',
+            'version': version,
             'time': now(),
             'execution_time': (time.time() - start_time),
             'status': 'ok'
@@ -154,7 +169,12 @@ class Track(Resource):
             database.save_metadata(video)
 
         if need_run:
-            database.clean_analysis(video_id, project)
+            output_path = utils.generate_output_path('./data/out', project, video_id)
+            if no_cache:
+                checkpoint.remove(output_path)
+            # with a checkpoint, the tracker resumes the job and keeps the tracks found until then
+            if not checkpoint.exists(output_path):
+                database.clean_analysis(video_id, project)
             database.save_status(video_id, project, 'RUNNING')
             video['status'] = 'RUNNING'
             Thread(target=run_tracker, args=(locator, speedup, video_id, project)).start()
@@ -178,7 +198,8 @@ class Track(Resource):
 
 def run_tracker(video_path, speedup, video, project):
     try:
-        return tracker.main(video_path, project=project, video_speedup=speedup, export_frames=True, video_id=video)
+        return tracker.main(video_path, project=project, video_speedup=speedup, export_frames=True, video_id=video,
+                            checkpoint_every=CHECKPOINT_EVERY, resume=True)
     except RuntimeError:
         database.save_status(video, project, 'ERROR')
 
@@ -217,8 +238,14 @@ class Disabled(Resource):
         DISABLED_FILE = os.path.join(TRAINING_IMG, project, 'disabled.txt')
 
         if not os.path.isfile(DISABLED_FILE):
-            # automatic disable
-            return jsonify(classifier.get_outlier_list(project))
+            # automatic disable, from the cached report (refreshed in background when the dataset changed)
+            outliers, _ = outlier_report.get(project)
+            if outliers is None:
+                # the first report is being computed
+                response = jsonify([])
+                response.status_code = 202
+                return response
+            return jsonify(outliers)
 
         with open(DISABLED_FILE) as f:
             dis = f.read().split('\n')
@@ -237,6 +264,13 @@ class Disabled(Resource):
         return 'ok'
 
 
+@api.route('/models')
+@api.doc(description="The models loaded by the server, with their load time and memory")
+class Models(Resource):
+    def get(self):
+        return jsonify(models.report())
+
+
 @api.errorhandler(ValueError)
 def handle_invalid_usage(error):
     response = jsonify({
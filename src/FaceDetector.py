@@ -4,28 +4,59 @@ import sys
 
 import cv2
 import numpy as np
-from mtcnn import MTCNN
 
+from . import models
 from .FaceAligner import FaceAligner
 from .utils import utils
+from .utils.mtcnn_batch import detect_faces_batch
 
 
 class FaceDetector:
-    def __init__(self, image_size=160, margin=10, detect_multiple_faces=False, min_face_size=20):
+    def __init__(self, image_size=160, margin=10, detect_multiple_faces=False, min_face_size=20, batch_size=8,
+                 precision=None):
         self.aligner = FaceAligner(desiredFaceWidth=image_size, margin=margin)
-        self.detector = MTCNN(min_face_size=min_face_size)
+        self.detector = models.mtcnn(min_face_size, precision).model
         self.detect_multiple_faces = detect_multiple_faces
+        self.batch_size = batch_size
 
     def extract(self, img):
         """ Extract the portions of a single img or frame including faces """
         bounding_box, landmarks = self.detect(img)
         return [self.aligner.align(img, det) for det in zip(bounding_box, landmarks)]
 
+    def extract_batch(self, imgs):
+        """ Extract the portions of each img including faces """
+        return [[self.aligner.align(img, det) for det in zip(bounding_box, landmarks)]
+                for img, (bounding_box, landmarks) in zip(imgs, self.detect_batch(imgs))]
+
     def detect(self, img):
-        bounding_boxes = self.detector.detect_faces(img)
+        return self.select(img, self.detector.detect_faces(img))
+
+    def detect_batch(self, imgs, scale=1., scores=False):
+        """
+        Detect the faces in a list of images, running the MTCNN networks on `batch_size` images at once.
+        Images are grouped by size, as required by the image pyramid.
+        With `scale` < 1, the faces are searched on the images resized by `scale` and refined at full resolution.
+        Return a `(boxes, landmarks)` tuple for each image, as `detect`, or `(boxes, landmarks, confidences)` with
+        `scores`.
+        """
+        groups = {}
+        for i, img in enumerate(imgs):
+            groups.setdefault(img.shape, []).append(i)
+
+        results = [None] * len(imgs)
+        for indexes in groups.values():
+            for start in range(0, len(indexes), self.batch_size):
+                chunk = indexes[start:start + self.batch_size]
+                faces = detect_faces_batch(self.detector, [imgs[i] for i in chunk], scale)
+                for i, bounding_boxes in zip(chunk, faces):
+                    results[i] = self.select(imgs[i], bounding_boxes, scores)
+        return results
+
+    def select(self, img, bounding_boxes, scores=False):
         nrof_faces = len(bounding_boxes)
         if nrof_faces <= 0:
-            return [], []
+            return ([], [], []) if scores else ([], [])
 
         det = np.array([utils.fix_box(b['box']) for b in bounding_boxes])
         img_size = np.asarray(img.shape)[0:2]
@@ -40,11 +71,13 @@ class FaceDetector:
             # some extra weight on the centering
             index = np.argmax(bounding_box_size - offset_dist_squared * 2.0)
             det_arr = [det[index, :]]
-            landmarks = [bounding_boxes[index]['keypoints']]
+            bounding_boxes = [bounding_boxes[index]]
         else:
             det_arr = [np.squeeze(d) for d in det]
-            landmarks = [b['keypoints'] for b in bounding_boxes]
+        landmarks = [b['keypoints'] for b in bounding_boxes]
 
+        if scores:
+            return det_arr, landmarks, [b['confidence'] for b in bounding_boxes]
         return det_arr, landmarks
 
 
@@ -61,13 +94,12 @@ def main(project='general', image_size=160, margin=10, detect_multiple_faces=Fal
 
     nrof_successfully_aligned = 0
 
-    for img, label, path in zip(data, labels, paths):
+    for img, label, path, extracted_faces in zip(data, labels, paths, detector.extract_batch(data)):
         output_class_dir = os.path.join(output_dir, label.replace(' ', '_'))
         os.makedirs(output_class_dir, exist_ok=True)
 
         filename = os.path.splitext(os.path.split(path)[1])[0]
 
-        extracted_faces = detector.extract(img)
         if len(extracted_faces) == 0:
             print('Unable to detect faces in %s' % path)
             continue
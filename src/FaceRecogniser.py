@@ -1,14 +1,12 @@
 import argparse
 import os
-import pickle
 
 import cv2
 import numpy as np
-from mtcnn import MTCNN
-from tensorflow.keras.models import load_model
 import scipy.cluster as cluster
 
-from .utils import utils
+from . import models
+from .utils import utils, frame_source
 
 
 def select_best(predictions, class_names):
@@ -21,92 +19,166 @@ def select_best(predictions, class_names):
 class Classifier:
     def __init__(self,
                  classifier_path='data/classifier/classifier.pkl',
-                 facenet_model='./model/facenet_keras.h5',
-                 facenet_weights='./model/facenet_keras_weights.h5'):
+                 facenet_model=models.FACENET_MODEL,
+                 facenet_weights=models.FACENET_WEIGHTS,
+                 precision=None,
+                 project=None):
+        """The classifier is the current version of the one of `project`, if given, otherwise the `classifier_path`"""
         self.image_size = 160
 
-        self.facenet = load_model(facenet_model, compile=False)
-        self.facenet.load_weights(facenet_weights)
+        # shared with the other instances of the process. With a `precision`, a TFLite conversion
+        self.facenet = models.facenet(facenet_model, facenet_weights, precision).model
         self.features = []
         self.meta = []
         self.collect_features = False
 
-        # Load classifier
-        classifier_filename = os.path.expanduser(classifier_path)
-        with open(classifier_filename, 'rb') as f:
-            (classifier, class_names) = pickle.load(f)
-            print("Loaded classifier file: %s" % classifier_filename)
-            self.classifier = classifier
-            self.class_names = class_names
-
-    def predict(self, img, meta=None):
-        scaledx = cv2.resize(img, (self.image_size, self.image_size), interpolation=cv2.INTER_CUBIC)
-        scaled = scaledx.reshape(-1, self.image_size, self.image_size, 3)
-        # convert to array and predict among the known ones
-        emb_arrayx = [utils.get_embedding(self.facenet, face_pixels) for face_pixels in scaled]
-        emb_array = np.asarray(emb_arrayx)
-        if self.collect_features:
+        # Load classifier, once per version of the file
+        self.project = project
+        self.version = None
+        if project is None:
+            self.classifier, self.class_names = models.classifier(classifier_path).model
+        else:
+            self.reload()
+
+    def reload(self, version=None):
+        """Switch to a version of the classifier of the project, by default the current one. Return the version."""
+        if self.project is None:
+            return None
+        handle = models.project_classifier(self.project, version)
+        if handle.version != self.version:
+            self.classifier, self.class_names = handle.model
+            self.version = handle.version
+        return self.version
+
+    def embed(self, imgs):
+        scaled = np.asarray([cv2.resize(img, (self.image_size, self.image_size), interpolation=cv2.INTER_CUBIC)
+                             for img in imgs])
+        return utils.get_embeddings(self.facenet, scaled)
+
+    def embed_batches(self, imgs, batch_size=None):
+        """Embed a list of faces, with one forward pass every `batch_size` faces"""
+        if batch_size is None:
+            batch_size = max(len(imgs), 1)
+        if len(imgs) == 0:
+            return np.empty((0, self.facenet.output_shape[-1]))
+        return np.concatenate([self.embed(imgs[i:i + batch_size]) for i in range(0, len(imgs), batch_size)])
+
+    def collect(self, emb_array, metas):
+        if not self.collect_features:
+            return
+        for emb, meta in zip(emb_array, metas):
             _, _, rect, _ = meta
             dim = (rect[3] - rect[1]) * (rect[2] - rect[0])
             if dim >= 2000:
-                self.features.append(emb_array[0])
+                self.features.append(emb)
                 self.meta.append(meta)
-        return self.classifier.predict_proba(emb_array).flatten()
+
+    def classify(self, imgs, batch_size=None):
+        """
+        Embed a list of faces and compute their class probabilities, with one forward pass every `batch_size` faces.
+        Return the embeddings and the probabilities, without collecting the features.
+        """
+        if batch_size is None:
+            batch_size = max(len(imgs), 1)
+
+        embeddings = []
+        predictions = []
+        for i in range(0, len(imgs), batch_size):
+            # convert to array and predict among the known ones
+            emb_array = self.embed(imgs[i:i + batch_size])
+            embeddings.append(emb_array)
+            predictions.append(self.classifier.predict_proba(emb_array))
+
+        if len(predictions) == 0:
+            return np.empty((0, self.facenet.output_shape[-1])), np.empty((0, len(self.class_names)))
+        return np.concatenate(embeddings), np.concatenate(predictions)
+
+    def classify_embeddings(self, embeddings):
+        """`classify` for faces already embedded"""
+        if len(embeddings) == 0:
+            return np.empty((0, self.facenet.output_shape[-1])), np.empty((0, len(self.class_names)))
+        embeddings = np.asarray(embeddings)
+        return embeddings, self.classifier.predict_proba(embeddings)
+
+    def predict_proba(self, imgs, metas=None, batch_size=None):
+        """Class probabilities for a list of faces"""
+        if metas is None:
+            metas = [None] * len(imgs)
+        emb_array, predictions = self.classify(imgs, batch_size)
+        self.collect(emb_array, metas)
+        return predictions
+
+    def predict(self, img, meta=None):
+        return self.predict_proba([img], [meta])[0]
 
     def predict_best(self, img, meta=None):
         predictions = self.predict(img, meta)
         return select_best(predictions, self.class_names)
 
+    def predict_batch(self, imgs, metas=None, batch_size=None):
+        """Return the best `(name, prob)` for each face in `imgs`"""
+        predictions = self.predict_proba(imgs, metas, batch_size)
+        return self.select_best(predictions)
+
+    def select_best(self, predictions):
+        return [select_best(p, self.class_names) for p in predictions]
+
     def cluster_features(self, clustering_distance=14, distance_threshold=1.3, side_face_threshold=0.6, min_samples=7,
                          max_samples=5, min_involved_tracks=3):
-        # print('NOW CLUSTERING', len(self.features),
-        #       'feature vectors of dimensionality', len(self.features[0]),
-        #       'to', nclusters, 'clusters and showing max', maxsamples,
-        #       'samples of clusters that contain min', minsamples, 'vectors')
-        features = np.array(self.features)
-        link = cluster.hierarchy.linkage(features, method='complete')
-        fc = cluster.hierarchy.fcluster(link, clustering_distance, criterion='distance')
-        clusters = []
-        for i in np.unique(fc):
-            cur_indexes = [j for j, k in enumerate(fc) if k == i]
-            x = np.array(features)[cur_indexes]
-            y = np.array(self.meta)[cur_indexes]
-
-            m = np.mean(x, axis=0)
-            avg = np.linalg.norm(x - m, axis=1)
-            e = sorted(zip(y, avg), key=lambda a: a[1])
-
-            if len(e) < min_samples:
-                continue
-
-            avg = np.mean(avg)
-            distance_score = avg / len(e)
-
-            if distance_score > distance_threshold:
-                continue
-
-            elements = [x[0] for x in e]
-            involved_tracks = np.unique([track for frame_no, track, bb, ld in elements])
-            if len(involved_tracks) < min_involved_tracks:
-                continue
-            # TODO
-            # if any([x in official_cluster_mapping for x in involved_tracks]):
-            #     continue
-
-            lds = [ld for frame_no, track, bb, ld in elements[0:5]]
-            side_face_score = np.sum([(1 / (i + 1) * ld) for i, ld in enumerate(lds)]) / len(lds)
-            if side_face_score > side_face_threshold:
-                continue
-
-            clusters.append({
-                'id': len(clusters),
-                'elements': [{
-                    'frame': int(frame_no),
-                    'track': int(track),
-                    'rect': [int(b) for b in bb]
-                } for frame_no, track, bb, ld in elements[0:max_samples]]
-            })
-        return clusters
+        return cluster_features(self.features, self.meta, clustering_distance, distance_threshold, side_face_threshold,
+                                min_samples, max_samples, min_involved_tracks)
+
+
+def cluster_features(features, meta, clustering_distance=14, distance_threshold=1.3, side_face_threshold=0.6,
+                     min_samples=7, max_samples=5, min_involved_tracks=3):
+    # print('NOW CLUSTERING', len(features),
+    #       'feature vectors of dimensionality', len(features[0]),
+    #       'to', nclusters, 'clusters and showing max', maxsamples,
+    #       'samples of clusters that contain min', minsamples, 'vectors')
+    features = np.array(features)
+    link = cluster.hierarchy.linkage(features, method='complete')
+    fc = cluster.hierarchy.fcluster(link, clustering_distance, criterion='distance')
+    clusters = []
+    for i in np.unique(fc):
+        cur_indexes = [j for j, k in enumerate(fc) if k == i]
+        x = np.array(features)[cur_indexes]
+        y = np.array(meta)[cur_indexes]
+
+        m = np.mean(x, axis=0)
+        avg = np.linalg.norm(x - m, axis=1)
+        e = sorted(zip(y, avg), key=lambda a: a[1])
+
+        if len(e) < min_samples:
+            continue
+
+        avg = np.mean(avg)
+        distance_score = avg / len(e)
+
+        if distance_score > distance_threshold:
+            continue
+
+        elements = [x[0] for x in e]
+        involved_tracks = np.unique([track for frame_no, track, bb, ld in elements])
+        if len(involved_tracks) < min_involved_tracks:
+            continue
+        # TODO
+        # if any([x in official_cluster_mapping for x in involved_tracks]):
+        #     continue
+
+        lds = [ld for frame_no, track, bb, ld in elements[0:5]]
+        side_face_score = np.sum([(1 / (i + 1) * ld) for i, ld in enumerate(lds)]) / len(lds)
+        if side_face_score > side_face_threshold:
+            continue
+
+        clusters.append({
+            'id': len(clusters),
+            'elements': [{
+                'frame': int(frame_no),
+                'track': int(track),
+                'rect': [int(b) for b in bb]
+            } for frame_no, track, bb, ld in elements[0:max_samples]]
+        })
+    return clusters
 
 
 def main(video_path, output_path='data/cluster.txt',
@@ -117,7 +189,7 @@ def main(video_path, output_path='data/cluster.txt',
     if folder_containing_frame is None:
         folder_containing_frame = utils.generate_output_path('./data/frames', '', video_path=video_path)
 
-    detector = MTCNN()
+    detector = models.mtcnn().model
 
     # Load classifier
     classifier = Classifier(classifier_path)
@@ -128,13 +200,14 @@ def main(video_path, output_path='data/cluster.txt',
 
     matches = []
 
+    source = frame_source.open_frame_source(video_capture, frame_source.sample_frames(0, video_length, video_speedup))
+
     # iterate over the frames
-    for frame_no in np.arange(0, video_length, video_speedup):
+    for sample in source:
+        if sample.image is None:
+            break
+        frame_no, frame = sample.frame_no, sample.image
         print('frame %d/%d' % (frame_no, video_length))
-        video_capture.set(cv2.CAP_PROP_POS_FRAMES, frame_no)
-
-        # read the frame
-        ret, frame = video_capture.retrieve()
 
         bounding_boxes = detector.detect_faces(frame)
         if len(bounding_boxes) == 0:
@@ -0,0 +1,201 @@
+"""
+The motion model of `KalmanBoxTracker`, for all the tracks at once.
+
+The states and covariances of the tracks are stacked in the arrays of a `BatchedKalmanFilter`, one slot per track,
+so that `Sort` predicts and updates every track in one vectorised call instead of one filterpy `KalmanFilter` each.
+The slots of the removed tracks are reused, and the arrays double in size when they are full.
+The computations are the ones of filterpy, including the Joseph form of the covariance update.
+"""
+
+import numpy as np
+
+from .face_attributes import FaceAttributeStore
+from .kalman_tracker import KalmanBoxTracker
+
+'''Motion Model'''
+
+F = np.array([[1, 0, 0, 0, 1, 0, 0], [0, 1, 0, 0, 0, 1, 0], [0, 0, 1, 0, 0, 0, 1], [0, 0, 0, 1, 0, 0, 0],
+              [0, 0, 0, 0, 1, 0, 0], [0, 0, 0, 0, 0, 1, 0], [0, 0, 0, 0, 0, 0, 1]], dtype=float)
+H = np.array([[1, 0, 0, 0, 0, 0, 0], [0, 1, 0, 0, 0, 0, 0], [0, 0, 1, 0, 0, 0, 0], [0, 0, 0, 1, 0, 0, 0]],
+             dtype=float)
+R = np.eye(4)
+R[2:, 2:] *= 10.
+P0 = np.eye(7)
+P0[4:, 4:] *= 1000.  # give high uncertainty to the unobservable initial velocities
+P0 *= 10.
+Q = np.eye(7)
+Q[-1, -1] *= 0.01
+Q[4:, 4:] *= 0.01
+I = np.eye(7)
+
+
+class BatchedKalmanFilter:
+    """
+    Constant velocity Kalman filters of boxes, with the states `x` (capacity, 7) and the covariances `P`
+    (capacity, 7, 7) of all the tracks. A track is a slot of the arrays.
+    """
+
+    def __init__(self, capacity=64):
+        self.x = np.zeros((capacity, 7))
+        self.P = np.zeros((capacity, 7, 7))
+        self._free = list(range(capacity - 1, -1, -1))
+
+    @property
+    def capacity(self):
+        return len(self.x)
+
+    def __len__(self):
+        return self.capacity - len(self._free)
+
+    def add(self, bbox):
+        """Start the filter of a box [x1,y1,x2,y2]. Return its slot."""
+        if not self._free:
+            capacity = self.capacity
+            self.x = np.concatenate([self.x, np.zeros_like(self.x)])
+            self.P = np.concatenate([self.P, np.zeros_like(self.P)])
+            self._free = list(range(2 * capacity - 1, capacity - 1, -1))
+        slot = self._free.pop()
+        self.x[slot] = 0.
+        self.x[slot, :4] = convert_bboxes_to_z(np.asarray(bbox, dtype=float)[None, :4])[0]
+        self.P[slot] = P0
+        return slot
+
+    def remove(self, slot):
+        self._free.append(slot)
+
+    def predict(self, slots):
+        """Advance the states of the slots. Return their predicted boxes."""
+        slots = np.asarray(slots, dtype=int)
+        x = self.x[slots]
+        # the scale cannot become negative
+        x[x[:, 6] + x[:, 2] <= 0, 6] *= 0.0
+        self.x[slots] = np.matmul(F, x[..., None])[..., 0]
+        self.P[slots] = np.matmul(np.matmul(F, self.P[slots]), F.T) + Q
+        return self.boxes(slots)
+
+    def update(self, slots, bboxes):
+        """Correct the states of the slots with the observed boxes [x1,y1,x2,y2]"""
+        slots = np.asarray(slots, dtype=int)
+        if len(slots) == 0:
+            return
+        z = convert_bboxes_to_z(np.asarray(bboxes, dtype=float)[:, :4])[..., None]
+        x = self.x[slots][..., None]
+        P = self.P[slots]
+
+        y = z - np.matmul(H, x)
+        PHT = np.matmul(P, H.T)
+        S = np.matmul(H, PHT) + R
+        K = np.matmul(PHT, np.linalg.inv(S))
+        self.x[slots] = (x + np.matmul(K, y))[..., 0]
+
+        I_KH = I - np.matmul(K, H)
+        self.P[slots] = (np.matmul(np.matmul(I_KH, P), I_KH.transpose(0, 2, 1))
+                         + np.matmul(np.matmul(K, R), K.transpose(0, 2, 1)))
+
+    def peek(self, slots):
+        """The boxes of the slots at the next step, without advancing the states"""
+        x = self.x[np.asarray(slots, dtype=int)]
+        x[x[:, 6] + x[:, 2] <= 0, 6] *= 0.0
+        return convert_x_to_bboxes(np.matmul(F, x[..., None])[..., 0])
+
+    def boxes(self, slots):
+        """The current boxes of the slots"""
+        return convert_x_to_bboxes(self.x[np.asarray(slots, dtype=int)])
+
+
+class BatchedKalmanBoxTracker(object):
+    """
+    A tracked object whose motion model is a slot of a `BatchedKalmanFilter`. Same interface as `KalmanBoxTracker`,
+    whose ids it shares. `Sort` advances all the trackers of a filter at once with `predict_all` and `update_all`.
+    """
+
+    def __init__(self, bbox, kalman):
+        self.kalman = kalman
+        self.slot = kalman.add(bbox)
+        self.time_since_update = 0
+        self.id = KalmanBoxTracker.count
+        KalmanBoxTracker.count += 1
+        self.history = []
+        self.hits = 0
+        self.hit_streak = 0
+        self.age = 0
+
+        # addtional fields
+        self.face_additional_attribute = FaceAttributeStore()
+
+    def update(self, bbox, img=None):
+        update_all([self], [bbox])
+
+    def predict(self, img=None):
+        return predict_all([self])[0]
+
+    def peek(self):
+        return self.kalman.peek([self.slot])[0]
+
+    def coast(self):
+        return coast_all([self])[0]
+
+    def get_state(self):
+        return self.kalman.boxes([self.slot])[0]
+
+    def remove(self):
+        """Free the slot of the tracker, which must not be used after"""
+        self.kalman.remove(self.slot)
+        self.slot = None
+
+
+def predict_all(trackers):
+    """`KalmanBoxTracker.predict` of all the `trackers`, which share a filter. Return their predicted boxes."""
+    if len(trackers) == 0:
+        return np.empty((0, 4))
+    boxes = trackers[0].kalman.predict([trk.slot for trk in trackers])
+    for trk, box in zip(trackers, boxes):
+        trk.age += 1
+        if trk.time_since_update > 0:
+            trk.hit_streak = 0
+        trk.time_since_update += 1
+        trk.history.append(box[None, :])
+    return boxes
+
+
+def update_all(trackers, bboxes):
+    """`KalmanBoxTracker.update` of all the `trackers` with their observed boxes"""
+    observed = []
+    for trk, bbox in zip(trackers, bboxes):
+        trk.time_since_update = 0
+        trk.history = []
+        trk.hits += 1
+        trk.hit_streak += 1
+        if len(bbox) > 0:
+            observed.append((trk.slot, bbox[:4]))
+    if observed:
+        slots, bboxes = zip(*observed)
+        trackers[0].kalman.update(slots, np.array(bboxes, dtype=float))
+
+
+def coast_all(trackers):
+    """`KalmanBoxTracker.coast` of all the `trackers`. Return their boxes."""
+    if len(trackers) == 0:
+        return np.empty((0, 4))
+    boxes = trackers[0].kalman.predict([trk.slot for trk in trackers])
+    for trk in trackers:
+        trk.age += 1
+    return boxes
+
+
+def convert_bboxes_to_z(bboxes):
+    """`convert_bbox_to_z` of the rows of `bboxes`, as rows [x,y,s,r]"""
+    w = bboxes[:, 2] - bboxes[:, 0]
+    h = bboxes[:, 3] - bboxes[:, 1]
+    x = bboxes[:, 0] + w / 2.
+    y = bboxes[:, 1] + h / 2.
+    s = w * h  # scale is just area
+    r = w / h
+    return np.stack([x, y, s, r], axis=1)
+
+
+def convert_x_to_bboxes(x):
+    """`convert_x_to_bbox` of the rows of `x`, as rows [x1,y1,x2,y2]"""
+    w = np.sqrt(x[:, 2] * x[:, 3])
+    h = x[:, 2] / w
+    return np.stack([x[:, 0] - w / 2., x[:, 1] - h / 2., x[:, 0] + w / 2., x[:, 1] + h / 2.], axis=1)
@@ -30,47 +30,69 @@ def iou(bb_test, bb_gt):
     return o
 
 
-def associate_detections_to_trackers(detections, trackers, iou_threshold=0.25):
+def iou_matrix(bb_test, bb_gt):
+    """
+    Computes the IOU of each bbox of `bb_test` with each bbox of `bb_gt`, in the form [x1,y1,x2,y2].
+    Same values as `iou`, for all the pairs at once.
+    """
+    bb_test = _boxes(bb_test)[:, None]
+    bb_gt = _boxes(bb_gt)[None, :]
+    xx1 = np.maximum(bb_test[..., 0], bb_gt[..., 0])
+    yy1 = np.maximum(bb_test[..., 1], bb_gt[..., 1])
+    xx2 = np.minimum(bb_test[..., 2], bb_gt[..., 2])
+    yy2 = np.minimum(bb_test[..., 3], bb_gt[..., 3])
+    w = np.maximum(0., xx2 - xx1)
+    h = np.maximum(0., yy2 - yy1)
+    wh = w * h
+    o = wh / ((bb_test[..., 2] - bb_test[..., 0]) * (bb_test[..., 3] - bb_test[..., 1])
+              + (bb_gt[..., 2] - bb_gt[..., 0]) * (bb_gt[..., 3] - bb_gt[..., 1]) - wh)
+    return o
+
+
+def _boxes(bbs):
+    bbs = np.asarray(bbs, dtype=float)
+    return bbs.reshape(0, 4) if bbs.size == 0 else bbs[:, :4]
+
+
+def associate_detections_to_trackers(detections, trackers, iou_threshold=0.25, similarity=None, appearance_weight=0.,
+                                     min_similarity=0.6):
     """
     Assigns detections to tracked object (both represented as bounding boxes)
 
-    Returns 3 lists of matches, unmatched_detections and unmatched_trackers
+    With a `similarity` matrix (cosine similarity between the appearance of each detection and each tracker, NaN for
+    the trackers without appearance) and an `appearance_weight` > 0, the assignment maximises
+    (1 - appearance_weight) * IOU + appearance_weight * similarity, and a pair with a low IOU is kept if its
+    similarity is at least `min_similarity`: a face that moved between two samples keeps its track.
+
+    Returns 3 lists of matches, unmatched_detections and unmatched_trackers.
+    The unmatched items come in ascending order, followed by the pairs rejected for their low IOU, in the order
+    of the assignment.
     """
     if len(trackers) == 0:
         return np.empty((0, 2), dtype=int), np.arange(len(detections)), np.empty((0, 5), dtype=int)
-    iou_matrix = np.zeros((len(detections), len(trackers)), dtype=np.float32)
-
-    for d, det in enumerate(detections):
-        for t, trk in enumerate(trackers):
-            iou_matrix[d, t] = iou(det, trk)
+    ious = iou_matrix(detections, trackers).astype(np.float32)
+    appearance = similarity is not None and appearance_weight > 0
+    scores = ious
+    if appearance:
+        scores = (1 - appearance_weight) * ious + appearance_weight * np.clip(np.nan_to_num(similarity), 0, None)
     '''
     The linear assignment module tries to minimise the total assignment cost.
     In our case we pass -iou_matrix as we want to maximise the total IOU
      between track predictions and the frame detection.
     '''
-    matched_indices = linear_sum_assignment(-iou_matrix)
-    matched_indices = np.transpose(np.asarray(matched_indices))
-
-    unmatched_detections = []
-    for d, det in enumerate(detections):
-        if d not in matched_indices[:, 0]:
-            unmatched_detections.append(d)
-    unmatched_trackers = []
-    for t, trk in enumerate(trackers):
-        if t not in matched_indices[:, 1]:
-            unmatched_trackers.append(t)
+    rows, cols = linear_sum_assignment(-scores)
+
+    det_matched = np.zeros(len(detections), dtype=bool)
+    det_matched[rows] = True
+    trk_matched = np.zeros(len(trackers), dtype=bool)
+    trk_matched[cols] = True
 
     # filter out matched with low IOU
-    matches = []
-    for m in matched_indices:
-        if iou_matrix[m[0], m[1]] < iou_threshold:
-            unmatched_detections.append(m[0])
-            unmatched_trackers.append(m[1])
-        else:
-            matches.append(m.reshape(1, 2))
-    if len(matches) == 0:
-        matches = np.empty((0, 2), dtype=int)
-    else:
-        matches = np.concatenate(matches, axis=0)
-
-    return matches, np.array(unmatched_detections), np.array(unmatched_trackers)
+    low = ious[rows, cols] < iou_threshold
+    if appearance:
+        low &= ~(similarity[rows, cols] >= min_similarity)
+    unmatched_detections = np.concatenate([np.flatnonzero(~det_matched), rows[low]])
+    unmatched_trackers = np.concatenate([np.flatnonzero(~trk_matched), cols[low]])
+    matches = np.stack([rows[~low], cols[~low]], axis=1)
+
+    return matches, unmatched_detections, unmatched_trackers
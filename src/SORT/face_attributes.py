@@ -0,0 +1,68 @@
+"""
+The attributes of the faces of a track, in a memory that does not grow with the duration of the track.
+
+An attribute is the list [cropped face, score, dist_rate, high_ratio_variance, width_rate, landmarks] built by the
+tracker for each detection. The store keeps:
+- the last attribute, whose landmarks go with the tracked box
+- the `max_crops` best crops by `crop_quality`, copied so that they do not hold the frame they were cut from
+- the scalar metrics of the last `history` observations, in preallocated arrays used as a ring buffer
+"""
+import heapq
+
+import numpy as np
+
+METRICS = ('score', 'dist_rate', 'high_ratio_variance', 'width_rate')
+
+
+def crop_quality(attribute):
+    """Face score from MTCNN, lowered for side faces (dist_rate 0 => front face ; 1 => side face)"""
+    return attribute[1] * (1 - attribute[2])
+
+
+class FaceAttributeStore:
+    def __init__(self, max_crops=20, history=256):
+        self.max_crops = max_crops
+        self.count = 0  # observations appended, also the ones not kept
+        self.last = None
+        self._crops = []  # heap of (quality, sample, score, crop), the worst first
+        self.samples = np.zeros(history, dtype=np.int64)
+        self.metrics = np.zeros((history, len(METRICS)), dtype=np.float32)
+
+    @classmethod
+    def from_list(cls, attributes, sample, **kwargs):
+        """A store from the list of attributes of the checkpoints saved before the store, the last one at `sample`"""
+        store = cls(**kwargs)
+        for i, attribute in enumerate(attributes):
+            store.append(attribute, sample - len(attributes) + 1 + i)
+        return store
+
+    def __len__(self):
+        return self.count
+
+    def append(self, attribute, sample):
+        """Add the attribute of the detection of the track at `sample`"""
+        i = self.count % len(self.samples)
+        self.samples[i] = sample
+        values = attribute[1:1 + len(METRICS)]
+        self.metrics[i, :len(values)] = values
+        self.count += 1
+        self.last = attribute
+
+        crop = attribute[0]
+        if crop is None or self.max_crops <= 0:
+            return
+        quality = crop_quality(attribute)
+        if len(self._crops) < self.max_crops:
+            heapq.heappush(self._crops, (quality, sample, attribute[1], np.array(crop)))
+        elif quality > self._crops[0][0]:
+            heapq.heapreplace(self._crops, (quality, sample, attribute[1], np.array(crop)))
+
+    def crops(self):
+        """The kept crops as (sample, score, quality, crop), from the best"""
+        return [(sample, score, quality, crop) for quality, sample, score, crop in sorted(self._crops, reverse=True)]
+
+    def history(self):
+        """The samples and the metrics of the last observations, in order"""
+        size = min(self.count, len(self.samples))
+        order = np.arange(self.count - size, self.count) % len(self.samples)
+        return self.samples[order], self.metrics[order]
@@ -5,6 +5,8 @@ As implemented in https://github.com/abewley/sort but with some modifications
 import numpy as np
 from filterpy.kalman import KalmanFilter
 
+from .face_attributes import FaceAttributeStore
+
 '''Motion Model'''
 
 
@@ -42,7 +44,7 @@ class KalmanBoxTracker(object):
         self.age = 0
 
         # addtional fields
-        self.face_additional_attribute = []
+        self.face_additional_attribute = FaceAttributeStore()
 
     def update(self, bbox, img=None):
         """
@@ -69,6 +71,25 @@ class KalmanBoxTracker(object):
         self.history.append(convert_x_to_bbox(self.kf.x))
         return self.history[-1][0]
 
+    def peek(self):
+        """
+        Returns the bounding box estimate at the next step, without advancing the state vector.
+        """
+        x = self.kf.x.copy()
+        if (x[6] + x[2]) <= 0:
+            x[6] *= 0.0
+        return convert_x_to_bbox(np.dot(self.kf.F, x))[0]
+
+    def coast(self):
+        """
+        Advances the state vector when the detector did not run, so that the object is not counted as missed.
+        """
+        if (self.kf.x[6] + self.kf.x[2]) <= 0:
+            self.kf.x[6] *= 0.0
+        self.kf.predict()
+        self.age += 1
+        return self.get_state()
+
     def get_state(self):
         """
         Returns the current bounding box estimate.
@@ -8,14 +8,26 @@ import numpy as np
 from . import sort_utils as utils
 from .correlation_tracker import CorrelationTracker
 from .data_association import associate_detections_to_trackers
+from .face_attributes import FaceAttributeStore
 from .kalman_tracker import KalmanBoxTracker
+from .batched_kalman import BatchedKalmanFilter, BatchedKalmanBoxTracker, predict_all, update_all, coast_all
 
 
 class Sort:
 
-    def __init__(self, max_age=1, min_hits=3, use_dlib=False):
+    def __init__(self, max_age=1, min_hits=3, use_dlib=False, batched=True, appearance_weight=0., min_similarity=0.6,
+                 embedding_momentum=0.9, save_crops=False, max_crops=20):
         """
-        Sets key parameters for SORT
+        Sets key parameters for SORT.
+        With `batched`, the Kalman filters of all the tracks run at once (see `batched_kalman`), otherwise each
+        track has its own filterpy filter.
+        With `appearance_weight` > 0 and the embeddings of the detections given to `update`, the association mixes
+        the IOU with the cosine similarity to the appearance of the tracks (see `associate_detections_to_trackers`).
+        The appearance of a track is the running average of the embeddings of its detections, with
+        `embedding_momentum`.
+        With `save_crops`, the crops of a track are saved in `root_dic` when it ends, by the `crop_writer` if set,
+        otherwise synchronously.
+        Each track keeps its `max_crops` best crops (see `FaceAttributeStore`), whatever its duration.
         """
         self.max_age = max_age
         self.min_hits = min_hits
@@ -23,61 +35,188 @@ class Sort:
         self.frame_count = 0
 
         self.use_dlib = use_dlib
+        self.kalman = BatchedKalmanFilter() if batched and not use_dlib else None
 
-    def update(self, dets, img_size, root_dic, additional_attribute_list, img=None):
+        self.appearance_weight = appearance_weight
+        self.min_similarity = min_similarity
+        self.embedding_momentum = embedding_momentum
+        self.appearances = {}  # normalised running embedding of each track id
+        self.detection_embeddings = {}  # embedding of the detection of each track id updated by the last `update`
+
+        self.save_crops = save_crops
+        self.max_crops = max_crops
+        self.crop_writer = None  # a `sort_utils.CropWriter`, not part of the pickled state
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['crop_writer'] = None
+        return state
+
+    def __setstate__(self, state):
+        # checkpoints saved before the batched filters, the appearance and the crop options
+        state.setdefault('kalman', None)
+        state.setdefault('appearance_weight', 0.)
+        state.setdefault('min_similarity', 0.6)
+        state.setdefault('embedding_momentum', 0.9)
+        state.setdefault('appearances', {})
+        state.setdefault('detection_embeddings', {})
+        state.setdefault('save_crops', False)
+        state.setdefault('crop_writer', None)
+        state.setdefault('max_crops', 20)
+        for trk in state['trackers']:
+            if isinstance(getattr(trk, 'face_additional_attribute', None), list):
+                trk.face_additional_attribute = FaceAttributeStore.from_list(
+                    trk.face_additional_attribute, state['frame_count'], max_crops=state['max_crops'])
+        self.__dict__.update(state)
+
+    def new_tracker(self, det, img=None):
+        if self.use_dlib:
+            return CorrelationTracker(det, img)
+        if self.kalman is not None:
+            trk = BatchedKalmanBoxTracker(det, self.kalman)
+        else:
+            trk = KalmanBoxTracker(det)
+        trk.face_additional_attribute.max_crops = self.max_crops
+        return trk
+
+    def remove_tracker(self, i):
+        trk = self.trackers.pop(i)
+        if self.kalman is not None:
+            trk.remove()
+        self.appearances.pop(trk.id, None)
+        return trk
+
+    def similarity(self, embeddings):
+        """Cosine similarity between the `embeddings` of the detections and the trackers, NaN without appearance"""
+        embeddings = np.asarray(embeddings, dtype=float)
+        embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+        appearances = np.full((len(self.trackers), embeddings.shape[1]), np.nan)
+        for t, trk in enumerate(self.trackers):
+            if trk.id in self.appearances:
+                appearances[t] = self.appearances[trk.id]
+        return np.dot(embeddings, appearances.T)
+
+    def remember(self, trk, embedding):
+        """Add the embedding of a detection to the appearance of its tracker"""
+        self.detection_embeddings[trk.id] = embedding
+        embedding = embedding / np.linalg.norm(embedding)
+        previous = self.appearances.get(trk.id)
+        if previous is not None:
+            embedding = self.embedding_momentum * previous + (1 - self.embedding_momentum) * embedding
+            embedding /= np.linalg.norm(embedding)
+        self.appearances[trk.id] = embedding
+
+    def update(self, dets, img_size, root_dic, additional_attribute_list, img=None, embeddings=None):
         """
         Params:
           dets - a numpy array of detections in the format [[x,y,w,h,score],[x,y,w,h,score],...]
+          embeddings - optional FaceNet embedding of each detection, kept in `detection_embeddings`
         Requires: this method must be called once for each frame even with empty detections.
         Returns the a similar array, where the last column is the object ID.
 
         NOTE: as in practical realtime MOT, the detector doesn't run on every single frame
         """
         self.frame_count += 1
+        self.detection_embeddings = {}
         # time_dict = dict()
         # get predicted locations from existing trackers.
         trks = np.zeros((len(self.trackers), 5))
-        to_del = []
         ret = []
-        for t, trk in enumerate(trks):
-            pos = self.trackers[t].predict(img)  # for kal!
-            trk[:] = [pos[0], pos[1], pos[2], pos[3], 0]
-            if np.any(np.isnan(pos)):
-                to_del.append(t)
+        if self.kalman is not None:
+            positions = predict_all(self.trackers)
+        else:
+            positions = np.reshape([trk.predict(img) for trk in self.trackers], (-1, 4))  # for kal!
+        trks[:, :4] = positions
+        to_del = np.flatnonzero(np.any(np.isnan(positions), axis=1))
         trks = np.ma.compress_rows(np.ma.masked_invalid(trks))
         for t in reversed(to_del):
-            self.trackers.pop(t)
+            self.remove_tracker(t)
         if len(dets) > 0:
-            matched, unmatched_dets, unmatched_trks = associate_detections_to_trackers(dets, trks)
+            similarity = None
+            if embeddings is not None and self.appearance_weight > 0 and len(self.trackers) > 0:
+                similarity = self.similarity(embeddings)
+            matched, unmatched_dets, unmatched_trks = associate_detections_to_trackers(
+                dets, trks, similarity=similarity, appearance_weight=self.appearance_weight,
+                min_similarity=self.min_similarity)
             # update matched trackers with assigned detections
-            for t, trk in enumerate(self.trackers):
-                if t not in unmatched_trks:
-                    d = matched[np.where(matched[:, 1] == t)[0], 0]
-                    trk.update(dets[d, :][0], img)  # for dlib re-intialize the trackers ?!
-                    trk.face_additional_attribute.append(additional_attribute_list[d[0]])
+            updated = []
+            for d, t in matched:
+                trk = self.trackers[t]
+                if self.kalman is not None:
+                    updated.append((trk, dets[d, :]))
+                else:
+                    trk.update(dets[d, :], img)  # for dlib re-intialize the trackers ?!
+                trk.face_additional_attribute.append(additional_attribute_list[d], self.frame_count)
+                if embeddings is not None:
+                    self.remember(trk, embeddings[d])
+            if updated:
+                update_all(*zip(*updated))
 
             # create and initialise new trackers for unmatched detections
             for i in unmatched_dets:
+                trk = self.new_tracker(dets[i, :], img)
                 if not self.use_dlib:
-                    trk = KalmanBoxTracker(dets[i, :])
-                    trk.face_additional_attribute.append(additional_attribute_list[i])
-                else:
-                    trk = CorrelationTracker(dets[i, :], img)
+                    trk.face_additional_attribute.append(additional_attribute_list[i], self.frame_count)
+                if embeddings is not None:
+                    self.remember(trk, embeddings[i])
 
                 self.trackers.append(trk)
 
+        states = self.states()
         i = len(self.trackers)
         for trk in reversed(self.trackers):
-            d = trk.get_state()
+            d = states[i - 1]
 
             if (trk.time_since_update < 1) and (trk.hit_streak >= self.min_hits or self.frame_count <= self.min_hits):
-                ret.append(np.concatenate((d, [trk.id, trk.face_additional_attribute[-1][-1]])).reshape(1, -1))
+                ret.append(np.concatenate((d, [trk.id, trk.face_additional_attribute.last[-1]])).reshape(1, -1))
             i -= 1
             # remove dead tracklet
             if trk.time_since_update >= self.max_age or \
                     d[2] < 0 or d[3] < 0 or d[0] > img_size[1] or d[1] > img_size[0]:
-                utils.save_to_file(root_dic, trk, self.frame_count)
-                self.trackers.pop(i)
+                if self.save_crops and self.crop_writer is not None:
+                    self.crop_writer.save(root_dic, trk)
+                elif self.save_crops:
+                    utils.save_to_file(root_dic, trk)
+                self.remove_tracker(i)
+        if len(ret) > 0:
+            return np.concatenate(ret)
+
+        return np.empty((0, 6))
+
+    def states(self):
+        """The current boxes of the trackers"""
+        if self.kalman is not None:
+            return self.kalman.boxes([trk.slot for trk in self.trackers])
+        return [trk.get_state() for trk in self.trackers]
+
+    def leaves_image(self, img_size):
+        """
+        True if the next predicted position of any track is (partially) outside the image.
+        """
+        if self.kalman is not None:
+            peeked = self.kalman.peek([trk.slot for trk in self.trackers])
+        else:
+            peeked = [trk.peek() for trk in self.trackers]
+        for d in peeked:
+            if d[0] < 0 or d[1] < 0 or d[2] > img_size[1] or d[3] > img_size[0]:
+                return True
+        return False
+
+    def coast(self):
+        """
+        Advance all the tracks with their motion model, for a frame on which the detector did not run.
+        Returns the same array of `update`, with the landmarks of the last detection of each track.
+        """
+        self.frame_count += 1
+        ret = []
+        if self.kalman is not None:
+            coasted = coast_all(self.trackers)
+        else:
+            coasted = [trk.coast() for trk in self.trackers]
+        for trk, d in zip(reversed(self.trackers), reversed(coasted)):
+            if np.any(np.isnan(d)):
+                continue
+            ret.append(np.concatenate((d, [trk.id, trk.face_additional_attribute.last[-1]])).reshape(1, -1))
         if len(ret) > 0:
             return np.concatenate(ret)
 
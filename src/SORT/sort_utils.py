@@ -1,7 +1,9 @@
 import os
+import queue
+import threading
+import time
+
 import cv2
-import numpy as np
-from PIL import Image
 
 
 def mkdir(path):
@@ -10,14 +12,99 @@ def mkdir(path):
     os.makedirs(path, exist_ok=True)
 
 
-def save_to_file(root_dic, tracker, frame):
-    image_size = 160
-    out_path = os.path.join(root_dic, str(tracker.id))
+def select_crops(tracker, min_score=0.99, top_k=None):
+    """
+    The (file name, crop) to save for a finished track: its best crops (see `FaceAttributeStore`) with a score above
+    `min_score`, at most `top_k`. The files are named after the sample of the crop.
+    """
+    selected = [(sample, crop) for sample, score, _, crop in tracker.face_additional_attribute.crops()
+                if score > min_score]  # face score from MTCNN ,max = 1
+    if top_k:
+        selected = selected[:top_k]
+    return [('%d.jpg' % sample, crop) for sample, crop in selected]
+
+
+def write_crops(out_path, crops, image_size=160):
+    """Write the crops resized to `image_size`. Return the bytes written."""
     mkdir(out_path)
+    written = 0
+    for name, crop in crops:
+        scaled = cv2.resize(crop, (image_size, image_size), interpolation=cv2.INTER_LINEAR)
+        ok, content = cv2.imencode('.jpg', scaled)
+        if not ok:
+            continue
+        with open(os.path.join(out_path, name), 'wb') as f:
+            f.write(content.tobytes())
+        written += len(content)
+    return written
+
+
+def save_to_file(root_dic, tracker):
+    write_crops(os.path.join(root_dic, str(tracker.id)), select_crops(tracker))
+
+
+class CropWriter:
+    """
+    Saves the face crops of the finished tracks from a pool of background threads, so that the tracking does not
+    wait for the disk. `save` selects the crops, and blocks only when `queue_size` tracks are already waiting.
+    With `top_k`, only the best crops of each track are kept (see `FaceAttributeStore`).
+    """
+
+    def __init__(self, workers=2, queue_size=64, top_k=None, min_score=0.99, image_size=160):
+        self.top_k = top_k
+        self.min_score = min_score
+        self.image_size = image_size
+
+        self.tracks = 0
+        self.crops = 0
+        self.bytes = 0
+        self.busy = 0.  # seconds spent resizing, encoding and writing, summed over the workers
+        self.blocked = 0.  # seconds `save` waited for a place in the queue
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(queue_size)
+        self._threads = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for t in self._threads:
+            t.start()
+
+    def save(self, root_dic, tracker):
+        crops = select_crops(tracker, self.min_score, self.top_k)
+        start = time.time()
+        self._queue.put((os.path.join(root_dic, str(tracker.id)), crops))
+        self.blocked += time.time() - start
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            out_path, crops = item
+            start = time.time()
+            try:
+                written = write_crops(out_path, crops, self.image_size)
+            except Exception as e:
+                print('Crops of %s not saved: %s' % (out_path, e))
+                with self._lock:
+                    self.errors += 1
+                continue
+            with self._lock:
+                self.tracks += 1
+                self.crops += len(crops)
+                self.bytes += written
+                self.busy += time.time() - start
+
+    def close(self):
+        """Wait for the crops in the queue to be written, and stop the workers. Can be called several times."""
+        threads, self._threads = self._threads, []
+        for _ in threads:
+            self._queue.put(None)
+        for t in threads:
+            t.join()
 
-    for i, item in enumerate(tracker.face_additional_attribute):
-        if item[1] > 0.99:  # face score from MTCNN ,max = 1
-            scaled = np.array(Image.fromarray(item[0]).resize((image_size, image_size), resample=Image.BILINEAR))
-            scaled = cv2.resize(scaled, (image_size, image_size), interpolation=cv2.INTER_CUBIC)
+    def stats(self):
+        return {'tracks': self.tracks, 'crops': self.crops, 'bytes': self.bytes, 'busy': self.busy,
+                'blocked': self.blocked, 'errors': self.errors}
 
-            cv2.imwrite("%s/%s.jpg" % (out_path, frame - i), scaled)
+    def summary(self):
+        return '%d crops of %d tracks, %.1f MB in %.1fs of writing, tracking blocked %.1fs' % (
+            self.crops, self.tracks, self.bytes / 2 ** 20, self.busy, self.blocked)
@@ -0,0 +1,169 @@
+"""
+Approximate nearest-neighbour classifier, for projects with many identities.
+
+The FaceNet embeddings of the training images are indexed with an inverted file (IVF): a spherical k-means splits
+them in `nlist` lists, and a query only scans the `nprobe` lists with the closest centroids. The score of a class is
+the cosine similarity of its closest retrieved image, mapped to a probability by a sigmoid calibrated on the
+training set (Platt scaling). Like `FacerecClassifier`, the probabilities of the classes are not normalised.
+"""
+import numpy as np
+from scipy.special import expit
+from sklearn.linear_model import LogisticRegression
+
+
+def normalise(X):
+    X = np.asarray(X, dtype='float32')
+    norm = np.linalg.norm(X, axis=1, keepdims=True)
+    return X / np.maximum(norm, 1e-12)
+
+
+def kmeans(X, k, iterations=10, seed=0):
+    """Spherical k-means of the rows of `X`, which are unit vectors. Return the centroids and the assignments."""
+    rng = np.random.RandomState(seed)
+    centroids = X[rng.choice(len(X), k, replace=False)]
+    for _ in range(iterations):
+        assignment = np.argmax(X @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, X)
+        counts = np.bincount(assignment, minlength=k)
+        empty = counts == 0
+        # an empty list restarts from a random vector
+        sums[empty] = X[rng.choice(len(X), empty.sum())]
+        centroids = normalise(sums)
+    return centroids, np.argmax(X @ centroids.T, axis=1)
+
+
+class IVFIndex:
+    """Inverted file of unit vectors, searched by inner product"""
+
+    def __init__(self, nlist=None, nprobe=8, train_size=256, seed=0):
+        self.nlist = nlist  # by default, the square root of the number of vectors
+        self.nprobe = nprobe
+        self.train_size = train_size  # vectors per list for the k-means
+        self.seed = seed
+        self.centroids = None
+        self.vectors = None  # sorted by list
+        self.ids = None  # position of each vector in the indexed data
+        self.offsets = None  # the vectors of list l are vectors[offsets[l]:offsets[l + 1]]
+
+    def fit(self, X):
+        X = normalise(X)
+        nlist = self.nlist or int(np.sqrt(len(X)))
+        nlist = max(1, min(nlist, len(X)))
+
+        rng = np.random.RandomState(self.seed)
+        sample = X[rng.choice(len(X), min(len(X), nlist * self.train_size), replace=False)]
+        self.centroids, _ = kmeans(sample, nlist, seed=self.seed)
+
+        assignment = np.argmax(X @ self.centroids.T, axis=1)
+        order = np.argsort(assignment, kind='stable')
+        self.vectors = np.ascontiguousarray(X[order])
+        self.ids = order
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=nlist))])
+        return self
+
+    def __len__(self):
+        return 0 if self.ids is None else len(self.ids)
+
+    def search(self, X, k=1, nprobe=None):
+        """
+        The `k` most similar indexed vectors of each row of `X`, scanning `nprobe` lists.
+        Return their similarities and ids, padded with -inf and -1 when less than `k` vectors were scanned.
+        """
+        X = normalise(X)
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        similarities = np.full((len(X), k), -np.inf, dtype='float32')
+        ids = np.full((len(X), k), -1)
+        if len(X) == 0:
+            return similarities, ids
+
+        if nprobe < len(self.centroids):
+            coarse = X @ self.centroids.T
+            probes = np.argpartition(-coarse, nprobe - 1, axis=1)[:, :nprobe]
+        else:
+            probes = np.broadcast_to(np.arange(len(self.centroids)), (len(X), nprobe))
+
+        for i, (x, lists) in enumerate(zip(X, probes)):
+            # the lists are contiguous: scanning slices avoids copying the vectors
+            slices = [slice(self.offsets[l], self.offsets[l + 1]) for l in lists]
+            scores = np.concatenate([self.vectors[s] @ x for s in slices])
+            if len(scores) == 0:
+                continue
+            found = np.concatenate([self.ids[s] for s in slices])
+            n = min(k, len(scores))
+            best = np.argpartition(-scores, n - 1)[:n] if n < len(scores) else np.arange(len(scores))
+            best = best[np.argsort(-scores[best], kind='stable')]
+            similarities[i, :n] = scores[best]
+            ids[i, :n] = found[best]
+        return similarities, ids
+
+
+class AnnClassifier:
+    """
+    Classifier of the closest training images, through an `IVFIndex`.
+    `nprobe` trades recall for latency, `k` is the number of retrieved images per face.
+    """
+
+    def __init__(self, nlist=None, nprobe=8, k=10, calibration_size=2000):
+        self.type = 'ANN'
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.k = k
+        self.calibration_size = calibration_size
+        self.index = None
+        self.labels_ = None  # class index of each indexed image
+        self.classes_ = []
+        self.prob_a = 1.
+        self.prob_b = 0.
+
+    def train(self, X, y, keys=None):
+        print('Indexing %d images' % len(y))
+        self.classes_, self.labels_ = np.unique(y, return_inverse=True)
+        self.classes_ = list(self.classes_)
+        self.index = IVFIndex(self.nlist, self.nprobe).fit(X)
+        print('Indexed %d classes in %d lists' % (len(self.classes_), len(self.index.centroids)))
+        self.calibrate(X)
+        return self
+
+    def update(self, X, y, keys, refit_negatives=False):
+        """The index is rebuilt: it is cheap, and there are no negatives to keep"""
+        return self.train(X, y, keys)
+
+    def calibrate(self, X):
+        """
+        Fit the sigmoid of the similarities on a sample of the training images: each one is queried without itself,
+        and the closest image of its own class is a positive, the closest of another class a negative.
+        """
+        rng = np.random.RandomState(0)
+        sample = rng.choice(len(X), min(len(X), self.calibration_size), replace=False)
+        similarities, ids = self.index.search(np.asarray(X)[sample], self.k + 1)
+
+        scores, targets = [], []
+        for i, sims, found in zip(sample, similarities, ids):
+            keep = (found != i) & (found >= 0)
+            same = self.labels_[found[keep]] == self.labels_[i]
+            for target in (True, False):
+                if (same == target).any():
+                    scores.append(sims[keep][same == target][0])
+                    targets.append(int(target))
+
+        if len(set(targets)) < 2:
+            print('Not enough images for calibrating the similarities, using them as probabilities')
+            self.prob_a, self.prob_b = 1., 0.
+            return
+        lr = LogisticRegression(C=1e4).fit(np.array(scores).reshape(-1, 1), targets)
+        if lr.coef_[0, 0] <= 0:
+            print('The similarities do not separate the classes, using them as probabilities')
+            self.prob_a, self.prob_b = 1., 0.
+            return
+        self.prob_a, self.prob_b = lr.coef_[0, 0], lr.intercept_[0]
+
+    def predict_proba(self, X, nprobe=None):
+        # Y[i, j] gives the probability that sample i has the label j, 0 for the classes not retrieved
+        similarities, ids = self.index.search(X, self.k, nprobe or self.nprobe)
+        Y = np.zeros((len(ids), len(self.classes_)))
+        found = ids >= 0
+        rows = np.nonzero(found)[0]
+        # the sigmoid is increasing: the closest retrieved image of a class gives its probability
+        np.maximum.at(Y, (rows, self.labels_[ids[found]]), expit(self.prob_a * similarities[found] + self.prob_b))
+        return Y
@@ -1,21 +1,126 @@
 import argparse
-import csv
+import hashlib
 import os
-import pickle
 import sys
+import time
 
 import numpy as np
 from joblib import Parallel, delayed
+from scipy.special import expit
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.linear_model import LogisticRegression
-from sklearn.metrics.pairwise import cosine_similarity
 from sklearn.multiclass import _fit_binary
 from sklearn.neighbors import KNeighborsClassifier
 from sklearn.preprocessing import LabelBinarizer
 from sklearn.svm import SVC
-from tensorflow.keras.models import load_model
 
-from .utils import utils
+from . import models
+from .ann import AnnClassifier
+from .models import FACENET_MODEL, FACENET_WEIGHTS
+from .utils import utils, classifier_store
+from .utils.embedding_store import EmbeddingStore, file_hash, model_version
+
+# sum of the squared sizes of the classes above which the outliers are detected in parallel: several seconds of work,
+# more than starting the processes
+MIN_PARALLEL_WORK = 2e8
+
+
+def load_facenet():
+    # the shared instance of the process; tensorflow is imported only there, not in the training workers
+    return models.facenet(FACENET_MODEL, FACENET_WEIGHTS).model
+
+
+def embed_dataset(paths, keys=None, batch_size=64):
+    """
+    The embeddings of a list of images. Only the images not yet in the embedding store go through FaceNet,
+    which is loaded only if needed. `keys` are the hashes of the images, if already computed.
+    """
+    store = EmbeddingStore(model_version(FACENET_MODEL, FACENET_WEIGHTS))
+    if keys is None:
+        keys = [file_hash(p) for p in paths]
+    missing = set(store.missing(keys))
+    if missing:
+        print('Embedding %d new images, %d already known' % (len(missing), len(store)))
+        facenet = load_facenet()
+        todo = {}  # one path for each new key, grouped by image size
+        for key, path in zip(keys, paths):
+            if key in missing:
+                missing.remove(key)
+                face = utils.resize_img(utils.load_gray(path))
+                todo.setdefault(face.shape, []).append((key, face))
+        new_keys, embeddings = [], []
+        for items in todo.values():
+            for i in range(0, len(items), batch_size):
+                batch = items[i:i + batch_size]
+                new_keys.extend(k for k, _ in batch)
+                embeddings.append(utils.get_embeddings(facenet, [f for _, f in batch]))
+        store.add(new_keys, np.concatenate(embeddings))
+    return store.get(keys)
+
+
+class LinearOvR:
+    """
+    Compiled inference of one-vs-rest linear SVCs. The decision values of all the classes come from a single matrix
+    product; libsvm's Platt scaling and pairwise coupling are then applied element-wise.
+    """
+    MIN_PROB = 1e-7  # as libsvm
+
+    def __init__(self, estimators):
+        self.coef = np.vstack([e.coef_ for e in estimators]).T  # (features, classes)
+        self.intercept = np.concatenate([e.intercept_ for e in estimators])
+        self.prob_a = np.array([e.probA_[0] for e in estimators])
+        self.prob_b = np.array([e.probB_[0] for e in estimators])
+
+    @staticmethod
+    def supports(estimators):
+        return len(estimators) > 0 and all(
+            isinstance(e, SVC) and e.kernel == 'linear' and e.probability and len(e.classes_) == 2
+            for e in estimators)
+
+    def decision_function(self, X):
+        return np.asarray(X) @ self.coef + self.intercept
+
+    def predict_proba(self, X):
+        """Probability of the positive class of each estimator"""
+        dec = self.decision_function(X)
+        # libsvm gives the probability of the first class with 1 / (1 + exp(A * f + B)), where f = -dec
+        r = np.clip(expit(self.prob_a * dec - self.prob_b), self.MIN_PROB, 1 - self.MIN_PROB)
+        return _couple_binary(r)
+
+
+def _couple_binary(r, max_iter=100):
+    """
+    libsvm's `multiclass_probability` for two classes, element-wise. It iterates only up to a tolerance,
+    so the result slightly differs from `r`. Return the probability of the second class.
+    """
+    q00, q11, q01 = (1 - r) * (1 - r), r * r, -(1 - r) * r
+    p0 = np.full_like(r, 0.5)
+    p1 = np.full_like(r, 0.5)
+    eps = 0.005 / 2
+    active = np.ones(r.shape, dtype=bool)
+    for _ in range(max_iter):
+        qp0 = q00 * p0 + q01 * p1
+        qp1 = q01 * p0 + q11 * p1
+        pqp = p0 * qp0 + p1 * qp1
+        active &= np.maximum(np.abs(qp0 - pqp), np.abs(qp1 - pqp)) >= eps
+        if not active.any():
+            break
+
+        # update of the first class
+        diff = np.where(active, (pqp - qp0) / q00, 0)
+        p0 = p0 + diff
+        pqp = (pqp + diff * (diff * q00 + 2 * qp0)) / (1 + diff) / (1 + diff)
+        qp0 = (qp0 + diff * q00) / (1 + diff)
+        qp1 = (qp1 + diff * q01) / (1 + diff)
+        p0 = p0 / (1 + diff)
+        p1 = p1 / (1 + diff)
+
+        # update of the second class
+        diff = np.where(active, (pqp - qp1) / q11, 0)
+        p1 = p1 + diff
+        p0 = p0 / (1 + diff)
+        p1 = p1 / (1 + diff)
+    return p1
 
 
 class FacerecClassifier:
@@ -24,40 +129,147 @@ class FacerecClassifier:
     This version avoid normalisation, which brings misleading results
     """
 
-    def __init__(self, type="SVM"):
+    def __init__(self, type="SVM", n_jobs=-1):
         self.type = type
+        self.n_jobs = n_jobs  # processes fitting the estimators, -1 for one per core
         self.estimators_ = []
+        self.classes_ = []
+        self.fingerprints_ = {}  # hash of the training images of each class
+        self.compiled_ = None  # LinearOvR, when the estimators can be compiled
 
-    def train(self, X, y):
-        # Train classifier
-        print('Training classifier')
-
+    def model(self):
         if self.type == 'SVM':
-            model = SVC(kernel='linear', probability=True)
+            # seeded, so that the calibration does not depend on the order of the fits in the pool
+            return SVC(kernel='linear', probability=True, random_state=0)
         elif self.type == 'KNN':
-            model = KNeighborsClassifier(n_neighbors=1)
+            return KNeighborsClassifier(n_neighbors=1)
         elif self.type == 'Softmax':
-            model = LogisticRegression(random_state=0, solver='lbfgs', multi_class='multinomial')
+            return LogisticRegression(random_state=0, solver='lbfgs', multi_class='multinomial')
         else:
-            model = RandomForestClassifier(n_estimators=1000, max_leaf_nodes=100, n_jobs=-1)
+            # the forest uses the cores itself, unless the classes are already fitted in parallel
+            n_jobs = -1 if getattr(self, 'n_jobs', 1) == 1 else 1
+            return RandomForestClassifier(n_estimators=1000, max_leaf_nodes=100, n_jobs=n_jobs)
+
+    def train(self, X, y, keys=None):
+        """Fit an estimator for each class. `keys` identify the training images, for later updates."""
+        # Train classifier
+        print('Training classifier')
 
         # x = OneVsRestClassifier(model).fit(X,y)
-        label_binarizer_ = LabelBinarizer(sparse_output=True)
-        Y = label_binarizer_.fit_transform(y)
-        Y = Y.tocsc()
-        columns = (col.toarray().ravel() for col in Y.T)
+        label_binarizer_ = LabelBinarizer().fit(y)
+        # with two classes, a single estimator of the second one
+        positives = label_binarizer_.classes_[1:] if len(label_binarizer_.classes_) == 2 else label_binarizer_.classes_
+
+        self.estimators_ = self.fit_estimators(X, y, positives)
+        self.classes_ = list(label_binarizer_.classes_)
+        self.fingerprints_ = class_fingerprints(y, keys) if keys is not None else {}
+        self.compile(X)
+
+        return self
 
-        self.estimators_ = Parallel(n_jobs=1)(delayed(_fit_binary)(
-            model, X, column, classes=[
-                "not %s" % label_binarizer_.classes_[i], label_binarizer_.classes_[i]])
-                                              for i, column in enumerate(columns))
+    def update(self, X, y, keys, refit_negatives=False):
+        """
+        Refit the estimators of the classes whose images changed (including the new classes).
+        The estimators of the removed classes are dropped.
+
+        The negatives of every estimator are the images of all the other classes. An unchanged SVC is kept only if
+        the images of the changed classes are all beyond its margin (decision <= -1): they are not support vectors,
+        so the refit would find the same hyperplane, only its cross-validated probability calibration could slightly
+        move. The other estimators are refitted, and all of them when a class was removed or with `refit_negatives`.
+        """
+        fingerprints = class_fingerprints(y, keys)
+        classes = sorted(fingerprints)
+        if not getattr(self, 'fingerprints_', None) or len(classes) <= 2 or len(self.classes_) <= 2:
+            # nothing to compare with, or a binary problem with a single estimator
+            return self.train(X, y, keys)
+
+        changed = [c for c in classes if self.fingerprints_.get(c) != fingerprints[c]]
+        removed = [c for c in self.classes_ if c not in fingerprints]
+        if removed or refit_negatives and changed:
+            # the images of the removed classes may have been support vectors of any estimator
+            to_fit = classes
+        else:
+            stale = self.stale_estimators(X, y, changed)
+            to_fit = [c for c in classes if c in changed or c in stale]
+        print('Updating classifier: %d changed, %d removed, refitting %d of %d estimators' % (
+            len(changed), len(removed), len(to_fit), len(classes)))
+
+        fitted = self.fit_estimators(X, y, to_fit)
+
+        estimators = dict(zip(self.classes_, self.estimators_))
+        estimators.update(zip(to_fit, fitted))
+        self.estimators_ = [estimators[c] for c in classes]
+        self.classes_ = classes
+        self.fingerprints_ = fingerprints
+        self.compile(X)
 
         return self
 
+    def stale_estimators(self, X, y, changed):
+        """The unchanged classes whose estimator may differ with the images of the `changed` classes as negatives"""
+        if not changed:
+            return []
+        negatives = np.asarray(X)[np.isin(y, changed)]
+        return [c for c, e in zip(self.classes_, self.estimators_)
+                if c not in changed and (not isinstance(e, SVC) or (e.decision_function(negatives) > -1).any())]
+
+    def fit_estimators(self, X, y, labels):
+        """
+        Fit an estimator for each of the `labels`, in a pool of `n_jobs` processes.
+        `X` is dumped once in a memory-mapped file shared by the workers, instead of being pickled for every class.
+        """
+        model = self.model()
+        X = np.ascontiguousarray(X)
+        y = np.asarray(y)
+        n_jobs = getattr(self, 'n_jobs', 1)
+
+        start = time.time()
+        results = Parallel(n_jobs=n_jobs, max_nbytes=0, mmap_mode='r')(
+            delayed(_fit_class)(model, X, y, label) for label in labels)
+        elapsed = time.time() - start
+
+        for label, (_, seconds) in zip(labels, results):
+            print('Fitted %s in %.2fs' % (label, seconds))
+        fit_time = sum(seconds for _, seconds in results)
+        print('Fitted %d estimators in %.2fs (%.2fs of fitting, %.1fx speedup)' % (
+            len(results), elapsed, fit_time, fit_time / elapsed if elapsed > 0 else 1))
+        return [estimator for estimator, _ in results]
+
+    def compile(self, X=None, tolerance=1e-6):
+        """
+        Switch to the compiled inference of `LinearOvR`, if the estimators are linear SVCs and it gives the same
+        probabilities of the estimators on (a sample of) `X`, or on random embeddings. Return True if compiled.
+        """
+        self.compiled_ = None
+        if not LinearOvR.supports(self.estimators_):
+            return False
+        compiled = LinearOvR(self.estimators_)
+
+        rng = np.random.RandomState(0)
+        if X is None:
+            X = rng.normal(size=(256, compiled.coef.shape[0]))
+        else:
+            X = np.asarray(X)
+            X = X[rng.choice(len(X), min(len(X), 256), replace=False)]
+        error = np.abs(compiled.predict_proba(X) - self.estimators_proba(X)).max()
+        if error > tolerance:
+            print('Compiled inference differs of %g from the estimators, not using it' % error)
+            return False
+        self.compiled_ = compiled
+        return True
+
+    def estimators_proba(self, X):
+        """Probability of each class, from each estimator"""
+        return np.array([e.predict_proba(X)[:, 1] for e in self.estimators_]).T
+
     def predict_proba(self, X):
         # Y[i, j] gives the probability that sample i has the label j.
         # In the multi-label case, these are not disjoint.
-        Y = np.array([e.predict_proba(X)[:, 1] for e in self.estimators_]).T
+        compiled = getattr(self, 'compiled_', None)
+        if compiled is not None:
+            Y = compiled.predict_proba(X)
+        else:
+            Y = self.estimators_proba(X)
 
         if len(self.estimators_) == 1:
             # Only one estimator, but we still want to return probabilities
@@ -67,12 +279,30 @@ class FacerecClassifier:
         return Y
 
 
-def main(classifier='SVM', project='general', discard_disabled="true"):
-    embedding_file = os.path.join('data/embedding/', project + '.csv')
-    label_file = os.path.join('data/embedding/', project + '_label.csv')
+def _fit_class(model, X, y, label):
+    """Fit the one-vs-rest estimator of a class. Return it, with the time taken."""
+    start = time.time()
+    estimator = _fit_binary(model, X, (y == label).astype(int), classes=["not %s" % label, label])
+    return estimator, time.time() - start
+
+
+def class_fingerprints(y, keys):
+    """A hash of the set of training images of each class"""
+    groups = {}
+    for label, key in zip(y, keys):
+        groups.setdefault(label, []).append(key)
+    return {label: hashlib.sha1(' '.join(sorted(k)).encode()).hexdigest() for label, k in groups.items()}
+
+
+def main(classifier='SVM', project='general', discard_disabled="true", incremental=False, refit_negatives=False,
+         n_jobs=-1, nprobe=8):
+    """
+    Train the classifier of a project, fitting the classes with `n_jobs` processes.
+    The `ANN` classifier scans `nprobe` lists of its index for each face.
+    With `incremental`, update the saved classifier, refitting only the classes whose images changed and the ones
+    whose margin they cross, or all of them with `refit_negatives` (see `FacerecClassifier.update`).
+    """
     data_dir = os.path.expanduser(os.path.join('data/training_img_aligned/', project))
-    classifier_path = os.path.expanduser(os.path.join('data/classifier', project + '.pkl'))
-    os.makedirs(os.path.dirname(classifier_path), exist_ok=True)
 
     disabled_file = os.path.join(data_dir, 'disabled.txt')
     disabled = []
@@ -82,61 +312,70 @@ def main(classifier='SVM', project='general', discard_disabled="true"):
             print(disabled)
 
     # load train dataset
-    trainX, trainy, paths, class_names = utils.load_dataset(data_dir, disabled=disabled)
-
-    facenet = load_model('./model/facenet_keras.h5', compile=False)
-    facenet.load_weights('./model/facenet_keras_weights.h5')
-
-    trainX = [utils.get_embedding(facenet, face_pixels) for face_pixels in trainX]
-    trainX = np.asarray(trainX)
-
-    np.savetxt(embedding_file, trainX, delimiter=",")
-    with open(label_file, 'w') as f:
-        writer = csv.writer(f)
-        writer.writerows(zip(trainy, paths))
+    trainy, paths, class_names = utils.list_dataset(data_dir, disabled=disabled)
+    keys = [file_hash(p) for p in paths]
+    trainX = embed_dataset(paths, keys)
 
     if discard_disabled == "auto":
         print("detecting outliers...")
-        trainX, trainy, paths, outliers = filter_outliers(trainX, trainy, paths)
+        trainX, trainy, filtered_paths, outliers = filter_outliers(trainX, trainy, paths, n_jobs=n_jobs)
+        keys = [k for k, p in zip(keys, paths) if p not in outliers]
+        paths = filtered_paths
         with open(disabled_file, 'w') as f:
             for x in outliers:
                 f.write(x)
                 f.write('\n')
             f.close()
 
-    model = FacerecClassifier(classifier).train(trainX, trainy)
+    model = None
+    if incremental and classifier_store.current_version(project) is not None:
+        _, (model, _) = classifier_store.load(project, mmap=False)
+        if getattr(model, 'type', None) != classifier:
+            model = None
+    if model is not None:
+        if classifier == 'ANN':
+            model.nprobe = nprobe
+        else:
+            model.n_jobs = n_jobs
+        model = model.update(trainX, trainy, keys, refit_negatives)
+    elif classifier == 'ANN':
+        model = AnnClassifier(nprobe=nprobe).train(trainX, trainy, keys)
+    else:
+        model = FacerecClassifier(classifier, n_jobs).train(trainX, trainy, keys)
 
-    # Saving classifier model
-    with open(classifier_path, 'wb') as outfile:
-        pickle.dump((model, class_names), outfile)
-    print('Saved classifier model to file "%s"' % classifier_path)
+    # Saving classifier model, as a new version
+    version = classifier_store.save(project, model, class_names)
+    print('Saved classifier model of %s, version %s' % (project, version))
+    return version
 
 
-def get_outlier_list(project):
+def get_outlier_list(project, threshold=0.1, n_jobs=1):
     data_dir = os.path.expanduser(os.path.join('data/training_img_aligned/', project))
-    trainX, trainy, paths, class_names = utils.load_dataset(data_dir)
-
-    facenet = load_model('./model/facenet_keras.h5', compile=False)
-    facenet.load_weights('./model/facenet_keras_weights.h5')
-
-    trainX = [utils.get_embedding(facenet, face_pixels) for face_pixels in trainX]
-    trainX = np.asarray(trainX)
+    trainy, paths, class_names = utils.list_dataset(data_dir)
+    trainX = embed_dataset(paths)
 
-    _, _, path, outliers = filter_outliers(trainX, trainy, paths)
+    _, _, path, outliers = filter_outliers(trainX, trainy, paths, threshold, n_jobs)
     return outliers
 
 
-def filter_outliers(x, y, paths, threshold=0.1):
+def filter_outliers(x, y, paths, threshold=0.1, n_jobs=1):
+    """
+    Detect the outliers of each class, and remove them. The classes are split among `n_jobs` processes only when
+    there is enough work to pay for starting them (`MIN_PARALLEL_WORK`).
+    """
     x = np.array(x)
     y = np.array(y)
     paths = np.array(paths)
 
     classes = np.unique(y)
+    indexes = [np.where(y == c)[0] for c in classes]
+    if sum(len(index) ** 2 for index in indexes) < MIN_PARALLEL_WORK:
+        n_jobs = 1
+    results = Parallel(n_jobs=n_jobs)(delayed(detect_outliers)(x[index], paths[index], threshold)
+                                      for index in indexes)
     to_exclude = []
     outliers = []
-    for c in classes:
-        index = np.where(y == c)[0]
-        _outliers = detect_outliers(x[index], paths[index], threshold)
+    for _outliers in results:
         for p in _outliers:
             outliers.append(p)
             to_exclude.append(np.where(paths == p)[0][0])
@@ -144,28 +383,48 @@ def filter_outliers(x, y, paths, threshold=0.1):
 
 
 def detect_outliers(embs, files, threshold=0.1):
-    # compute distances
-    d = cosine_similarity(embs)
-
-    # search for outliers
-    outliers = []
+    """
+    Remove one by one the image least similar to the mean of the class, as long as the standard deviation of the
+    pairwise cosine similarities is above `threshold`. Return the removed images, or the remaining ones if less than
+    2 are left.
 
+    The similarities are computed once: removing an image updates the sum of the similarities, the sum of their
+    squares and the similarity of each image to the sum of the embeddings.
+    """
     if len(embs) < 2:
         # full remove
         return files
 
-    while d.std() > threshold:
-        m = embs.mean(axis=0)
-        diff = np.array([cosine_similarity([x], [m]) for x in embs]).flatten()
-        to_delete = np.argmin(diff)
-        outliers.append(files[to_delete])
-        embs = np.delete(embs, to_delete, 0)
-        files = np.delete(files, to_delete, 0)
-        d = cosine_similarity(embs)
+    embs = np.asarray(embs, dtype='float64')
+    norms = np.linalg.norm(embs, axis=1)
+    units = embs / np.where(norms == 0, 1, norms)[:, None]
+    d = units @ units.T
+    squares = d * d
+    row_squares = squares.sum(axis=1)
+    total_squares = row_squares.sum()
+    total = units.sum(axis=0)  # the sum of the similarities is its squared norm
+    # the cosine similarity to the mean, times the norm of the sum of the embeddings
+    to_mean = d @ norms
+    alive = np.ones(len(embs), dtype=bool)
+    n = len(embs)
 
-        if len(embs) < 2:
+    outliers = []
+    while True:
+        mean = total @ total / (n * n)
+        if np.sqrt(max(total_squares / (n * n) - mean * mean, 0)) <= threshold:
+            break
+        to_delete = np.argmin(np.where(alive, to_mean, np.inf))
+        outliers.append(files[to_delete])
+        alive[to_delete] = False
+        n -= 1
+        total_squares -= 2 * row_squares[to_delete] - squares[to_delete, to_delete]
+        row_squares -= squares[to_delete]
+        total -= units[to_delete]
+        to_mean -= d[:, to_delete] * norms[to_delete]
+
+        if n < 2:
             # full remove
-            return files
+            return np.asarray(files)[alive]
 
     return outliers
 
@@ -173,7 +432,7 @@ def detect_outliers(embs, files, threshold=0.1):
 def parse_arguments(argv):
     parser = argparse.ArgumentParser()
     parser.add_argument('--classifier', type=str,
-                        choices=['KNN', 'SVM', 'RF', 'Softmax'],
+                        choices=['KNN', 'SVM', 'RF', 'Softmax', 'ANN'],
                         help='The type of classifier to use.',
                         default='SVM')
     parser.add_argument('--project', type=str, default='general',
@@ -181,10 +440,20 @@ def parse_arguments(argv):
     parser.add_argument('--discard_disabled', default="false",
                         help='If "true", skip the images in the file "disabled.txt". '
                              'If "auto", automatically detect and discard outliers')
+    parser.add_argument('--incremental', default=False, action='store_true',
+                        help='If specified, refit only the classes whose images changed since the last training')
+    parser.add_argument('--refit_negatives', default=False, action='store_true',
+                        help='With --incremental, refit all the classes when something changed, not only the ones '
+                             'whose margin is crossed by the new images')
+    parser.add_argument('--n_jobs', type=int, default=-1,
+                        help='Number of processes fitting the classes. By default, one per core')
+    parser.add_argument('--nprobe', type=int, default=8,
+                        help='With the ANN classifier, number of lists of the index scanned for each face')
 
     return parser.parse_args(argv)
 
 
 if __name__ == '__main__':
     args = parse_arguments(sys.argv[1:])
-    main(args.classifier, args.project, args.discard_disabled)
+    main(args.classifier, args.project, args.discard_disabled, args.incremental, args.refit_negatives, args.n_jobs,
+         args.nprobe)
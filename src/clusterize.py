@@ -29,6 +29,17 @@ def update_rect_in(previous_cluster, rects):
     previous_cluster['bounding'] = rect2xywh(*avg_rect)
 
 
+def dominant_name(predicted, confidences, dominant_ratio=0.6, weighted_dominant_ratio=0.4):
+    """The name of a track, if it dominates its predictions both by count and by confidence. Otherwise ''."""
+    name = ""
+    dominant, count = weighted_mode(predicted, confidences)
+    dominant2, count2 = mode(predicted)
+    if count[0] / float(len(predicted)) > weighted_dominant_ratio and dominant[0] == dominant2[0] and count2[
+        0] / float(len(predicted)) > dominant_ratio:
+        name = dominant[0]
+    return name
+
+
 # predictions is a pandas dataframe
 def main(predictions, confidence_threshold=0.7, dominant_ratio=0.6, weighted_dominant_ratio=0.4, merge_cluster=False,
          min_length=1):
@@ -46,12 +57,7 @@ def main(predictions, confidence_threshold=0.7, dominant_ratio=0.6, weighted_dom
         involved = predictions[predictions.track_id == track]
         confidences = involved.confidence.values.tolist()
         predicted = involved.name.values.tolist()
-        name = ""
-        dominant, count = weighted_mode(predicted, confidences)
-        dominant2, count2 = mode(predicted)
-        if count[0] / float(len(predicted)) > weighted_dominant_ratio and dominant[0] == dominant2[0] and count2[
-            0] / float(len(predicted)) > dominant_ratio:
-            name = dominant[0]
+        name = dominant_name(predicted, confidences, dominant_ratio, weighted_dominant_ratio)
         interest_cluster.update({track: name})
 
     known_persons = list(set([j for i, j in interest_cluster.items() if j]))
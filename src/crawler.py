@@ -39,11 +39,11 @@ def main(keyword, max_num=50, project='general', discard_multi_face=False, debug
 
     detector = FaceDetector(detect_multiple_faces=True)
 
-    for f in sorted(os.listdir(image_dir)):
+    files = sorted(os.listdir(image_dir))
+    images = [utils.load_gray(os.path.join(image_dir, f)) for f in files]
+    for f, extracted_faces in zip(files, detector.extract_batch(images)):
         filename = f.rsplit('.', 1)[0]
         print(filename)
-        image = utils.load_gray(os.path.join(image_dir, f))
-        extracted_faces = detector.extract(image)
         if discard_multi_face and len(extracted_faces) > 1:
             continue
         for i, face in enumerate(extracted_faces):
@@ -55,13 +55,15 @@ def clean_invalid_states():
     db.status.remove({'status': Status.RUNNING.value})
 
 
-def save_status(uri, project, status):
+def save_status(uri, project, status, classifier_version=None):
     update = {
         'locator': uri,
         'project': project,
         'status': Status[status].value,
         'timestamp': now()
     }
+    if classifier_version is not None:
+        update['classifier_version'] = classifier_version
 
     return db.status.replace_one({'locator': uri, 'project': project}, update, upsert=True)
 
@@ -73,11 +75,22 @@ def get_status(uri, project):
     return Status(s.get('status', 0))
 
 
+def get_classifier_version(uri, project):
+    """The version of the classifier of the last analysis, None if unknown"""
+    s = db.status.find_one({'locator': uri, 'project': project})
+    return s.get('classifier_version') if s is not None else None
+
+
 def clean_analysis(uri, project):
     db.feat_cluster.remove({'video': uri, 'project': project})
     return db.track.remove({'locator': uri, 'project': project})
 
 
+def clean_analysis_after(uri, project, frame):
+    """Remove the tracks found after `frame`, when a job resumes from a checkpoint"""
+    return db.track.remove({'locator': uri, 'project': project, 'frame': {'$gt': frame}})
+
+
 def insert_partial_analysis(track):
     return db.track.insert_one(track)
 
@@ -104,6 +117,7 @@ def get_all_about(uri, project):
         if status and status != Status.ERROR:
             v['status'] = status.name
             v['project'] = project
+            v['classifier_version'] = get_classifier_version(locator, project)
             v['tracks'] = get_analysis(locator, project)
             v['feat_clusters'] = get_feat_cluster(locator, project)
 
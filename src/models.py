@@ -0,0 +1,213 @@
+"""
+Process-wide registry of the models: FaceNet, MTCNN and the classifiers of the projects.
+FaceNet and MTCNN run in Keras, or converted to TFLite with a reduced precision (see `utils.lite`).
+
+Each model is loaded once per process, the first time it is needed, and shared by all the trackers and the training.
+The models are only read after loading, so the handles can be used from several threads; the loading itself is
+serialised by a lock. A new version of a classifier replaces the previous one in the registry, while the jobs
+already using the previous one keep it.
+The registry keeps the load time and the growth of the resident memory caused by each model.
+"""
+import os
+import pickle
+import threading
+import time
+
+import numpy as np
+
+from .utils import config, lite, classifier_store
+from .utils.embedding_store import model_version
+
+FACENET_MODEL = './model/facenet_keras.h5'
+FACENET_WEIGHTS = './model/facenet_keras_weights.h5'
+
+_lock = threading.RLock()
+_handles = {}
+
+
+def rss():
+    """Resident memory of the process, in bytes"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Handle:
+    def __init__(self, name, loader, warm_up=None, version=None):
+        self.name = name
+        self.version = version
+        self._loader = loader
+        self._warm_up = warm_up
+        self._model = None
+        self.load_time = None
+        self.warm_up_time = None
+        self.memory = None  # growth of the resident memory while loading
+        self.uses = 0
+
+    @property
+    def loaded(self):
+        return self._model is not None
+
+    @property
+    def model(self):
+        """The model, loaded if needed"""
+        if self._model is None:
+            with _lock:
+                if self._model is None:
+                    before = rss()
+                    start = time.time()
+                    model = self._loader()
+                    self.load_time = time.time() - start
+                    self.memory = rss() - before
+                    self._model = model
+                    print('Loaded %s in %.1fs (%+.0f MB)' % (self.name, self.load_time, self.memory / 2 ** 20))
+        self.uses += 1
+        return self._model
+
+    def warm_up(self):
+        """Load the model and run it once, so that the first request does not pay for the graph tracing"""
+        model = self.model
+        if self._warm_up is not None and self.warm_up_time is None:
+            start = time.time()
+            self._warm_up(model)
+            self.warm_up_time = time.time() - start
+        return self
+
+    def report(self):
+        return {
+            'name': self.name,
+            'loaded': self.loaded,
+            'load_time': self.load_time,
+            'warm_up_time': self.warm_up_time,
+            'memory_mb': self.memory / 2 ** 20 if self.memory is not None else None,
+            'uses': self.uses,
+        }
+
+
+def get(name, loader, warm_up=None, version=None):
+    """The handle of a model. A handle of another `version` replaces the previous one."""
+    with _lock:
+        handle = _handles.get(name)
+        if handle is None or handle.version != version:
+            handle = _handles[name] = Handle(name, loader, warm_up, version)
+        return handle
+
+
+def facenet(model_path=FACENET_MODEL, weights_path=FACENET_WEIGHTS, precision=None):
+    """FaceNet, in Keras or with the reduced `precision` of `lite.PRECISIONS`"""
+    precision = _precision(precision)
+
+    def load_keras():
+        from tensorflow.keras.models import load_model
+        model = load_model(model_path, compile=False)
+        model.load_weights(weights_path)
+        return model
+
+    def load():
+        if not precision:
+            return load_keras()
+        return lite.load('facenet', load_keras, model_version(model_path, weights_path), precision)
+
+    def warm_up(model):
+        model.predict(np.zeros((1, 160, 160, 3), dtype='float32'))
+
+    return get(_name('facenet:%s' % model_path, precision), load, warm_up)
+
+
+def mtcnn(min_face_size=20, precision=None):
+    """MTCNN, whose networks run in Keras or with the reduced `precision` of `lite.PRECISIONS`"""
+    precision = _precision(precision)
+
+    def load():
+        from mtcnn import MTCNN
+        import mtcnn as package
+        detector = MTCNN(min_face_size=min_face_size)
+        if precision:
+            version = model_version(os.path.join(os.path.dirname(package.__file__), 'data', 'mtcnn_weights.npy'))
+            for net in ('pnet', 'rnet', 'onet'):
+                keras_net = getattr(detector, '_' + net)
+                setattr(detector, '_' + net, lite.load('mtcnn-' + net, lambda: keras_net, version, precision))
+        return detector
+
+    def warm_up(model):
+        model.detect_faces(np.zeros((160, 160, 3), dtype='uint8'))
+
+    return get(_name('mtcnn:%d' % min_face_size, precision), load, warm_up)
+
+
+def _precision(precision):
+    # None, empty or 'keras' for the original models
+    return None if not precision or precision == 'keras' else precision
+
+
+def detection_precision(precision):
+    """
+    The precision of MTCNN for the `inference` setting of a project. Its int8 networks move the boxes too much
+    (mean IoU 0.91 with the Keras ones, see `benchmark.inference_backends`), so int8 applies to FaceNet only.
+    """
+    if precision == 'int8':
+        print('Warning: the int8 inference is for FaceNet only, MTCNN runs with float16')
+        return 'float16'
+    return precision
+
+
+def _name(name, precision):
+    return '%s:%s' % (name, precision) if precision else name
+
+
+def classifier(path):
+    """The (classifier, class names) pickled at `path`"""
+    path = os.path.expanduser(path)
+
+    def load():
+        with open(path, 'rb') as f:
+            (model, class_names) = pickle.load(f)
+        print("Loaded classifier file: %s" % path)
+        _compile(model)
+        return model, class_names
+
+    return get('classifier:%s' % path, load, version=os.stat(path).st_mtime_ns)
+
+
+def project_classifier(project, version=None):
+    """The (classifier, class names) of a version of the classifier of `project`, by default the current one"""
+    if version is None:
+        version = classifier_store.current_version(project)
+
+    def load():
+        _, (model, class_names) = classifier_store.load(project, version)
+        print("Loaded classifier %s of %s" % (version, project))
+        _compile(model)
+        return model, class_names
+
+    return get('classifier:%s' % project, load, version=version)
+
+
+def _compile(model):
+    if hasattr(model, 'compile') and getattr(model, 'compiled_', None) is None:
+        # classifiers saved before the compiled inference
+        model.compile()
+
+
+def warm_up(projects=()):
+    """Load and run the FaceNet, the MTCNN of the tracker and the classifier of the `projects`"""
+    handles = {}
+    for project in projects:
+        precision = config.project_settings(project).get('inference')
+        for handle in (facenet(precision=precision), mtcnn(25, detection_precision(precision))):
+            handles[handle.name] = handle
+        if classifier_store.current_version(project) is not None:
+            handle = project_classifier(project)
+            handles[handle.name] = handle
+    for handle in handles.values():
+        handle.warm_up()
+    print('Warmed up %d models, %.0f MB of resident memory' % (len(handles), rss() / 2 ** 20))
+
+
+def report():
+    with _lock:
+        handles = list(_handles.values())
+    return {'rss_mb': rss() / 2 ** 20, 'models': [h.report() for h in handles]}
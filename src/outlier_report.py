@@ -0,0 +1,92 @@
+"""
+Cached reports of the outliers among the training images of a project.
+
+A report is saved with the version of the dataset it was computed on. The version comes from the stats of the
+images and of the FaceNet model, not from their content, so that checking a report takes milliseconds.
+A missing or outdated report is recomputed in a background thread, from the embedding store: only the new images
+go through FaceNet.
+"""
+import hashlib
+import json
+import os
+import threading
+
+from . import classifier
+from .utils import utils
+
+ROOT = 'data/outliers'
+TRAINING_IMG = 'data/training_img_aligned'
+
+_lock = threading.Lock()
+_refreshing = set()  # the projects with a refresh running
+
+
+def path(project):
+    return os.path.join(ROOT, project + '.json')
+
+
+def dataset_version(project, threshold=0.1):
+    _, paths, _ = utils.list_dataset(os.path.join(TRAINING_IMG, project))
+    h = hashlib.sha1(('threshold %g\n' % threshold).encode())
+    for p in paths + [classifier.FACENET_MODEL, classifier.FACENET_WEIGHTS]:
+        stat = os.stat(p)
+        h.update(('%s %d %d\n' % (p, stat.st_size, stat.st_mtime_ns)).encode())
+    return h.hexdigest()
+
+
+def load(project):
+    """The saved report, or None"""
+    if not os.path.isfile(path(project)):
+        return None
+    with open(path(project)) as f:
+        return json.load(f)
+
+
+def save(project, report):
+    os.makedirs(ROOT, exist_ok=True)
+    tmp = path(project) + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(report, f)
+    os.replace(tmp, path(project))
+
+
+def compute(project, threshold=0.1):
+    """Compute and save the report of the current dataset. Return it."""
+    version = dataset_version(project, threshold)
+    outliers = classifier.get_outlier_list(project, threshold)
+    report = {'version': version, 'outliers': [str(p) for p in outliers]}
+    save(project, report)
+    print('Outlier report of %s: %d outliers' % (project, len(outliers)))
+    return report
+
+
+def refresh(project, threshold=0.1):
+    """Compute the report in a background thread, unless it is already being computed. Return True if started."""
+    with _lock:
+        if project in _refreshing:
+            return False
+        _refreshing.add(project)
+
+    def run():
+        try:
+            compute(project, threshold)
+        except Exception as e:
+            print('Outlier report of %s failed: %s' % (project, e))
+        finally:
+            with _lock:
+                _refreshing.discard(project)
+
+    threading.Thread(target=run, daemon=True).start()
+    return True
+
+
+def get(project, threshold=0.1):
+    """
+    The outliers of the last report and whether it is up to date.
+    An outdated report is returned as is, while refreshing it; without any report, the outliers are None.
+    """
+    report = load(project)
+    if report is not None and report['version'] == dataset_version(project, threshold):
+        return report['outliers'], True
+    refresh(project, threshold)
+    return (report['outliers'] if report is not None else None), False
@@ -0,0 +1,176 @@
+"""
+A multi-stage pipeline with bounded queues between the stages.
+
+Every stage runs in its own thread(s), so that decoding, detection and recognition can overlap.
+Each item is numbered at the source: stages declared as `ordered` process the items in their original order,
+and the pipeline yields the results in the same order of the input, whatever the number of workers.
+"""
+import queue
+import threading
+import time
+
+_END = object()
+
+
+class _Failure:
+    def __init__(self, error):
+        self.error = error
+
+
+class Stage:
+    def __init__(self, name, function, workers=1, ordered=False):
+        if ordered and workers != 1:
+            raise ValueError('The ordered stage %s can not have more than one worker' % name)
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.ordered = ordered
+
+        self.items = 0
+        self.busy = 0.  # seconds spent in `function`, summed over the workers
+        self.queue_max = 0
+        self.queue_total = 0
+        self._lock = threading.Lock()
+
+    def record(self, elapsed, queue_depth):
+        with self._lock:
+            self.items += 1
+            self.busy += elapsed
+            self.queue_max = max(self.queue_max, queue_depth)
+            self.queue_total += queue_depth
+
+    def stats(self, wall_time):
+        return {
+            'workers': self.workers,
+            'items': self.items,
+            'busy': self.busy,
+            'utilisation': self.busy / (wall_time * self.workers) if wall_time > 0 else 0.,
+            'queue_max': self.queue_max,
+            'queue_mean': self.queue_total / self.items if self.items else 0.,
+        }
+
+
+class Pipeline:
+    def __init__(self, source_name, stages, queue_size=8):
+        """
+        :param source_name: the name of the stage that consumes the input iterable
+        :param stages: list of `Stage`, applied in order to each item
+        :param queue_size: max number of items waiting in front of each stage
+        """
+        self.source = Stage(source_name, None)
+        self.stages = stages
+        self.queue_size = queue_size
+        self.wall_time = 0.
+        self._stop = threading.Event()
+
+    def run(self, items):
+        """Yield the results for each of the `items`, in the same order."""
+        self._stop.clear()
+        start = time.time()
+        queues = [queue.Queue(self.queue_size) for _ in range(len(self.stages) + 1)]
+
+        threads = [threading.Thread(target=self._feed, args=(items, queues[0]), daemon=True)]
+        for i, stage in enumerate(self.stages):
+            remaining = [stage.workers]
+            for _ in range(stage.workers):
+                threads.append(threading.Thread(target=self._work, daemon=True,
+                                                args=(stage, queues[i], queues[i + 1], remaining)))
+        for t in threads:
+            t.start()
+
+        try:
+            for _, result in self._reorder(queues[-1], None):
+                if isinstance(result, _Failure):
+                    raise result.error
+                yield result
+        finally:
+            self._stop.set()
+            self.wall_time = time.time() - start
+
+    def stats(self):
+        return {s.name: s.stats(self.wall_time) for s in [self.source] + self.stages}
+
+    def summary(self):
+        lines = []
+        for name, s in self.stats().items():
+            lines.append('%-10s workers: %d | items: %d | utilisation: %5.1f%% | queue max: %d, mean: %.1f' % (
+                name, s['workers'], s['items'], s['utilisation'] * 100, s['queue_max'], s['queue_mean']))
+        return '\n'.join(lines)
+
+    def _put(self, q, item):
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, q):
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _END
+
+    def _feed(self, items, output):
+        iterator = iter(items)
+        seq = 0
+        while True:
+            t = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            except Exception as e:
+                self._put(output, (seq, _Failure(e)))
+                break
+            self.source.record(time.time() - t, 0)
+            if not self._put(output, (seq, item)):
+                return
+            seq += 1
+        self._put(output, _END)
+
+    def _reorder(self, input_queue, stage):
+        """Read from the queue, returning the items by sequence number when the stage is ordered"""
+        pending = {}
+        expected = 0
+        ordered = stage is None or stage.ordered
+        while True:
+            entry = self._get(input_queue)
+            if entry is _END:
+                break
+            if not ordered:
+                yield entry
+                continue
+            seq, item = entry
+            pending[seq] = item
+            while expected in pending:
+                yield expected, pending.pop(expected)
+                expected += 1
+        for seq in sorted(pending):
+            yield seq, pending.pop(seq)
+        if stage is not None:
+            # wake up the other workers of this stage
+            self._put(input_queue, _END)
+
+    def _work(self, stage, input_queue, output_queue, remaining):
+        for entry in self._reorder(input_queue, stage):
+            seq, item = entry
+            if not isinstance(item, _Failure):
+                depth = input_queue.qsize()
+                t = time.time()
+                try:
+                    item = stage.function(item)
+                except Exception as e:
+                    item = _Failure(e)
+                stage.record(time.time() - t, depth)
+            if not self._put(output_queue, (seq, item)):
+                return
+
+        with stage._lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            self._put(output_queue, _END)
@@ -0,0 +1,292 @@
+"""
+Sharded analysis of a single video.
+
+The sampled frames are split in N contiguous ranges, analysed in parallel by a pool of processes (one `Tracker` per
+process). The shards are then stitched: a track alive at the end of a shard continues in the next one if it matches
+a track starting there, by box overlap and embedding similarity. Track ids and tracker samples are renumbered,
+so that the outputs look like the ones of a single run.
+"""
+import argparse
+import csv
+import multiprocessing
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+from . import database, FaceRecogniser
+from .SORT.data_association import iou
+from .tracker import Tracker, parse_fragment
+from .utils import utils, frame_source, classifier_store
+
+_tracker = None  # the Tracker of a worker process
+
+
+def split_frames(frames, shards):
+    """Split the sampled frames in (start, end) ranges, so that each shard samples exactly the same frames."""
+    bounds = [len(frames) * i // shards for i in range(shards)]
+    bounds = sorted(set(bounds))
+    ranges = []
+    for i, b in enumerate(bounds):
+        start = frames[b]
+        end = frames[bounds[i + 1]] if i + 1 < len(bounds) else frames[-1] + 1
+        ranges.append((start, end))
+    return ranges
+
+
+def _init_worker(project, threads):
+    global _tracker
+    # share the cores among the workers
+    cv2.setNumThreads(threads)
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    _tracker = Tracker(project)
+
+
+def _run_shard(task):
+    video_path, index, frame_range, output_dir, cluster_features, kwargs = task
+    _tracker.classifier.features = []
+    _tracker.classifier.meta = []
+    matches = _tracker.run(video_path, frame_range=frame_range, output_dir=output_dir, cluster_features=False,
+                           collect_features=cluster_features, verbose=False, **kwargs)
+    print('Shard %d done: frames %d-%d' % (index, frame_range[0], frame_range[1]))
+    return {
+        'output_dir': output_dir,
+        'matches': matches,
+        'samples': _tracker.tracker_samples,
+        'track_ends': _tracker.track_ends,
+        'features': _tracker.classifier.features,
+        'meta': _tracker.classifier.meta,
+        'classifier_version': _tracker.classifier.version,
+    }
+
+
+def _similarity(a, b):
+    if a is None or b is None:
+        return None
+    return np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
+
+
+def match_tracks(previous, current, min_iou=0.25, min_similarity=0.5):
+    """
+    Match the tracks alive at the end of the `previous` shard with the tracks starting the `current` shard.
+    Return a dict {current track: previous track}.
+    """
+    ending = [t for t, e in previous['track_ends'].items() if e['last_sample'] == previous['samples']]
+    starting = [t for t, e in current['track_ends'].items() if e['first_sample'] == 1]
+    if len(ending) == 0 or len(starting) == 0:
+        return {}
+
+    score = np.full((len(ending), len(starting)), -1.)
+    for i, a in enumerate(ending):
+        end = previous['track_ends'][a]
+        for j, b in enumerate(starting):
+            start = current['track_ends'][b]
+            overlap = iou(end['last_box'], start['first_box'])
+            similarity = _similarity(end['last_embedding'], start['first_embedding'])
+            if overlap < min_iou or (similarity is not None and similarity < min_similarity):
+                continue
+            score[i, j] = overlap + (similarity if similarity is not None else 0)
+
+    rows, cols = linear_sum_assignment(-score)
+    return {starting[j]: ending[i] for i, j in zip(rows, cols) if score[i, j] >= 0}
+
+
+def stitch(shards, min_iou=0.25, min_similarity=0.5):
+    """
+    Assign a global id to the tracks of all the shards.
+    Return, for each shard, the map {local track id: global track id} and the offset of its tracker samples.
+    """
+    mappings = []
+    offsets = []
+    next_id = 0
+    offset = 0
+    for i, shard in enumerate(shards):
+        continued = match_tracks(shards[i - 1], shard, min_iou, min_similarity) if i > 0 else {}
+        mapping = {}
+        for track in sorted(shard['track_ends'], key=lambda t: (shard['track_ends'][t]['first_sample'], t)):
+            if track in continued:
+                mapping[track] = mappings[-1][continued[track]]
+            else:
+                mapping[track] = next_id
+                next_id += 1
+        mappings.append(mapping)
+        offsets.append(offset)
+        offset += shard['samples']
+    return mappings, offsets
+
+
+def _merge_csv(name, shards, mappings, offsets, output_path, sample_column=None):
+    with open(os.path.join(output_path, name), 'w') as out:
+        writer = csv.writer(out, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        for i, (shard, mapping, offset) in enumerate(zip(shards, mappings, offsets)):
+            with open(os.path.join(shard['output_dir'], name)) as f:
+                reader = csv.reader(f)
+                header = next(reader)
+                if i == 0:
+                    writer.writerow(header)
+                track_column = header.index('track_id')
+                for row in reader:
+                    row[track_column] = str(mapping[int(row[track_column])])
+                    if sample_column is not None:
+                        column = header.index(sample_column)
+                        row[column] = str(int(row[column]) + offset)
+                    writer.writerow(row)
+
+
+def _move_files(shards, mappings, offsets, output_path):
+    """Move the face crops and the exported frames of the shards, renaming them with the global ids"""
+    for shard, mapping, offset in zip(shards, mappings, offsets):
+        cluster_path = os.path.join(shard['output_dir'], 'cluster')
+        if os.path.isdir(cluster_path):
+            for track in os.listdir(cluster_path):
+                if int(track) not in mapping:
+                    # a track never written in the outputs
+                    continue
+                dst = os.path.join(output_path, 'cluster', str(mapping[int(track)]))
+                os.makedirs(dst, exist_ok=True)
+                for file in os.listdir(os.path.join(cluster_path, track)):
+                    sample = int(os.path.splitext(file)[0])
+                    shutil.move(os.path.join(cluster_path, track, file),
+                                os.path.join(dst, '%d.jpg' % (sample + offset)))
+
+        frames_path = os.path.join(shard['output_dir'], 'frames')
+        if os.path.isdir(frames_path):
+            dst = os.path.join(output_path, 'frames')
+            os.makedirs(dst, exist_ok=True)
+            for file in os.listdir(frames_path):
+                # frame_<frame>.t<track>.jpg
+                frame, track = file[len('frame_'):-len('.jpg')].rsplit('.t', 1)
+                shutil.move(os.path.join(frames_path, file),
+                            os.path.join(dst, 'frame_%s.t%d.jpg' % (frame, mapping[int(track)])))
+
+
+def run(video_path, project='general', workers=None, shards=None, video_speedup=25, fragment=None, video_id=None,
+        cluster_features=True, min_iou=0.25, min_similarity=0.5, keep_shards=False, verbose=True, **kwargs):
+    """
+    Analyse a video with `workers` processes, splitting it in `shards` ranges (by default, one per worker).
+    The other `kwargs` are given to `Tracker.run`. Return the matches, as `Tracker.run`.
+    """
+    if not video_id:
+        video_id = video_path
+    if workers is None:
+        workers = os.cpu_count()
+    if shards is None:
+        shards = workers
+
+    video_capture = cv2.VideoCapture(video_path)
+    fps = video_capture.get(cv2.CAP_PROP_FPS)
+    frame_start = 0
+    frame_end = int(video_capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    video_capture.release()
+    if fragment is not None:
+        frame_start, frame_end = parse_fragment(fragment, fps)
+
+    # with adaptive sampling, align the shards on the probed frames
+    step = kwargs.get('min_stride', 5) if kwargs.get('sampling') == 'adaptive' else video_speedup
+    frames = frame_source.sample_frames(frame_start, frame_end, step)
+    ranges = split_frames(frames, shards)
+
+    output_path = utils.generate_output_path('./data/out', project, video_id)
+    shards_path = os.path.join(output_path, 'shards')
+    kwargs['video_speedup'] = video_speedup
+    kwargs['video_id'] = video_id
+    # all the shards with the same classifier, even if a new one is trained meanwhile
+    kwargs['classifier_version'] = classifier_store.current_version(project)
+    tasks = [(video_path, i, r, os.path.join(shards_path, '%03d' % i), cluster_features, kwargs)
+             for i, r in enumerate(ranges)]
+
+    threads = max(1, os.cpu_count() // workers)
+    if verbose:
+        print('Analysing %d shards with %d workers' % (len(tasks), workers))
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_worker, initargs=(project, threads)) as executor:
+        results = list(executor.map(_run_shard, tasks))
+
+    return merge(results, project, video_id, output_path, cluster_features, min_iou, min_similarity, keep_shards,
+                 verbose)
+
+
+def merge(shards, project, video_id, output_path, cluster_features=True, min_iou=0.25, min_similarity=0.5,
+          keep_shards=False, verbose=True):
+    """Stitch the results of the shards and write the outputs of the whole video"""
+    mappings, offsets = stitch(shards, min_iou, min_similarity)
+    if verbose:
+        stitched = sum(len(s['track_ends']) for s in shards) - len(set(t for m in mappings for t in m.values()))
+        print('Stitched %d tracks across %d shard boundaries' % (stitched, len(shards) - 1))
+
+    _merge_csv('trackers.csv', shards, mappings, offsets, output_path)
+    _merge_csv('predictions.csv', shards, mappings, offsets, output_path, 'tracker_sample')
+    _move_files(shards, mappings, offsets, output_path)
+
+    matches = []
+    features = []
+    meta = []
+    for shard, mapping, offset in zip(shards, mappings, offsets):
+        for match in shard['matches']:
+            match['track_id'] = mapping[match['track_id']]
+            match['tracker_sample'] += offset
+            matches.append(match)
+        features.extend(shard['features'])
+        meta.extend([frame_no, mapping[int(track)], bb, ld] for frame_no, track, bb, ld in shard['meta'])
+
+    if database.is_on():
+        for match in matches:
+            database.insert_partial_analysis(match)
+        database.save_status(video_id, project, 'COMPLETE', shards[0]['classifier_version'])
+
+    if not keep_shards:
+        shutil.rmtree(os.path.join(output_path, 'shards'), ignore_errors=True)
+
+    if cluster_features and len(features) > 1:
+        if verbose:
+            print('Feature clustering started')
+        clus = FaceRecogniser.cluster_features(features, meta)
+        for c in clus:
+            c['video'] = video_id
+            c['project'] = project
+        if database.is_on():
+            database.insert_feat_cluster(clus)
+
+    if verbose:
+        print('COMPLETE')
+    return matches
+
+
+def parse_args():
+    """Parse input arguments."""
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-v', '--video', type=str, required=True,
+                        help='Path or URI of the video to be analysed.')
+    parser.add_argument('--project', type=str, default='general',
+                        help='Name of the collection to be part of')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Number of processes. By default, one per core')
+    parser.add_argument('--shards', type=int, default=None,
+                        help='Number of time ranges of the video. By default, one per worker')
+    parser.add_argument('--video_speedup', type=int, default=25,
+                        help='Speed up for the video')
+    parser.add_argument('--export_frames', default=False, action='store_true',
+                        help='If specified, export the annotated frames')
+    parser.add_argument('--min_iou', type=float, default=0.25,
+                        help='Min overlap of the boxes for continuing a track in the next shard')
+    parser.add_argument('--min_similarity', type=float, default=0.5,
+                        help='Min cosine similarity of the embeddings for continuing a track in the next shard')
+    parser.add_argument('--keep_shards', default=False, action='store_true',
+                        help='If specified, keep the outputs of the single shards')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    from .utils import uri_utils
+
+    video = uri_utils.normalize_video(args.video)
+
+    run(video, args.project, args.workers, args.shards, args.video_speedup, export_frames=args.export_frames,
+        min_iou=args.min_iou, min_similarity=args.min_similarity, keep_shards=args.keep_shards)
@@ -1,16 +1,21 @@
 import argparse
 import csv
 import os
+import pickle
 
 import cv2
 import numpy as np
 
-from . import database
+from . import database, models, pipeline
+from .clusterize import dominant_name
 from .FaceRecogniser import Classifier
 from .FaceDetector import FaceDetector
 from .FaceAligner import FaceAligner
+from .SORT.data_association import iou
+from .SORT.kalman_tracker import KalmanBoxTracker
 from .SORT.sort import Sort
-from .utils import utils, media_fragment
+from .SORT.sort_utils import CropWriter
+from .utils import utils, media_fragment, frame_source, checkpoint, config, classifier_store
 from .utils.face_utils import judge_side_face
 
 colours = np.random.rand(32, 3)
@@ -33,11 +38,22 @@ def export_frame(input_frame, d, classname, frame_num, frames_path):
 
 
 def init_csv(path, fieldnames):
-    file = open(path, 'w')
+    return open_csv(path, fieldnames)[1]
+
+
+def open_csv(path, fieldnames, offset=None):
+    """Open a csv output. With `offset`, continue the file from there, dropping what was written after."""
+    if offset is None:
+        file = open(path, 'w')
+    else:
+        file = open(path, 'r+')
+        file.truncate(offset)
+        file.seek(offset)
     writer = csv.writer(file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-    writer.writerow(fieldnames)
+    if offset is None:
+        writer.writerow(fieldnames)
     file_to_be_close.append(file)
-    return writer
+    return file, writer
 
 
 def parse_fragment(fragment, fps):
@@ -45,96 +61,517 @@ def parse_fragment(fragment, fps):
     return frag['startNormalized'] * fps, frag['endNormalized'] * fps
 
 
-def main(video_path, project='general', video_speedup=25, export_frames=False, fragment=None, video_id=None):
+def main(video_path, project='general', video_speedup=25, export_frames=False, fragment=None, video_id=None,
+         **kwargs):
     if not video_id:
         video_id = video_path
     t = Tracker(project)
-    t.run(video_path, video_speedup, export_frames, fragment, video_id)
+    t.run(video_path, video_speedup, export_frames, fragment, video_id, **kwargs)
+
+
+class FrameAnalysis:
+    """What is known about a sampled frame, while it moves through the stages of the tracker"""
+
+    def __init__(self, frame_no):
+        self.frame_no = frame_no
+        self.frame = None
+        self.rgb_frame = None
+        self.detected = False  # False if the detector did not run, and the tracks are moved by their motion model
+        self.face_list = []  # detected boxes
+        self.attribute_list = []  # attributes of each detected box
+        self.tracker_sample = None
+        self.faces = []  # (box with track id, landmarks, dist_rate) of the tracked faces in the image
+        self.recognised = []  # True for each tracked face that went through the classifier
+        self.detection_embeddings = None  # embeddings of the detected boxes, with the appearance-aware tracking
+        self.face_embeddings = []  # embedding of the detection of each tracked face, with the appearance-aware tracking
+        self.embeddings = None  # embeddings of the recognised faces
+        self.predictions = []  # (name, prob) of each tracked face, None if not recognised
+        self.snapshot = None  # the state of the tracks after this frame, when a checkpoint is due
+
+
+class TrackIdentity:
+    """The running vote on the name of a track. Once the vote is stable, the track does not need to be recognised."""
+
+    def __init__(self):
+        self.names = []
+        self.confidences = []
+        self.name = ''  # the dominant name, '' while the vote is not stable
+        self.box = None  # the box of the last recognition
+        self.skipped = 0  # samples since the last recognition
+
+    def vote(self, name, prob, box, min_votes):
+        self.names.append(name)
+        self.confidences.append(prob)
+        self.box = box
+        self.skipped = 0
+        if len(self.names) >= min_votes:
+            self.name = dominant_name(self.names, self.confidences)
+        else:
+            self.name = ''
+
+    def needs_recognition(self, box, reverify_every, reverify_iou):
+        return not self.name or self.skipped >= reverify_every or iou(box, self.box) < reverify_iou
+
+    def label(self):
+        """(name, prob) to emit when the track is not recognised"""
+        if not self.names:
+            return None
+        if not self.name:
+            return self.names[-1], self.confidences[-1]
+        prob = np.mean([c for n, c in zip(self.names, self.confidences) if n == self.name])
+        return self.name, prob
+
+
+class TrackingJob:
+    """The state of a run of the tracker on a video"""
+    COUNTERS = ['detections', 'early_detections', 'coasted', 'recognitions', 'skipped_recognitions']
+
+    def __init__(self, video_id, output_path, fps, scale_rate, frame_end, export_frames, recognition_batch_size,
+                 detect_every=1, identity_votes=0, reverify_every=25, reverify_iou=0.5, checkpoint_every=0,
+                 state=None, detection_scale=1., appearance_weight=0., min_similarity=0.6, save_crops=False,
+                 crop_top_k=0, sampling=None):
+        self.video_id = video_id
+        self.output_path = output_path
+        self.fps = fps
+        self.scale_rate = scale_rate
+        self.detection_scale = detection_scale
+        self.frame_end = frame_end
+        self.export_frames = export_frames
+        self.recognition_batch_size = recognition_batch_size
+        self.detect_every = detect_every
+        self.identity_votes = identity_votes
+        self.reverify_every = reverify_every
+        self.reverify_iou = reverify_iou
+        self.appearance_weight = appearance_weight
+        self.sampling = sampling  # arguments of the frame sampling, a checkpoint is resumed only with the same
+
+        self.cluster_path = os.path.join(output_path, 'cluster')
+        self.frames_path = os.path.join(output_path, 'frames')
+        if export_frames:
+            os.makedirs(self.frames_path, exist_ok=True)
+
+        # init csv outputs
+        offsets = state['offsets'] if state is not None else {}
+        self.trackers_file, self.trackers_writer = open_csv(
+            os.path.join(output_path, 'trackers.csv'), ['x1', 'y1', 'x2', 'y2', 'track_id', 'frame'],
+            offsets.get('trackers.csv'))
+        self.predictions_file, self.predictions_writer = open_csv(
+            os.path.join(output_path, 'predictions.csv'), ['x1', 'y1', 'x2', 'y2', 'track_id', 'name',
+                                                           'confidence', 'frame', 'tracker_sample', 'npt'],
+            offsets.get('predictions.csv'))
+
+        # init tracker
+        self.sort = Sort(min_hits=0, appearance_weight=appearance_weight, min_similarity=min_similarity)
+        self.matches = []
+        self.track_labels = {}  # last recognised (name, prob) of each track
+
+        self.detections = 0  # samples on which the detector ran
+        self.early_detections = 0  # of which because a predicted box was leaving the image
+        self.coasted = 0  # samples on which the tracks moved with the motion model
+
+        self.track_ends = {}  # first and last observation of each track, for stitching the shards of a video
+        self.identities = {}  # TrackIdentity of each track, when the recognition early-stopping is on
+        self.recognitions = 0  # faces that went through the classifier
+        self.skipped_recognitions = 0  # detected faces not recognised because their track was stable
+
+        self.journal_end = 0  # size of the checkpoint journal
+        self.journaled = {'matches': 0, 'features': 0, 'meta': 0}  # items of the lists already in the journal
+
+        if state is not None:
+            self.restore(state)
+
+        # the crops of the finished tracks, written in the background
+        self.crop_writer = CropWriter(top_k=crop_top_k or None) if save_crops else None
+        self.sort.save_crops = save_crops
+        self.sort.crop_writer = self.crop_writer
+        if crop_top_k > 0:
+            self.sort.max_crops = crop_top_k
+
+        self.checkpoint_every = checkpoint_every  # samples between two checkpoints, 0 for none
+        self.next_checkpoint = self.sort.frame_count + checkpoint_every
+
+    def restore(self, state):
+        """Continue from a checkpoint"""
+        self.sort = pickle.loads(state['sort'])
+        KalmanBoxTracker.count = state['tracker_count']
+        if state.get('identities') is not None:
+            self.identities = pickle.loads(state['identities'])
+        self.track_labels = state['track_labels']
+        self.track_ends = state['track_ends']
+        self.matches = state['matches']
+        for name in self.COUNTERS:
+            setattr(self, name, state['counters'][name])
+        if 'journal' in state:
+            self.journal_end = state['journal']
+            self.journaled = {key: len(state[key]) for key in self.journaled}
+
+    def snapshot(self, analyses):
+        """Called by the tracking stage: attach the state of the tracks to the batch, when a checkpoint is due"""
+        if self.checkpoint_every <= 0 or self.sort.frame_count < self.next_checkpoint:
+            return
+        self.next_checkpoint = self.sort.frame_count + self.checkpoint_every
+        analyses[-1].snapshot = {
+            'sort': pickle.dumps(self.sort),
+            'tracker_count': KalmanBoxTracker.count,
+            'counters': {'detections': self.detections, 'early_detections': self.early_detections,
+                         'coasted': self.coasted},
+        }
+
+    def offsets(self):
+        self.trackers_file.flush()
+        self.predictions_file.flush()
+        return {'trackers.csv': self.trackers_file.tell(), 'predictions.csv': self.predictions_file.tell()}
+
+    def needs_recognition(self, d):
+        if self.identity_votes <= 0 or d[4] not in self.identities:
+            return True
+        return self.identities[d[4]].needs_recognition(d[0:4], self.reverify_every, self.reverify_iou)
+
+    def update_identities(self, analysis):
+        """Add the votes of the recognised faces and replace the missing predictions with the label of the track"""
+        if self.identity_votes <= 0:
+            return
+        for i, ((d, _, _), recognised) in enumerate(zip(analysis.faces, analysis.recognised)):
+            identity = self.identities.setdefault(d[4], TrackIdentity())
+            if recognised:
+                name, prob = analysis.predictions[i]
+                identity.vote(name, prob, d[0:4], self.identity_votes)
+            else:
+                identity.skipped += 1
+                analysis.predictions[i] = identity.label()
+
+    def record_track(self, d, tracker_sample, embedding=None):
+        """Keep the first and last box and embedding of the track"""
+        end = self.track_ends.get(int(d[4]))
+        if end is None:
+            end = self.track_ends[int(d[4])] = {'first_sample': tracker_sample, 'first_box': d[0:4],
+                                                 'first_embedding': None, 'last_embedding': None}
+        end['last_sample'] = tracker_sample
+        end['last_box'] = d[0:4]
+        if embedding is not None:
+            if end['first_embedding'] is None:
+                end['first_embedding'] = embedding
+            end['last_embedding'] = embedding
+
+    def detection_summary(self):
+        return 'detector ran on %d/%d samples (%d early)' % (
+            self.detections, self.detections + self.coasted, self.early_detections)
+
+    def recognition_summary(self):
+        return 'classified %d faces, %d skipped on stable tracks' % (self.recognitions, self.skipped_recognitions)
 
 
 class Tracker:
-    def __init__(self, project='general'):
+    def __init__(self, project='general', inference=None):
+        """
+        `inference` is the precision of FaceNet and MTCNN, by default the one of the project settings.
+        MTCNN runs with float16 instead of int8, see `models.detection_precision`.
+        """
         self.project = project
-        classifier_path = os.path.join('data/classifier', project + '.pkl')
-        self.classifier = Classifier(classifier_path)
+        self.settings = config.project_settings(project)
+        precision = inference or self.settings.get('inference')
+        self.classifier = Classifier(precision=precision, project=project)
         self.aligner = FaceAligner(desiredFaceWidth=160, margin=10)
-        self.detector = FaceDetector(detect_multiple_faces=True, min_face_size=25)
+        self.detector = FaceDetector(detect_multiple_faces=True, min_face_size=25,
+                                     precision=models.detection_precision(precision))
+        self.frame_source_stats = None
+        self.pipeline_stats = None
+        self.detection_stats = None
+        self.recognition_stats = None
+        self.crop_stats = None
+        self.track_ends = None
+        self.tracker_samples = 0
 
     def run(self, video_path, video_speedup=25, export_frames=False, fragment=None, video_id=None, verbose=True,
-            cluster_features=True):
+            cluster_features=True, max_grab=frame_source.DEFAULT_MAX_GRAB, recognition_batch_size=32,
+            detection_batch_size=4, pipelined=False, detect_workers=1, recognise_workers=1, queue_size=8,
+            sampling='fixed', min_stride=5, max_stride=50, detect_every=1, identity_votes=0, reverify_every=25,
+            reverify_iou=0.5, frame_range=None, output_dir=None, collect_features=None, checkpoint_every=0,
+            resume=False, analysis_scale=None, detection_scale=None, classifier_version=None, appearance_weight=0.,
+            min_similarity=0.6, save_crops=None, crop_top_k=None):
+        """
+        Track and recognise the faces in a video.
+
+        With `pipelined`, decoding, detection, tracking and recognition run concurrently in separate threads,
+        connected by queues of `queue_size` items. Detection and recognition can use several workers,
+        while tracking is always done by a single worker in the original frame order.
+        The output is the same of the serial execution.
+
+        Frames move through the stages in batches of `detection_batch_size` samples, so that MTCNN and FaceNet
+        run on all of them at once.
+
+        With `sampling='fixed'` a frame every `video_speedup` is analysed. With `sampling='adaptive'` the stride
+        varies between `min_stride` and `max_stride`: dense after a shot change, sparse in stable shots.
+        The sampling decisions are written in `sampling.csv`.
+
+        With `detect_every` > 1, the face detector runs only every `detect_every` samples, or earlier on a shot change
+        or when a predicted box is leaving the image. In between, the tracks move with their Kalman prediction and
+        keep the label of their last recognition.
+
+        With `appearance_weight` > 0, the detected faces are embedded before the tracking, and a detection is
+        associated to a track on both the IoU and the cosine similarity of its embedding to the ones of the track:
+        a face that moved between two samples keeps its track if the similarity is at least `min_similarity`.
+        The recognition reuses these embeddings, so FaceNet runs once per detected face, also the ones that
+        `identity_votes` would skip.
+
+        With `save_crops`, the face crops of each track are saved in the `cluster` folder when the track ends,
+        by background writers. A track keeps only its best `crop_top_k` crops in memory, if > 0, otherwise the
+        default of `Sort`. Both default to the settings of the project, where the crops are not saved.
+
+        With `identity_votes` > 0, a track is not recognised anymore once it has at least `identity_votes` predictions
+        and a dominant name (same rule of `clusterize`). It is verified again after `reverify_every` samples, or when
+        its box has an IoU lower than `reverify_iou` with the box of the last recognition. The skipped samples are
+        written with the dominant name of the track. The recognition stage is then ordered, with a single worker.
+
+        `frame_range` (start, end) restricts the analysis to a range of frames, like `fragment`, and `output_dir`
+        replaces the default output folder: both are used by `sharding` for analysing a video in parallel.
+        With `collect_features` and not `cluster_features`, the features are collected in the classifier and left
+        to the caller for clustering.
+
+        With `checkpoint_every` > 0, the state of the job is saved every `checkpoint_every` samples in
+        `checkpoint.pkl`: last frame written, tracks and the size of the csv outputs. The matches and the collected
+        features are appended to `checkpoint.journal`, only the ones found since the previous checkpoint.
+        With `resume`, the job continues from the checkpoint, if any. A checkpoint made with other sampling
+        arguments (`sampling`, `video_speedup` or the strides, frame range, `analysis_scale`) is not resumed: the
+        job starts over.
+        The checkpoint is removed when the job is complete.
+
+        The job uses a single version of the classifier of the project: `classifier_version`, the one of the
+        checkpoint when resuming, or the current one when the job starts. A newer version is used by the next jobs.
+
+        The frames are analysed resized by `analysis_scale`, by default 0.9 for videos wider than 700px.
+        With `detection_scale` < 1, MTCNN searches the faces on the frames further resized by `detection_scale`,
+        then refines them at the analysis resolution. Both default to the settings of the project in `config.yaml`.
+        """
         video_capture = cv2.VideoCapture(video_path)
 
         # setup all paths
-        output_path = utils.generate_output_path('./data/out', self.project, video_id)
-        cluster_path = os.path.join(output_path, 'cluster')
-        frames_path = os.path.join(output_path, 'frames')
-
-        if export_frames:
-            os.makedirs(frames_path, exist_ok=True)
+        if output_dir is None:
+            output_path = utils.generate_output_path('./data/out', self.project, video_id)
+        else:
+            output_path = output_dir
+            os.makedirs(output_path, exist_ok=True)
 
-        trackers_csv = os.path.join(output_path, 'trackers.csv')
-        predictions_csv = os.path.join(output_path, 'predictions.csv')
-
-        # init csv outputs
-        trackers_writer = init_csv(trackers_csv, ['x1', 'y1', 'x2', 'y2', 'track_id', 'frame'])
-        predictions_writer = init_csv(predictions_csv, ['x1', 'y1', 'x2', 'y2', 'track_id', 'name',
-                                                        'confidence', 'frame', 'tracker_sample', 'npt'])
-
-        self.classifier.collect_features = cluster_features
-
-        # init tracker
-        tracker = Sort(min_hits=0)
+        if collect_features is None:
+            collect_features = cluster_features
+        self.classifier.collect_features = collect_features
 
         # frames per second
         fps = video_capture.get(cv2.CAP_PROP_FPS)
         video_length = int(video_capture.get(cv2.CAP_PROP_FRAME_COUNT))
         width = int(video_capture.get(cv2.CAP_PROP_FRAME_WIDTH))
 
-        scale_rate = 0.9 if width > 700 else 1
+        if analysis_scale is None:
+            analysis_scale = self.settings.get('analysis_scale')
+        if detection_scale is None:
+            detection_scale = self.settings.get('detection_scale') or 1.
+        if save_crops is None:
+            save_crops = bool(self.settings.get('save_crops'))
+        if crop_top_k is None:
+            crop_top_k = self.settings.get('crop_top_k') or 0
+        if analysis_scale:
+            scale_rate = analysis_scale
+        else:
+            scale_rate = 0.9 if width > 700 else 1
 
         frame_start = 0
         frame_end = video_length
         if fragment is not None:
             frame_start, frame_end = parse_fragment(fragment, fps)
+        if frame_range is not None:
+            frame_start, frame_end = frame_range
+
+        # the frames of a resumed job must follow the ones analysed before the checkpoint
+        sampling_args = {'sampling': sampling, 'frame_range': (frame_start, frame_end), 'scale_rate': scale_rate}
+        if sampling == 'adaptive':
+            sampling_args.update(min_stride=min_stride, max_stride=max_stride)
+        else:
+            sampling_args.update(video_speedup=video_speedup)
+
+        state = checkpoint.load(output_path) if resume else None
+        if state is not None and state.get('sampling', sampling_args) != sampling_args:
+            print('Checkpoint of %s made with %s, not %s: starting over' % (video_id, state['sampling'], sampling_args))
+            state = None
+            if database.is_on():
+                database.clean_analysis(video_id, self.project)
+        if state is not None:
+            if verbose:
+                print('Resuming from frame %d' % state['frame_no'])
+            self.classifier.features = state['features']
+            self.classifier.meta = state['meta']
+            if database.is_on():
+                database.clean_analysis_after(video_id, self.project, int(state['frame_no']))
+            if sampling == 'adaptive':
+                frame_start = state['frame_no'] + min_stride
+
+        if classifier_version is None and state is not None:
+            classifier_version = state.get('classifier_version')
+        if classifier_version is not None and not classifier_store.exists(self.project, classifier_version):
+            print('Classifier %s of %s not found, using the current one' % (classifier_version, self.project))
+            classifier_version = None
+        classifier_version = self.classifier.reload(classifier_version)
+        if verbose:
+            print('Classifier version: %s' % classifier_version)
+
+        if sampling == 'adaptive':
+            source = frame_source.AdaptiveFrameSource(video_capture, frame_start, frame_end, min_stride, max_stride,
+                                                      max_grab=max_grab)
+        else:
+            frames = frame_source.sample_frames(frame_start, frame_end, video_speedup)
+            if state is not None:
+                frames = frames[frames > state['frame_no']]
+            shot_detector = frame_source.ShotChangeDetector() if detect_every > 1 else None
+            source = frame_source.open_frame_source(video_capture, frames, max_grab, shot_detector)
+
+        job = TrackingJob(video_id, output_path, fps, scale_rate, frame_end, export_frames, recognition_batch_size,
+                          detect_every, identity_votes, reverify_every, reverify_iou, checkpoint_every, state,
+                          detection_scale, appearance_weight, min_similarity, save_crops, crop_top_k, sampling_args)
+        batches = frame_source.batches(self.schedule(job, source), detection_batch_size)
+
+        try:
+            # iterate over the frames
+            if pipelined:
+                p = pipeline.Pipeline('decode', [
+                    pipeline.Stage('detect', lambda x: self.detect(job, x), detect_workers),
+                    pipeline.Stage('track', lambda x: self.track(job, x), ordered=True),
+                    # the identities of the tracks must be updated in order
+                    pipeline.Stage('recognise', lambda x: self.recognise(job, x), ordered=True)
+                    if identity_votes > 0 else
+                    pipeline.Stage('recognise', lambda x: self.recognise(job, x), recognise_workers),
+                ], queue_size)
+                for analyses in p.run(batches):
+                    self.output(job, analyses, verbose)
+                self.pipeline_stats = p.stats()
+                if verbose:
+                    print(p.summary())
+            else:
+                for samples in batches:
+                    analyses = self.recognise(job, self.track(job, self.detect(job, samples)))
+                    self.output(job, analyses, verbose)
+        finally:
+            # also when the job fails: write the queued crops and stop the writer threads
+            if job.crop_writer is not None:
+                job.crop_writer.close()
+
+        # TODO final track
+
+        if job.crop_writer is not None:
+            self.crop_stats = job.crop_writer.stats()
+        self.frame_source_stats = source.stats()
+        self.detection_stats = {'detections': job.detections, 'early_detections': job.early_detections,
+                                'coasted': job.coasted}
+        self.recognition_stats = {'recognitions': job.recognitions, 'skipped': job.skipped_recognitions}
+        self.track_ends = job.track_ends
+        self.tracker_samples = job.sort.frame_count
+        if verbose:
+            print('Frame source: %s' % source.summary())
+            print('Detection: %s' % job.detection_summary())
+            print('Recognition: %s' % job.recognition_summary())
+            if job.crop_writer is not None:
+                print('Crops: %s' % job.crop_writer.summary())
+        if sampling == 'adaptive':
+            sampling_writer = init_csv(os.path.join(output_path, 'sampling.csv'),
+                                       ['frame', 'reason', 'hist_distance', 'motion', 'next_stride'])
+            sampling_writer.writerows(source.decisions)
 
-        matches = []
-        # iterate over the frames
-        for frame_no in np.arange(frame_start, frame_end, video_speedup):
+        if database.is_on():
+            database.save_status(video_id, self.project, 'COMPLETE', classifier_version)
+
+        for f in file_to_be_close:
+            f.close()
+        checkpoint.remove(output_path)
+
+        matches = job.matches
+        if cluster_features:
             if verbose:
-                print('frame %d/%d' % (frame_no, frame_end))
-            video_capture.set(cv2.CAP_PROP_POS_FRAMES, frame_no)
+                print('Feature clustering started')
+            clus = self.classifier.cluster_features()
+            for c in clus:
+                c['video'] = video_id
+                c['project'] = self.project
+            if database.is_on():
+                database.insert_feat_cluster(clus)
+            return matches, cluster_features
 
-            # read the frame
-            ret, frame = video_capture.retrieve()
+        if verbose:
+            print('COMPLETE')
+        return matches
 
-            if frame is None:
+    def schedule(self, job, samples):
+        """Decide on which samples the detector runs. Yield `(sample, detect)`."""
+        since_detection = job.detect_every
+        for sample in samples:
+            detect = since_detection >= job.detect_every or sample.shot_change
+            since_detection = 1 if detect else since_detection + 1
+            yield sample, detect
+
+    def detect(self, job, samples):
+        """Detection stage: find the faces in a batch of sampled frames"""
+        analyses = []
+        for sample, detect in samples:
+            if sample.image is None:
                 raise RuntimeError
 
-            face_list = []
-            attribute_list = []
-            frame = cv2.resize(frame, (0, 0), fx=scale_rate, fy=scale_rate)
-            frame_height, frame_width, _ = frame.shape
-            rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            rgb_frame = cv2.cvtColor(rgb_frame, cv2.COLOR_GRAY2RGB)
-            img_size = np.asarray(frame.shape)[0:2]
-            bounding_boxes, landmarks = self.detector.detect(rgb_frame)
+            analysis = FrameAnalysis(sample.frame_no)
+            analysis.frame = cv2.resize(sample.image, (0, 0), fx=job.scale_rate, fy=job.scale_rate)
+            rgb_frame = cv2.cvtColor(analysis.frame, cv2.COLOR_BGR2GRAY)
+            analysis.rgb_frame = cv2.cvtColor(rgb_frame, cv2.COLOR_GRAY2RGB)
+            analysis.detected = detect
+            analyses.append(analysis)
+
+        self.find_faces(job, [a for a in analyses if a.detected])
+        return analyses
+
+    def find_faces(self, job, analyses):
+        detections = self.detector.detect_batch([a.rgb_frame for a in analyses], job.detection_scale, scores=True)
 
+        for analysis, (bounding_boxes, landmarks, confidences) in zip(analyses, detections):
             # print('Detected %d faces' % len(bounding_boxes))
-            for item, ld in zip(bounding_boxes, landmarks):
+            for item, ld, confidence in zip(bounding_boxes, landmarks, confidences):
                 bb = utils.xywh2rect(*utils.fix_box(item))
-                face_list.append(bb)
+                analysis.face_list.append(bb)
 
                 # use 5 face landmarks to judge the face is front or side
                 # TODO use this value
                 dist_rate, high_ratio_variance, width_rate = judge_side_face(ld)
                 # dist_rate 0 => front face ; 1 => side face
 
-                cropped = frame.copy()[bb[1]:bb[3], bb[0]:bb[2], :]
-
-                attribute_list.append([cropped, 0.99, dist_rate, high_ratio_variance, width_rate, ld])
+                # a copy of the face only, the tracks keep it after the frame
+                cropped = analysis.frame[bb[1]:bb[3], bb[0]:bb[2], :].copy()
+
+                analysis.attribute_list.append([cropped, confidence, dist_rate, high_ratio_variance, width_rate, ld])
+
+        if job.appearance_weight > 0:
+            # the crops of the recognition, which depend only on the landmarks
+            crops = [self.aligner.align(a.frame, (bb, attribute[-1]))
+                     for a in analyses for bb, attribute in zip(a.face_list, a.attribute_list)]
+            embeddings = self.classifier.embed_batches(crops, job.recognition_batch_size)
+            start = 0
+            for analysis in analyses:
+                analysis.detection_embeddings = embeddings[start:start + len(analysis.face_list)]
+                start += len(analysis.face_list)
+
+    def track(self, job, analyses):
+        """Tracking stage: assign the detections to the tracks. It must see the frames in order."""
+        for analysis in analyses:
+            frame = analysis.frame
+            frame_height, frame_width, _ = frame.shape
+            img_size = np.asarray(frame.shape)[0:2]
 
-            trackers = tracker.update(np.array(face_list), img_size, cluster_path, attribute_list, rgb_frame)
-            tracker_sample = tracker.frame_count
+            if not analysis.detected and job.sort.leaves_image(img_size):
+                # the motion model is not enough, detect now
+                self.find_faces(job, [analysis])
+                analysis.detected = True
+                job.early_detections += 1
+
+            if analysis.detected:
+                trackers = job.sort.update(np.array(analysis.face_list), img_size, job.cluster_path,
+                                           analysis.attribute_list, analysis.rgb_frame, analysis.detection_embeddings)
+                job.detections += 1
+            else:
+                trackers = job.sort.coast()
+                job.coasted += 1
+            analysis.tracker_sample = job.sort.frame_count
             # this is a counter of the frame analysed by the tracker (so normalised respect to the video_speedup)
 
             for d in trackers:
@@ -147,64 +584,127 @@ class Tracker:
                 if any(i < 0 for i in d) \
                         or d[0] >= frame_width or d[2] >= frame_width \
                         or d[1] >= frame_height or d[3] >= frame_height:
-                    print('Error tracker %d at frame %d:' % (d[4], frame_no))
+                    print('Error tracker %d at frame %d:' % (d[4], analysis.frame_no))
                     continue
 
-                trackers_writer.writerow([str(i) for i in d] + [str(frame_no)])
-
-                # cutting the img on the face
-                trackers_cropped = self.aligner.align(frame, (d[0:4], ld))
-
-                best_name, best_prob = self.classifier.predict_best(trackers_cropped,
-                                                                    [frame_no, d[4], d[0:4], dist_rate])
-
-                npt = utils.frame2npt(frame_no, fps)
-                predictions_writer.writerow(
-                    [str(i) for i in d] + [best_name, best_prob, str(frame_no), tracker_sample, npt])
-
-                # apply back the scale rate
-                box = [x / scale_rate for x in d[0:4].tolist()]
-                match = {
-                    'name': best_name,
-                    'project': self.project,
-                    'track_id': int(d[4]),
-                    'frame': int(frame_no),
-                    'confidence': best_prob,
-                    'tracker_sample': tracker_sample,
-                    'npt': npt,
-                    'locator': video_id,
-                    'bounding': utils.rect2xywh(*box),
-                    'rect': box
-                }
-                matches.append(match)
-                if database.is_on():
-                    database.insert_partial_analysis(match)
-
-                if export_frames:
-                    export_frame(frame, d, best_name, frame_no, frames_path)
-
-        # TODO final track
-
-        if database.is_on():
-            database.save_status(video_id, self.project, 'COMPLETE')
-
-        for f in file_to_be_close:
-            f.close()
-
-        if cluster_features:
-            if verbose:
-                print('Feature clustering started')
-            clus = self.classifier.cluster_features()
-            for c in clus:
-                c['video'] = video_id
-                c['project'] = self.project
+                analysis.faces.append((d, ld, dist_rate))
+                embedding = job.sort.detection_embeddings.get(d[4]) if analysis.detected else None
+                analysis.face_embeddings.append(embedding)
+
+        job.snapshot(analyses)
+        return analyses
+
+    def recognise(self, job, analyses):
+        """Recognition stage: classify all the tracked faces of the batch together"""
+        for analysis in analyses:
+            analysis.recognised = [analysis.detected and job.needs_recognition(d) for d, _, _ in analysis.faces]
+            job.skipped_recognitions += sum(analysis.detected and not r for r in analysis.recognised)
+
+        if job.appearance_weight > 0:
+            # embedded before the tracking
+            embedded = [e for a in analyses for e, recognised in zip(a.face_embeddings, a.recognised) if recognised]
+            embeddings, predictions = self.classifier.classify_embeddings(embedded)
+        else:
+            # cutting the img on the face
+            crops = [self.aligner.align(a.frame, (d[0:4], ld))
+                     for a in analyses for (d, ld, _), recognised in zip(a.faces, a.recognised) if recognised]
+            embeddings, predictions = self.classifier.classify(crops, job.recognition_batch_size)
+        predictions = self.classifier.select_best(predictions)
+        job.recognitions += len(embeddings)
+
+        start = 0
+        for analysis in analyses:
+            end = start + sum(analysis.recognised)
+            analysis.embeddings = embeddings[start:end]
+            found = iter(predictions[start:end])
+            analysis.predictions = [next(found) if recognised else None for recognised in analysis.recognised]
+            start = end
+            job.update_identities(analysis)
+
+        snapshot = analyses[-1].snapshot
+        if snapshot is not None:
+            snapshot['identities'] = pickle.dumps(job.identities)
+            snapshot['counters'].update(recognitions=job.recognitions, skipped_recognitions=job.skipped_recognitions)
+        return analyses
+
+    def output(self, job, analyses, verbose=True):
+        """Output stage: write the results of the frames. It must see the frames in order."""
+        for analysis in analyses:
+            self.output_frame(job, analysis, verbose)
+        if analyses[-1].snapshot is not None:
+            self.save_checkpoint(job, analyses[-1])
+
+    def save_checkpoint(self, job, analysis):
+        # the matches and the features found since the last checkpoint go to the journal
+        lists = {'matches': job.matches, 'features': self.classifier.features, 'meta': self.classifier.meta}
+        job.journal_end = checkpoint.append(job.output_path, job.journal_end,
+                                            {key: values[job.journaled[key]:] for key, values in lists.items()})
+        job.journaled = {key: len(values) for key, values in lists.items()}
+
+        state = analysis.snapshot
+        state.update({
+            'frame_no': analysis.frame_no,
+            'track_labels': job.track_labels,
+            'track_ends': job.track_ends,
+            'journal': job.journal_end,
+            'offsets': job.offsets(),
+            'classifier_version': self.classifier.version,
+            'sampling': job.sampling,
+        })
+        checkpoint.save(job.output_path, state)
+
+    def output_frame(self, job, analysis, verbose=True):
+        frame_no = analysis.frame_no
+        if verbose:
+            print('frame %d/%d' % (frame_no, job.frame_end))
+
+        for d, _, _ in analysis.faces:
+            job.trackers_writer.writerow([str(i) for i in d] + [str(frame_no)])
+
+        self.classifier.collect(analysis.embeddings,
+                                [[frame_no, d[4], d[0:4], dist_rate]
+                                 for (d, _, dist_rate), recognised in zip(analysis.faces, analysis.recognised)
+                                 if recognised])
+
+        embeddings = iter(analysis.embeddings)
+        for (d, _, _), recognised in zip(analysis.faces, analysis.recognised):
+            job.record_track(d, analysis.tracker_sample, next(embeddings) if recognised else None)
+
+        for (d, _, _), prediction in zip(analysis.faces, analysis.predictions):
+            track_id = int(d[4])
+            if prediction is not None:
+                job.track_labels[track_id] = prediction
+            elif track_id in job.track_labels:
+                # not recognised in this frame, carry the last label of the track
+                prediction = job.track_labels[track_id]
+            else:
+                continue
+            best_name, best_prob = prediction
+
+            npt = utils.frame2npt(frame_no, job.fps)
+            job.predictions_writer.writerow(
+                [str(i) for i in d] + [best_name, best_prob, str(frame_no), analysis.tracker_sample, npt])
+
+            # apply back the scale rate
+            box = [x / job.scale_rate for x in d[0:4].tolist()]
+            match = {
+                'name': best_name,
+                'project': self.project,
+                'track_id': track_id,
+                'frame': int(frame_no),
+                'confidence': best_prob,
+                'tracker_sample': analysis.tracker_sample,
+                'npt': npt,
+                'locator': job.video_id,
+                'bounding': utils.rect2xywh(*box),
+                'rect': box
+            }
+            job.matches.append(match)
             if database.is_on():
-                database.insert_feat_cluster(clus)
-            return matches, cluster_features
+                database.insert_partial_analysis(match)
 
-        if verbose:
-            print('COMPLETE')
-        return matches
+            if job.export_frames:
+                export_frame(analysis.frame, d, best_name, frame_no, job.frames_path)
 
 
 def parse_args():
@@ -222,6 +722,56 @@ def parse_args():
                         help='Speed up for the video')
     parser.add_argument('--export_frames', default=False, action='store_true',
                         help='If specified, export the annotated frames')
+    parser.add_argument('--max_grab', type=int, default=frame_source.DEFAULT_MAX_GRAB,
+                        help='Max distance (in frames) between two samples for decoding sequentially '
+                             'instead of seeking')
+    parser.add_argument('--recognition_batch_size', type=int, default=32,
+                        help='Max number of faces embedded with a single FaceNet forward pass')
+    parser.add_argument('--detection_batch_size', type=int, default=4,
+                        help='Number of sampled frames given together to the face detector')
+    parser.add_argument('--analysis_scale', type=float, default=None,
+                        help='Resize factor of the analysed frames. By default, from the project settings')
+    parser.add_argument('--detection_scale', type=float, default=None,
+                        help='Resize factor of the frames for the face search, relative to the analysed frames. '
+                             'By default, from the project settings')
+    parser.add_argument('--sampling', type=str, default='fixed', choices=['fixed', 'adaptive'],
+                        help='"fixed" analyses a frame every `video_speedup`, '
+                             '"adaptive" follows the shot changes and the motion')
+    parser.add_argument('--min_stride', type=int, default=5,
+                        help='Min distance (in frames) between two samples in adaptive sampling')
+    parser.add_argument('--max_stride', type=int, default=50,
+                        help='Max distance (in frames) between two samples in adaptive sampling')
+    parser.add_argument('--detect_every', type=int, default=1,
+                        help='Run the face detector every N samples, moving the tracks with their motion model '
+                             'in between')
+    parser.add_argument('--identity_votes', type=int, default=0,
+                        help='Stop recognising a track after N predictions with a dominant name. 0 to disable')
+    parser.add_argument('--reverify_every', type=int, default=25,
+                        help='Samples after which a stable track is recognised again')
+    parser.add_argument('--reverify_iou', type=float, default=0.5,
+                        help='Recognise a stable track again when its box moved under this IoU')
+    parser.add_argument('--appearance_weight', type=float, default=0.,
+                        help='Weight of the FaceNet similarity in the association of the detections to the tracks. '
+                             '0 for IoU only')
+    parser.add_argument('--min_similarity', type=float, default=0.6,
+                        help='Min cosine similarity for continuing a track whose IoU is too low')
+    parser.add_argument('--save_crops', default=None, action='store_true',
+                        help='If specified, the face crops of the tracks are saved. By default, the project setting')
+    parser.add_argument('--crop_top_k', type=int, default=None,
+                        help='Keep and save only the N best face crops of each track. 0 for the default of the '
+                             'tracker, by default the project setting')
+    parser.add_argument('--checkpoint_every', type=int, default=0,
+                        help='Save a checkpoint of the job every N samples. 0 to disable')
+    parser.add_argument('--resume', default=False, action='store_true',
+                        help='If specified, continue the job from its last checkpoint')
+    parser.add_argument('--pipelined', default=False, action='store_true',
+                        help='If specified, decoding, detection, tracking and recognition run concurrently')
+    parser.add_argument('--detect_workers', type=int, default=1,
+                        help='Number of detection workers in pipelined mode')
+    parser.add_argument('--recognise_workers', type=int, default=1,
+                        help='Number of recognition workers in pipelined mode')
+    parser.add_argument('--queue_size', type=int, default=8,
+                        help='Max number of frames waiting in front of each stage in pipelined mode')
     return parser.parse_args()
 
 
@@ -231,4 +781,13 @@ if __name__ == '__main__':
 
     video = uri_utils.normalize_video(args.video)
 
-    main(video, args.project, args.video_speedup, args.export_frames)
+    main(video, args.project, args.video_speedup, args.export_frames, max_grab=args.max_grab,
+         recognition_batch_size=args.recognition_batch_size, detection_batch_size=args.detection_batch_size,
+         pipelined=args.pipelined,
+         detect_workers=args.detect_workers, recognise_workers=args.recognise_workers, queue_size=args.queue_size,
+         sampling=args.sampling, min_stride=args.min_stride, max_stride=args.max_stride,
+         detect_every=args.detect_every, identity_votes=args.identity_votes, reverify_every=args.reverify_every,
+         reverify_iou=args.reverify_iou, checkpoint_every=args.checkpoint_every, resume=args.resume,
+         analysis_scale=args.analysis_scale, detection_scale=args.detection_scale,
+         appearance_weight=args.appearance_weight, min_similarity=args.min_similarity,
+         save_crops=args.save_crops, crop_top_k=args.crop_top_k)
@@ -0,0 +1,81 @@
+"""
+Checkpoints of the tracking jobs, for resuming a job after a restart of the server.
+
+A checkpoint is a pickle written next to the outputs of the job. It is replaced atomically, so a crash while
+writing it leaves the previous one in place.
+
+The lists that only grow during a job (as its matches) are not saved in the checkpoint, which would make each
+checkpoint longer than the previous one: `append` writes what was added since the last checkpoint at the end of a
+journal, and the checkpoint keeps the size of the journal at that time, as the sizes of the csv outputs.
+"""
+import os
+import pickle
+
+FILENAME = 'checkpoint.pkl'
+JOURNAL = 'checkpoint.journal'
+
+
+def path(output_path):
+    return os.path.join(output_path, FILENAME)
+
+
+def journal_path(output_path):
+    return os.path.join(output_path, JOURNAL)
+
+
+def append(output_path, end, added):
+    """
+    Write `added`, a dict of lists, in the journal at `end`, its size at the last checkpoint: what was written after
+    it by a job that stopped before its next checkpoint is dropped. Return the new size, for the next checkpoint.
+    """
+    with open(journal_path(output_path), 'r+b' if os.path.isfile(journal_path(output_path)) else 'wb') as f:
+        f.seek(end)
+        f.truncate()
+        pickle.dump(added, f, pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+        return f.tell()
+
+
+def read_journal(output_path, end):
+    """The lists written in the journal before `end`, joined"""
+    lists = {}
+    with open(journal_path(output_path), 'rb') as f:
+        while f.tell() < end:
+            for key, values in pickle.load(f).items():
+                lists.setdefault(key, []).extend(values)
+    return lists
+
+
+def save(output_path, state):
+    tmp = path(output_path) + '.tmp'
+    with open(tmp, 'wb') as f:
+        pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path(output_path))
+
+
+def load(output_path):
+    """
+    The state saved in the checkpoint, with the lists of the journal up to the checkpoint (see `append`),
+    or None if there is no checkpoint
+    """
+    if not os.path.isfile(path(output_path)):
+        return None
+    with open(path(output_path), 'rb') as f:
+        state = pickle.load(f)
+    if 'journal' in state:
+        state.update(read_journal(output_path, state['journal']))
+    return state
+
+
+def exists(output_path):
+    return os.path.isfile(path(output_path))
+
+
+def remove(output_path):
+    if exists(output_path):
+        os.remove(path(output_path))
+    if os.path.isfile(journal_path(output_path)):
+        os.remove(journal_path(output_path))
@@ -0,0 +1,123 @@
+"""
+Versioned classifiers of the projects.
+
+Each training saves a new version in `data/classifier/<project>/<version>/model.joblib`, then points the `CURRENT`
+file to it. Both steps are atomic renames, so a reader sees either the previous version or the new one, complete.
+The estimators are unpickled in memory: memory-mapping them would open one map per array (thousands for a random
+forest), and libsvm cannot predict from read-only buffers. Only the matrices of the compiled inference (`ARRAYS` of
+the `compiled_` attribute of the model), saved aside as `.npy` files, are memory-mapped read-only when loading.
+
+Projects trained before the versioning have a single `data/classifier/<project>.pkl`, loaded as version `legacy`.
+"""
+import copy
+import os
+import pickle
+import shutil
+import time
+import uuid
+
+import joblib
+import numpy as np
+
+ROOT = 'data/classifier'
+CURRENT = 'CURRENT'
+MODEL = 'model.joblib'
+LEGACY = 'legacy'
+ARRAYS = ('coef', 'intercept')
+
+
+def project_path(project, root=ROOT):
+    return os.path.join(root, project)
+
+
+def legacy_path(project, root=ROOT):
+    return os.path.join(root, project + '.pkl')
+
+
+def current_version(project, root=ROOT):
+    """The version pointed by CURRENT, `legacy` for an old pickle, or None if the project has no classifier"""
+    try:
+        with open(os.path.join(project_path(project, root), CURRENT)) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return LEGACY if os.path.isfile(legacy_path(project, root)) else None
+
+
+def versions(project, root=ROOT):
+    """The saved versions, from the oldest"""
+    path = project_path(project, root)
+    if not os.path.isdir(path):
+        return []
+    return sorted(v for v in os.listdir(path) if os.path.isfile(os.path.join(path, v, MODEL)))
+
+
+def exists(project, version, root=ROOT):
+    if version == LEGACY:
+        return os.path.isfile(legacy_path(project, root))
+    return os.path.isfile(os.path.join(project_path(project, root), version, MODEL))
+
+
+def save(project, model, class_names, root=ROOT, keep=3):
+    """Save a new version and make it the current one. Keep the `keep` last versions. Return the version."""
+    path = project_path(project, root)
+    os.makedirs(path, exist_ok=True)
+    # sortable by date, unique among the servers sharing the folder
+    version = '%s-%s' % (time.strftime('%Y%m%d-%H%M%S'), uuid.uuid4().hex[:8])
+
+    tmp = os.path.join(path, '.%s.tmp' % version)
+    os.makedirs(tmp)
+    joblib.dump((_without_arrays(model, tmp), class_names), os.path.join(tmp, MODEL))
+    os.replace(tmp, os.path.join(path, version))
+
+    pointer = os.path.join(path, '.%s.tmp' % CURRENT)
+    with open(pointer, 'w') as f:
+        f.write(version)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(pointer, os.path.join(path, CURRENT))
+
+    for old in versions(project, root)[:-keep]:
+        if old != version:
+            shutil.rmtree(os.path.join(path, old), ignore_errors=True)
+    return version
+
+
+def load(project, version=None, root=ROOT, mmap=True):
+    """
+    The `(model, class_names)` of a version, by default the current one. With `mmap`, the matrices of the compiled
+    inference are memory-mapped read-only. Return the version too.
+    """
+    if version is None:
+        version = current_version(project, root)
+    if version is None:
+        raise FileNotFoundError('No classifier for the project %s' % project)
+    if version == LEGACY:
+        with open(legacy_path(project, root), 'rb') as f:
+            return version, pickle.load(f)
+    path = os.path.join(project_path(project, root), version)
+    model, class_names = joblib.load(os.path.join(path, MODEL), mmap_mode=None)
+    _with_arrays(model, path, mmap)
+    return version, (model, class_names)
+
+
+def _without_arrays(model, path):
+    """Save the `ARRAYS` of the compiled inference of `model` in `path`. Return a copy of `model` without them."""
+    compiled = getattr(model, 'compiled_', None)
+    if compiled is None:
+        return model
+    compiled = copy.copy(compiled)
+    for name in ARRAYS:
+        np.save(os.path.join(path, name + '.npy'), getattr(compiled, name))
+        setattr(compiled, name, None)
+    model = copy.copy(model)
+    model.compiled_ = compiled
+    return model
+
+
+def _with_arrays(model, path, mmap):
+    compiled = getattr(model, 'compiled_', None)
+    if compiled is None:
+        return
+    for name in ARRAYS:
+        if getattr(compiled, name) is None:
+            setattr(compiled, name, np.load(os.path.join(path, name + '.npy'), mmap_mode='r' if mmap else None))
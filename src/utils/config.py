@@ -0,0 +1,21 @@
+"""Settings from config/config.yaml"""
+import os
+
+import yaml
+
+CONFIG_PATH = 'config/config.yaml'
+
+
+def load(path=CONFIG_PATH):
+    if not os.path.isfile(path):
+        return {}
+    with open(path, 'r') as ymlfile:
+        return yaml.load(ymlfile, Loader=yaml.SafeLoader) or {}
+
+
+def project_settings(project, path=CONFIG_PATH):
+    """The settings of `project` in the `projects` section, on top of the `default` ones"""
+    projects = load(path).get('projects') or {}
+    settings = dict(projects.get('default') or {})
+    settings.update(projects.get(project) or {})
+    return settings
@@ -0,0 +1,85 @@
+"""
+Persistent store of the FaceNet embeddings of the training images.
+
+The embeddings are keyed by the hash of the image file, so that an image is embedded only once, whatever its
+project or path. There is a store for each model version: `embeddings.npy` holds one row per image, `keys.npy`
+the hash of each row. Rows are only appended, so a store interrupted while saving is still consistent
+up to the shorter of the two files.
+"""
+import hashlib
+import os
+
+import numpy as np
+
+ROOT = 'data/embedding'
+
+
+def file_hash(path, algorithm='sha1'):
+    h = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def model_version(*paths, preprocessing='gray-std-v1'):
+    """Version of a model, from the content of its files and the preprocessing of the images"""
+    h = hashlib.sha1(preprocessing.encode())
+    for path in paths:
+        h.update(file_hash(path).encode())
+    return h.hexdigest()[:16]
+
+
+class EmbeddingStore:
+    def __init__(self, version, root=ROOT):
+        self.path = os.path.join(root, version)
+        self.embeddings_file = os.path.join(self.path, 'embeddings.npy')
+        self.keys_file = os.path.join(self.path, 'keys.npy')
+        self.embeddings = None
+        self.keys = []
+        self.index = {}
+        self.load()
+
+    def load(self):
+        if not os.path.isfile(self.embeddings_file) or not os.path.isfile(self.keys_file):
+            return
+        self.embeddings = np.load(self.embeddings_file, mmap_mode='r')
+        self.keys = np.load(self.keys_file).tolist()
+        size = min(len(self.keys), len(self.embeddings))
+        self.keys = self.keys[:size]
+        self.index = {k: i for i, k in enumerate(self.keys)}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def missing(self, keys):
+        """The keys without an embedding, once each"""
+        return list(dict.fromkeys(k for k in keys if k not in self.index))
+
+    def get(self, keys):
+        """The embeddings of the keys, in one read"""
+        return np.asarray(self.embeddings[[self.index[k] for k in keys]])
+
+    def add(self, keys, embeddings):
+        """Append the embeddings of new keys, and save the store"""
+        if len(keys) == 0:
+            return
+        embeddings = np.asarray(embeddings, dtype='float32')
+        if self.embeddings is not None:
+            embeddings = np.concatenate([self.embeddings[:len(self.keys)], embeddings])
+        keys = self.keys + list(keys)
+
+        os.makedirs(self.path, exist_ok=True)
+        # embeddings first: extra rows without a key are ignored at loading
+        _save(self.embeddings_file, embeddings)
+        _save(self.keys_file, np.asarray(keys))
+        self.load()
+
+
+def _save(path, array):
+    tmp = path + '.tmp.npy'
+    np.save(tmp, array)
+    os.replace(tmp, path)
@@ -0,0 +1,221 @@
+"""
+Frame sources for the video analysis.
+
+Setting `CAP_PROP_POS_FRAMES` makes OpenCV seek back to the previous keyframe and decode the whole GOP up to the
+requested frame. When the samples are close to each other it is much cheaper to keep decoding sequentially and to
+skip the unwanted frames with `grab()`, which decodes the frame without converting it to an image.
+"""
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+Sample = namedtuple('Sample', ['frame_no', 'image', 'shot_change'], defaults=[False])
+
+# x264 default keyframe interval: farther than this, seeking is never more expensive than grabbing
+DEFAULT_MAX_GRAB = 250
+
+
+class FrameSource:
+    """
+    Iterate over a list of frame numbers of a video, yielding a `Sample` for each of them.
+
+    Frame numbers can be floats (e.g. when computed from a media fragment): they are yielded untouched,
+    while the integer part is used for positioning in the video.
+    """
+
+    def __init__(self, video_capture, frames, shot_detector=None):
+        self.video_capture = video_capture
+        self.frames = frames
+        self.shot_detector = shot_detector  # if given, flag the samples at a shot change
+        self.decoded = 0  # frames decoded through grab() or read()
+        self.seeks = 0  # calls to set(CAP_PROP_POS_FRAMES)
+        self.delivered = 0  # samples returned to the caller
+
+    def __iter__(self):
+        for frame_no in self.frames:
+            frame = self.read(int(frame_no))
+            self.delivered += 1
+            cut = False
+            if self.shot_detector is not None and frame is not None:
+                cut, _, _ = self.shot_detector.update(frame)
+            yield Sample(frame_no, frame, cut)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def read(self, frame_no):
+        raise NotImplementedError
+
+    def seek(self, frame_no):
+        self.video_capture.set(cv2.CAP_PROP_POS_FRAMES, frame_no)
+        self.seeks += 1
+        self.decoded += 1
+        _, frame = self.video_capture.read()
+        return frame
+
+    def stats(self):
+        return {'decoded': self.decoded, 'seeks': self.seeks, 'delivered': self.delivered}
+
+    def summary(self):
+        return 'decoded %d frames with %d seeks for %d samples' % (self.decoded, self.seeks, self.delivered)
+
+
+class SeekingFrameSource(FrameSource):
+    """Seek to every sample. Convenient when the samples are more distant than the keyframes."""
+
+    def read(self, frame_no):
+        return self.seek(frame_no)
+
+
+class SequentialFrameSource(FrameSource):
+    """
+    Decode the video sequentially, grabbing the frames between two samples.
+    It falls back on seeking when the next sample is behind or farther than `max_grab` frames.
+    """
+
+    def __init__(self, video_capture, frames, max_grab=DEFAULT_MAX_GRAB, shot_detector=None):
+        super().__init__(video_capture, frames, shot_detector)
+        self.max_grab = max_grab
+        self.position = -1  # the frame currently held by the decoder
+        self.current = None
+
+    def read(self, frame_no):
+        gap = frame_no - self.position
+        if gap == 0 and self.current is not None:
+            return self.current
+
+        if gap < 0 or gap > self.max_grab:
+            self.current = self.seek(frame_no)
+        else:
+            for _ in range(gap):
+                self.decoded += 1
+                if not self.video_capture.grab():
+                    self.current = None
+                    self.position = frame_no
+                    return None
+            _, self.current = self.video_capture.retrieve()
+
+        self.position = frame_no
+        return self.current
+
+
+class ShotChangeDetector:
+    """
+    Cheap per-frame signals computed on a downscaled gray version of the frame:
+    the Bhattacharyya distance between consecutive histograms reveals the cuts,
+    the mean absolute difference between consecutive frames measures the motion.
+    """
+
+    def __init__(self, cut_threshold=0.4, size=(64, 36), bins=32):
+        self.cut_threshold = cut_threshold
+        self.size = size
+        self.bins = bins
+        self.previous = None
+        self.previous_hist = None
+
+    def update(self, frame):
+        """Return (is_cut, histogram distance, motion) with respect to the previous frame"""
+        small = cv2.cvtColor(cv2.resize(frame, self.size, interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+        hist = cv2.calcHist([small], [0], None, [self.bins], [0, 256])
+        cv2.normalize(hist, hist)
+
+        if self.previous is None:
+            distance, motion = 0., 0.
+        else:
+            distance = cv2.compareHist(self.previous_hist, hist, cv2.HISTCMP_BHATTACHARYYA)
+            motion = np.mean(cv2.absdiff(self.previous, small)) / 255.
+
+        self.previous = small
+        self.previous_hist = hist
+        return distance > self.cut_threshold, distance, motion
+
+
+class AdaptiveFrameSource(SequentialFrameSource):
+    """
+    Content-adaptive sampling. The video is probed every `min_stride` frames with a `ShotChangeDetector`.
+    A sample is taken on each cut, followed by `dense_samples` samples at `min_stride`;
+    within a stable shot the stride doubles at every sample, up to `max_stride`, and goes back to `min_stride`
+    when the motion is higher than `motion_threshold`.
+
+    Every decision is kept in `decisions` as (frame, reason, histogram distance, motion, next stride).
+    """
+
+    def __init__(self, video_capture, frame_start, frame_end, min_stride=5, max_stride=50, cut_threshold=0.4,
+                 motion_threshold=0.05, dense_samples=3, max_grab=DEFAULT_MAX_GRAB):
+        super().__init__(video_capture, sample_frames(frame_start, frame_end, min_stride), max_grab)
+        self.min_stride = min_stride
+        self.max_stride = max_stride
+        self.motion_threshold = motion_threshold
+        self.dense_samples = dense_samples
+        self.shot_detector = ShotChangeDetector(cut_threshold)
+        self.probed = 0
+        self.decisions = []
+
+    def __iter__(self):
+        stride = self.min_stride
+        next_sample = None
+        dense = self.dense_samples
+        for frame_no in self.frames:
+            frame = self.read(int(frame_no))
+            if frame is None:
+                # let the caller know that the video is broken
+                self.delivered += 1
+                yield Sample(frame_no, None)
+                return
+
+            self.probed += 1
+            cut, distance, motion = self.shot_detector.update(frame)
+
+            if cut:
+                reason = 'cut'
+                dense = self.dense_samples
+            elif next_sample is None or frame_no >= next_sample:
+                reason = 'scheduled'
+            else:
+                continue
+
+            if dense > 0:
+                dense -= 1
+                stride = self.min_stride
+            elif motion > self.motion_threshold:
+                stride = self.min_stride
+            else:
+                stride = min(stride * 2, self.max_stride)
+            next_sample = frame_no + stride
+
+            self.decisions.append((frame_no, reason, distance, motion, stride))
+            self.delivered += 1
+            yield Sample(frame_no, frame, cut)
+
+    def stats(self):
+        stats = super().stats()
+        stats['probed'] = self.probed
+        return stats
+
+    def summary(self):
+        return '%s (%d probed)' % (super().summary(), self.probed)
+
+
+def batches(iterable, size):
+    """Iterate over lists of `size` consecutive items"""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def sample_frames(frame_start, frame_end, step):
+    """The explicit list of the frames to analyse in the range [frame_start, frame_end)."""
+    return np.arange(frame_start, frame_end, step)
+
+
+def open_frame_source(video_capture, frames, max_grab=DEFAULT_MAX_GRAB, shot_detector=None):
+    """Choose the cheapest access strategy given the distance between the requested frames."""
+    if len(frames) > 1 and np.median(np.diff(frames)) > max_grab:
+        return SeekingFrameSource(video_capture, frames, shot_detector)
+    return SequentialFrameSource(video_capture, frames, max_grab, shot_detector)
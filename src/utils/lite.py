@@ -0,0 +1,103 @@
+"""
+Reduced-precision inference of the Keras models (FaceNet, the MTCNN networks) with TensorFlow Lite.
+
+A Keras model is converted once, and cached in `data/lite` under the hash of its source files and the precision:
+- float16: the weights are stored in half precision, the computations are in float32
+- int8: dynamic-range quantisation, the weights are stored in int8 and the activations quantised on the fly
+
+`LiteModel.predict` follows `keras.Model.predict`, so that a converted model replaces the Keras one.
+"""
+import json
+import os
+import threading
+
+import numpy as np
+
+ROOT = 'data/lite'
+PRECISIONS = ('float16', 'int8')
+
+
+def convert(model, precision):
+    """The TFLite flatbuffer of a Keras model"""
+    import tensorflow as tf
+    if precision not in PRECISIONS:
+        raise ValueError('Unknown precision %s, expected one of %s' % (precision, ', '.join(PRECISIONS)))
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if precision == 'float16':
+        converter.target_spec.supported_types = [tf.float16]
+    return converter.convert()
+
+
+def load(name, build, version, precision, root=ROOT):
+    """
+    The `LiteModel` of a Keras model, converted the first time.
+    `build` gives the Keras model, and is called only if the conversion is not in the cache.
+    """
+    path = os.path.join(root, '%s-%s-%s.tflite' % (name, version, precision))
+    if not os.path.isfile(path):
+        model = build()
+        print('Converting %s to %s' % (name, precision))
+        content = convert(model, precision)
+        os.makedirs(root, exist_ok=True)
+        # the order of the outputs, which the conversion does not keep
+        _write(path + '.json', json.dumps({'output_dims': [int(o.shape[-1]) for o in model.outputs]}).encode())
+        _write(path, content)
+
+    with open(path + '.json') as f:
+        output_dims = json.load(f)['output_dims']
+    with open(path, 'rb') as f:
+        return LiteModel(f.read(), output_dims)
+
+
+def _write(path, content):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(content)
+    os.replace(tmp, path)
+
+
+class LiteModel:
+    """
+    A TFLite model with the `predict` of Keras. The outputs are matched to the ones of the Keras model by their last
+    dimension, which must differ. A TFLite interpreter is not thread-safe: each thread has its own.
+    """
+
+    def __init__(self, content, output_dims, num_threads=None):
+        if len(set(output_dims)) != len(output_dims):
+            raise ValueError('Outputs with the same last dimension cannot be matched: %s' % output_dims)
+        self.content = content
+        self.output_dims = output_dims
+        self.num_threads = num_threads or os.cpu_count()
+        self._local = threading.local()
+
+    @property
+    def output_shape(self):
+        """As in Keras, with only the last dimension known"""
+        shapes = [(None, dim) for dim in self.output_dims]
+        return shapes[0] if len(shapes) == 1 else shapes
+
+    def _interpreter(self, shape):
+        local = self._local
+        if getattr(local, 'interpreter', None) is None:
+            import tensorflow as tf
+            local.interpreter = tf.lite.Interpreter(model_content=self.content, num_threads=self.num_threads)
+            local.shape = None
+        interpreter = local.interpreter
+        if local.shape != shape:
+            # the batch size, and the image size of P-Net, change between the calls
+            local.input = interpreter.get_input_details()[0]['index']
+            interpreter.resize_tensor_input(local.input, shape)
+            interpreter.allocate_tensors()
+            outputs = {d['shape'][-1]: d['index'] for d in interpreter.get_output_details()}
+            local.outputs = [outputs[dim] for dim in self.output_dims]
+            local.shape = shape
+        return interpreter
+
+    def predict(self, x, **kwargs):
+        x = np.asarray(x, dtype='float32')
+        interpreter = self._interpreter(x.shape)
+        interpreter.set_tensor(self._local.input, x)
+        interpreter.invoke()
+        outputs = [interpreter.get_tensor(i) for i in self._local.outputs]
+        return outputs[0] if len(outputs) == 1 else outputs
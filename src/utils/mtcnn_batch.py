@@ -0,0 +1,258 @@
+"""
+Batched version of `MTCNN.detect_faces`, for images of the same size.
+
+It follows step by step the implementation of the mtcnn package, but each network runs once for all the images:
+P-Net once per pyramid scale, R-Net and O-Net once on the candidates of all the images.
+The helpers (pyramid, NMS, padding, box regression) are the ones of the MTCNN instance.
+
+With a `scale` lower than 1, P-Net and R-Net run on the downscaled images, whose pyramid is much cheaper.
+O-Net then refines the candidates on the full resolution images, giving accurate boxes and landmarks.
+"""
+import cv2
+import numpy as np
+from mtcnn.mtcnn import StageStatus
+
+
+def detect_faces_batch(detector, images, scale=1.):
+    """
+    Detect the faces in a list of images having the same size.
+    With `scale` < 1, the candidates are searched on the images resized by `scale`,
+    then refined on the original images.
+    Return, for each image, the same list of dicts of `MTCNN.detect_faces`.
+    """
+    if len(images) == 0:
+        return []
+
+    height, width, _ = images[0].shape
+    if any(img.shape != images[0].shape for img in images):
+        raise ValueError('All the images of a batch must have the same size')
+
+    small = images
+    if scale != 1:
+        small = [cv2.resize(img, (0, 0), fx=scale, fy=scale, interpolation=cv2.INTER_AREA) for img in images]
+    small_height, small_width, _ = small[0].shape
+
+    # the min face size in the downscaled images, but never upscaling them
+    m = min(12 / (detector._min_face_size * scale), 1.) if scale != 1 else 12 / detector._min_face_size
+    min_layer = np.amin([small_height, small_width]) * m
+    scales = detector._MTCNN__compute_scale_pyramid(m, min_layer)
+
+    stage_status = [StageStatus(width=small_width, height=small_height) for _ in small]
+
+    total_boxes, stage_status = _stage1(detector, small, scales, stage_status)
+    total_boxes = _stage2(detector, small, total_boxes, stage_status)
+
+    if scale != 1:
+        for boxes in total_boxes:
+            if boxes.shape[0] > 0:
+                boxes[:, 0:4] /= scale
+        stage_status = [StageStatus(width=width, height=height) for _ in images]
+    total_boxes, points = _stage3(detector, images, total_boxes, stage_status)
+
+    return [_format(b, p) for b, p in zip(total_boxes, points)]
+
+
+def _stage1(detector, images, scales, stage_status):
+    nms = detector._MTCNN__nms
+    all_boxes = [np.empty((0, 9)) for _ in images]
+
+    for scale in scales:
+        scaled_images = np.stack([detector._MTCNN__scale_image(img, scale) for img in images])
+        img_y = np.transpose(scaled_images, (0, 2, 1, 3))
+
+        out = detector._pnet.predict(img_y)
+
+        out0 = np.transpose(out[0], (0, 2, 1, 3))
+        out1 = np.transpose(out[1], (0, 2, 1, 3))
+
+        for i in range(len(images)):
+            boxes, _ = detector._MTCNN__generate_bounding_box(out1[i, :, :, 1].copy(), out0[i, :, :, :].copy(),
+                                                              scale, detector._steps_threshold[0])
+
+            # inter-scale nms
+            pick = nms(boxes.copy(), 0.5, 'Union')
+            if boxes.size > 0 and pick.size > 0:
+                boxes = boxes[pick, :]
+                all_boxes[i] = np.append(all_boxes[i], boxes, axis=0)
+
+    for i, total_boxes in enumerate(all_boxes):
+        if total_boxes.shape[0] == 0:
+            continue
+
+        pick = nms(total_boxes.copy(), 0.7, 'Union')
+        total_boxes = total_boxes[pick, :]
+
+        regw = total_boxes[:, 2] - total_boxes[:, 0]
+        regh = total_boxes[:, 3] - total_boxes[:, 1]
+
+        qq1 = total_boxes[:, 0] + total_boxes[:, 5] * regw
+        qq2 = total_boxes[:, 1] + total_boxes[:, 6] * regh
+        qq3 = total_boxes[:, 2] + total_boxes[:, 7] * regw
+        qq4 = total_boxes[:, 3] + total_boxes[:, 8] * regh
+
+        total_boxes = np.transpose(np.vstack([qq1, qq2, qq3, qq4, total_boxes[:, 4]]))
+        total_boxes = detector._MTCNN__rerec(total_boxes.copy())
+
+        total_boxes[:, 0:4] = np.fix(total_boxes[:, 0:4]).astype(np.int32)
+        status = stage_status[i]
+        stage_status[i] = StageStatus(detector._MTCNN__pad(total_boxes.copy(), status.width, status.height),
+                                      width=status.width, height=status.height)
+        all_boxes[i] = total_boxes
+
+    return all_boxes, stage_status
+
+
+def _crop_candidates(img, total_boxes, status, size):
+    """The candidate regions resized for the next network, or None if one of them is not valid"""
+    num_boxes = total_boxes.shape[0]
+    tempimg = np.zeros(shape=(size, size, 3, num_boxes))
+
+    for k in range(0, num_boxes):
+        tmp = np.zeros((int(status.tmph[k]), int(status.tmpw[k]), 3))
+
+        tmp[status.dy[k] - 1:status.edy[k], status.dx[k] - 1:status.edx[k], :] = \
+            img[status.y[k] - 1:status.ey[k], status.x[k] - 1:status.ex[k], :]
+
+        if tmp.shape[0] > 0 and tmp.shape[1] > 0 or tmp.shape[0] == 0 and tmp.shape[1] == 0:
+            tempimg[:, :, :, k] = cv2.resize(tmp, (size, size), interpolation=cv2.INTER_AREA)
+        else:
+            return None
+
+    tempimg = (tempimg - 127.5) * 0.0078125
+    return np.transpose(tempimg, (3, 1, 0, 2))
+
+
+def _run_on_candidates(network, crops):
+    """Run the network once on the crops of all the images, then split the outputs by image"""
+    valid = [c for c in crops if c is not None and c.shape[0] > 0]
+    if len(valid) == 0:
+        return [None for _ in crops]
+
+    out = network.predict(np.concatenate(valid))
+
+    outputs = []
+    start = 0
+    for c in crops:
+        if c is None or c.shape[0] == 0:
+            outputs.append(None)
+            continue
+        end = start + c.shape[0]
+        outputs.append([o[start:end] for o in out])
+        start = end
+    return outputs
+
+
+def _stage2(detector, images, all_boxes, stage_status):
+    crops = [_crop_candidates(img, total_boxes, status, 24) if total_boxes.shape[0] > 0 else None
+             for img, total_boxes, status in zip(images, all_boxes, stage_status)]
+    outputs = _run_on_candidates(detector._rnet, crops)
+
+    results = []
+    for total_boxes, c, out in zip(all_boxes, crops, outputs):
+        if total_boxes.shape[0] == 0:
+            results.append(total_boxes)
+            continue
+        if c is None:
+            results.append(np.empty(shape=(0,)))
+            continue
+
+        out0 = np.transpose(out[0])
+        out1 = np.transpose(out[1])
+
+        score = out1[1, :]
+
+        ipass = np.where(score > detector._steps_threshold[1])
+
+        total_boxes = np.hstack([total_boxes[ipass[0], 0:4].copy(), np.expand_dims(score[ipass].copy(), 1)])
+
+        mv = out0[:, ipass[0]]
+
+        if total_boxes.shape[0] > 0:
+            pick = detector._MTCNN__nms(total_boxes, 0.7, 'Union')
+            total_boxes = total_boxes[pick, :]
+            total_boxes = detector._MTCNN__bbreg(total_boxes.copy(), np.transpose(mv[:, pick]))
+            total_boxes = detector._MTCNN__rerec(total_boxes.copy())
+
+        results.append(total_boxes)
+    return results
+
+
+def _stage3(detector, images, all_boxes, stage_status):
+    crops = []
+    for i, (img, total_boxes) in enumerate(zip(images, all_boxes)):
+        if total_boxes.shape[0] == 0:
+            crops.append(None)
+            continue
+
+        total_boxes = np.fix(total_boxes).astype(np.int32)
+        all_boxes[i] = total_boxes
+        status = stage_status[i]
+        status = StageStatus(detector._MTCNN__pad(total_boxes.copy(), status.width, status.height),
+                             width=status.width, height=status.height)
+        crops.append(_crop_candidates(img, total_boxes, status, 48))
+
+    outputs = _run_on_candidates(detector._onet, crops)
+
+    results_boxes = []
+    results_points = []
+    for total_boxes, c, out in zip(all_boxes, crops, outputs):
+        if total_boxes.shape[0] == 0:
+            results_boxes.append(total_boxes)
+            results_points.append(np.empty(shape=(0,)))
+            continue
+        if c is None:
+            results_boxes.append(np.empty(shape=(0,)))
+            results_points.append(np.empty(shape=(0,)))
+            continue
+
+        out0 = np.transpose(out[0])
+        out1 = np.transpose(out[1])
+        out2 = np.transpose(out[2])
+
+        score = out2[1, :]
+
+        points = out1
+
+        ipass = np.where(score > detector._steps_threshold[2])
+
+        points = points[:, ipass[0]]
+
+        total_boxes = np.hstack([total_boxes[ipass[0], 0:4].copy(), np.expand_dims(score[ipass].copy(), 1)])
+
+        mv = out0[:, ipass[0]]
+
+        w = total_boxes[:, 2] - total_boxes[:, 0] + 1
+        h = total_boxes[:, 3] - total_boxes[:, 1] + 1
+
+        points[0:5, :] = np.tile(w, (5, 1)) * points[0:5, :] + np.tile(total_boxes[:, 0], (5, 1)) - 1
+        points[5:10, :] = np.tile(h, (5, 1)) * points[5:10, :] + np.tile(total_boxes[:, 1], (5, 1)) - 1
+
+        if total_boxes.shape[0] > 0:
+            total_boxes = detector._MTCNN__bbreg(total_boxes.copy(), np.transpose(mv))
+            pick = detector._MTCNN__nms(total_boxes.copy(), 0.7, 'Min')
+            total_boxes = total_boxes[pick, :]
+            points = points[:, pick]
+
+        results_boxes.append(total_boxes)
+        results_points.append(points)
+    return results_boxes, results_points
+
+
+def _format(total_boxes, points):
+    bounding_boxes = []
+
+    for bounding_box, keypoints in zip(total_boxes, points.T):
+        bounding_boxes.append({
+            'box': [int(bounding_box[0]), int(bounding_box[1]),
+                    int(bounding_box[2] - bounding_box[0]), int(bounding_box[3] - bounding_box[1])],
+            'confidence': bounding_box[-1],
+            'keypoints': {
+                'left_eye': (int(keypoints[0]), int(keypoints[5])),
+                'right_eye': (int(keypoints[1]), int(keypoints[6])),
+                'nose': (int(keypoints[2]), int(keypoints[7])),
+                'mouth_left': (int(keypoints[3]), int(keypoints[8])),
+                'mouth_right': (int(keypoints[4]), int(keypoints[9])),
+            }
+        })
+
+    return bounding_boxes
@@ -22,16 +22,19 @@ def xywh2rect(x, y, w, h):
 
 # get the face embedding for one face
 def get_embedding(model, face_pixels):
+    return get_embeddings(model, np.expand_dims(face_pixels, axis=0))[0]
+
+
+# get the face embeddings for a batch of faces, with a single forward pass
+def get_embeddings(model, faces):
     # scale pixel values
-    face_pixels = face_pixels.astype('float32')
-    # standardize pixel values across channels (global)
-    mean, std = face_pixels.mean(), face_pixels.std()
-    face_pixels = (face_pixels - mean) / std
-    # transform face into one sample
-    samples = np.expand_dims(face_pixels, axis=0)
+    faces = np.asarray(faces, dtype='float32')
+    # standardize pixel values across channels (global), face by face
+    mean = faces.mean(axis=(1, 2, 3), keepdims=True)
+    std = faces.std(axis=(1, 2, 3), keepdims=True)
+    samples = (faces - mean) / std
     # make prediction to get embedding
-    yhat = model.predict(samples)
-    return yhat[0]
+    return model.predict(samples)
 
 
 def frame2npt(frame, fps):
@@ -49,11 +52,12 @@ def generate_output_path(base, project, video_path):
     # load a dataset that contains one subdir for each class that in turn contains images
 
 
-def load_dataset(directory, keep_original_size=False, disabled=None):
+def list_dataset(directory, disabled=None):
+    """The labels and the paths of the images of a dataset, without loading them"""
     if disabled is None:
         disabled = []
 
-    X, y, paths = list(), list(), list()
+    y, paths = list(), list()
     proj = directory.rsplit('/')[-1]
     # enumerate folders, on per class
     for subdir in sorted(os.listdir(directory)):
@@ -62,28 +66,33 @@ def load_dataset(directory, keep_original_size=False, disabled=None):
         # skip any files that might be in the dir
         if not os.path.isdir(path):
             continue
-        # load all faces in the subdirectory
         files = [os.path.join(path, p) for p in sorted(os.listdir(path))
                  if p != '.DS_Store' and os.path.join(proj, subdir, p) not in disabled]
 
-        faces = [load_gray(file) for file in files]
-        if not keep_original_size:
-            faces = [resize_img(img) for img in faces]
-
         # create labels
-        labels = [subdir for _ in range(len(faces))]
-        # summarize progress
-        print('>loaded %d examples for class: %s' % (len(faces), subdir))
-
-        # store
-        X.extend(faces)
-        y.extend(labels)
+        y.extend([subdir for _ in range(len(files))])
         paths.extend(files)
 
     # Create a list of class names
     class_names = [cls.replace('_', ' ') for cls in np.unique(y)]
 
-    return np.asarray(X), np.asarray(y), paths, class_names
+    return np.asarray(y), paths, class_names
+
+
+def load_dataset(directory, keep_original_size=False, disabled=None):
+    y, paths, class_names = list_dataset(directory, disabled)
+
+    X = list()
+    for label in np.unique(y):
+        # load all faces in the subdirectory
+        faces = [load_gray(file) for file, l in zip(paths, y) if l == label]
+        if not keep_original_size:
+            faces = [resize_img(img) for img in faces]
+        # summarize progress
+        print('>loaded %d examples for class: %s' % (len(faces), label))
+        X.extend(faces)
+
+    return np.asarray(X), y, paths, class_names
 
 
 def load_gray(file):
@@ -0,0 +1,16 @@
+"""The batched Kalman filters of SORT give the same tracks as one filterpy filter per track"""
+import numpy as np
+import pytest
+
+from benchmark.kalman import make_video, track
+
+
+@pytest.mark.parametrize('size', [1, 10, 100])
+def test_same_tracks_as_filterpy(size, tmp_path):
+    video = make_video(size, 100)
+    expected, _ = track(video, False, str(tmp_path))
+    found, _ = track(video, True, str(tmp_path))
+    assert len(found) == len(expected)
+    for e, f in zip(expected, found):
+        # same ids, and boxes equal to the bit
+        np.testing.assert_array_equal(f, e)